@@ -3,9 +3,15 @@ add an equipment record to an asset action log
 by scanning the barcode
 '''
 
+import time
+import queue
+import logging
 import argparse
+import threading
+from pyairtable import Table
 import services.airtable.airtable as airtable
 
+logger = logging.getLogger('main_logger')
 
 def scan_barcode() -> str:
     '''
@@ -15,10 +21,79 @@ def scan_barcode() -> str:
     return barcode
 
 
+class AALWriter(threading.Thread):
+    '''
+    sends equipment to the Asset Action Log in the background
+    so the operator can keep scanning while Airtable catches up
+
+    scans that come in while an update is in flight
+    are sent together in the next update
+    scans that couldn't be sent are kept in failed, and close() raises if there are any
+    '''
+
+    def __init__(self, atbl_tbl_aal: Table, aal_record_id: str, field: str,
+                 eqp_list: list, coalesce_seconds: float = 0.5):
+        super().__init__(daemon=True)
+        self.atbl_tbl_aal = atbl_tbl_aal
+        self.aal_record_id = aal_record_id
+        self.field = field
+        self.eqp_list = list(eqp_list)
+        self.coalesce_seconds = coalesce_seconds
+        self.scans = queue.Queue()
+        self.updates_sent = 0
+        self.failed = []
+        self.error = None
+
+    def add(self, eqp_record_id: str):
+        self.scans.put(eqp_record_id)
+
+    def run(self):
+        closing = False
+        while not closing:
+            pending = [self.scans.get()]
+            # give rapid scans a moment to pile up
+            time.sleep(self.coalesce_seconds)
+            while True:
+                try:
+                    pending.append(self.scans.get_nowait())
+                except queue.Empty:
+                    break
+            if None in pending:
+                closing = True
+                pending = [eqp_record_id for eqp_record_id in pending if eqp_record_id is not None]
+            if not pending:
+                continue
+            self.eqp_list.extend(pending)
+            try:
+                self.atbl_tbl_aal.update(self.aal_record_id, {self.field: self.eqp_list})
+                self.updates_sent += 1
+            except Exception as exc:
+                logger.error(f"there was a problem adding {len(pending)} equipment record(s) "
+                             f"to the Asset Action Log: {pending}")
+                logger.error(exc)
+                for eqp_record_id in pending:
+                    self.eqp_list.remove(eqp_record_id)
+                self.failed.extend(pending)
+                self.error = exc
+
+    def close(self):
+        '''
+        sends anything still pending, then stops
+        raises if any scans weren't added to the Asset Action Log
+        '''
+        self.scans.put(None)
+        self.join()
+        if self.failed:
+            raise RuntimeError(f"{len(self.failed)} equipment record(s) weren't added to the "
+                               f"Asset Action Log, scan them again: {self.failed}") from self.error
+
+
 def attach_equipment_to_aal(args: argparse.Namespace):
     '''
     manages the process
     '''
+    if args.fresh:
+        airtable.use_mirror(False)
     aal_auto_id = args.auto_id
     if not aal_auto_id:
         aal_auto_id = input("Please Enter the 4-digit Auto ID \n"
@@ -28,31 +103,41 @@ def attach_equipment_to_aal(args: argparse.Namespace):
     except Exception:
         print("there was a problem with that Auto ID")
         print("please ensure it's just a 4-digit integer")
+    if args.field == 'asset_action':
+        field = 'Equipment Used - Asset Action'
+    elif args.field == 'digitization':
+        field = 'Equipment Used - Digitization'
     atbl_base = airtable.connect_one_base("Assets")
     atbl_tbl_aal = atbl_base["Physical Asset Action Log"]
     atbl_tbl_eqp = atbl_base["ALL SI AV EQUIPMENT"]
-    while True:
-        atbl_rec_aal = airtable.find(aal_auto_id, "Auto ID #", atbl_tbl_aal, True)
-        print("Please Enter the Barcode below")
-        print("Or type 'exit' to close")
-        barcode = scan_barcode()
-        if barcode.lower() in ['exit']:
-            return
-        atbl_rec_eqp = airtable.find(barcode, "Equip. Barcode", atbl_tbl_eqp, True)
-        if not atbl_rec_eqp:
-            print(f"unable to find equipment with barcode {barcode}")
-            print("please try again")
-            continue
-        if args.field == 'asset_action':
-            field = 'Equipment Used - Asset Action'
-        elif args.field == 'digitization':
-            field = 'Equipment Used - Digitization'
-        try:
-            eqp_list = atbl_rec_aal['fields'][field]
-            eqp_list.append(atbl_rec_eqp['id'])
-        except KeyError:
-            eqp_list = [atbl_rec_eqp['id']]
-        atbl_tbl_aal.update(atbl_rec_aal['id'], {field: eqp_list})
+    atbl_rec_aal = airtable.find(aal_auto_id, "Auto ID #", atbl_tbl_aal, True)
+    if not atbl_rec_aal:
+        print(f"unable to find an Asset Action Log with Auto ID {aal_auto_id}")
+        return
+    print("loading equipment list...")
+    eqp_index = airtable.prefetch(atbl_tbl_eqp, ["Equip. Barcode"], fields=["Equip. Barcode"])
+    writer = AALWriter(atbl_tbl_aal, atbl_rec_aal['id'], field,
+                       atbl_rec_aal['fields'].get(field, []))
+    writer.start()
+    try:
+        while True:
+            print("Please Enter the Barcode below")
+            print("Or type 'exit' to close")
+            barcode = scan_barcode()
+            if barcode.lower() in ['exit']:
+                return
+            eqp_recs = eqp_index.lookup(barcode.strip(), "Equip. Barcode")
+            if len(eqp_recs) != 1:
+                if eqp_recs:
+                    print(f"found {len(eqp_recs)} pieces of equipment with barcode {barcode}")
+                else:
+                    print(f"unable to find equipment with barcode {barcode}")
+                print("please try again")
+                continue
+            writer.add(eqp_recs[0]['id'])
+    finally:
+        print("saving equipment to the Asset Action Log...")
+        writer.close()
 
 
 def init() -> argparse.Namespace:
@@ -74,10 +159,14 @@ def init() -> argparse.Namespace:
                         "Action Log that you'd like to attach the "
                         "equipment to")
     parser.add_argument('-f', '--field', dest='field',
-                        choices=['asset_action', 'digitization'],
+                        choices=['asset_action', 'digitization'], required=True,
                         help="which field in Asset Action Record to add equipment to\n"
                         "'asset_action' = Equipment Used - Asset Action\n"
                         "'digitization' = Equipment Used - Digitization")
+    parser.add_argument('--fresh', dest='fresh', action='store_true', default=False,
+                        help="reads live from Airtable instead of the local mirror")
+    parser.add_argument('--stats_json', dest='stats_json', default=None,
+                        help="writes a summary of the Airtable calls made, with their timings, to this JSON file")
     args = parser.parse_args()
     return args
 
@@ -88,6 +177,7 @@ def main():
     '''
     print("starting...")
     args = init()
+    airtable.report_call_stats_at_exit(args.stats_json)
     attach_equipment_to_aal(args)
 
 
@@ -9,6 +9,7 @@ from pprint import pformat
 import make_log
 import util
 import files
+import services.airtable.airtable as airtable
 import services.excel.excel as excel
 
 
@@ -28,11 +29,11 @@ def process_rows(rows: dict, kwvars: dict):
     '''
     if kwvars['input_validation']:
         # validate it
-        logger.debug("validating sheet against required fields...")
-        missing_fields = excel.validate_required_fields(list(rows.values()), 'BroadcastWaveFile')
-        if missing_fields:
-            logger.error(pformat(missing_fields))
-            raise ValueError("Excel file is missing required fields")
+        logger.debug("validating sheet against field_mappings.json...")
+        problems = excel.validate_rows(rows, 'BroadcastWaveFile')
+        if problems:
+            logger.error(excel.format_problems(problems))
+            raise ValueError(f"Excel file has {len(problems)} problems, fix them and run again")
         logger.debug("validation complete")
     # parse each row to BroadcastWaveFile object, send for embedding
     logger.info("parsing row to BWF...")
@@ -51,15 +52,13 @@ def load_bwf_md_from_excel(kwvars: dict) -> dict:
     '''
     loads bwf metadata from excel sheet
     '''
-    workbook = excel.load_all_worksheets(kwvars['input'])
-    sheet = workbook['Fields_InUse']
-    if not kwvars['row']:
-        rows = sheet
-    else:
-        try:
-            rows = {kwvars['row']: sheet[kwvars['row']]}
-        except KeyError:
-            raise RuntimeError(f"specified row {kwvars['row']} is empty or does not exist")
+    # input can also be a CSV, JSONL or Parquet manifest of the Fields_InUse columns
+    if not excel.is_manifest(kwvars['input']):
+        excel.require_workbook_type(kwvars['input'], ('Unit-BWF',))
+    rows = excel.load_worksheet(kwvars['input'], 'Fields_InUse', kwvars['row'],
+                                use_cache=kwvars['workbook_cache'])
+    if kwvars['row'] and kwvars['row'] not in rows:
+        raise RuntimeError(f"specified row {kwvars['row']} is empty or does not exist")
     return rows
 
 
@@ -68,6 +67,8 @@ def embed_metadata(kwvars: dict):
     manages the process of embedding metadata
     '''
     logger.info("preparing to embed metadata into wave files...")    
+    if kwvars['fresh']:
+        airtable.use_mirror(False)
     if kwvars['input']:
         rows = load_bwf_md_from_excel(kwvars)
         process_rows(rows, kwvars)
@@ -105,6 +106,9 @@ def parse_args(args: argparse.Namespace) -> dict:
     kwvars['row'] = args.row
     kwvars['daid'] = args.daid
     kwvars['dadir'] = args.dadir
+    kwvars['fresh'] = args.fresh
+    kwvars['workbook_cache'] = not args.no_cache
+    kwvars['stats_json'] = args.stats_json
     return kwvars
 
 
@@ -122,7 +126,7 @@ def init_args() -> argparse.Namespace:
                         help="run script in verbose mode. "
                         "print all log messages to command line")
     parser.add_argument('-i', '--input', dest='input',metavar='',
-                        help="the input Excel spreadsheet")
+                        help="the input Excel spreadsheet, or a CSV, JSONL or Parquet manifest")
     parser.add_argument('--no_validation', dest='no_validation', action='store_true', default=False, 
                         help="overrides the validation of required fields for input Excel xlsx files")
     parser.add_argument('-r', '--row', dest='row', default=0, type=int,
@@ -131,6 +135,12 @@ def init_args() -> argparse.Namespace:
                         help="the Digital Asset ID we would like to embed metadata for")
     parser.add_argument('-dadir', '--digital_asset_directory', dest='dadir', default=None,
                         help="the directory where the Digital Asset is located")
+    parser.add_argument('--fresh', dest='fresh', action='store_true', default=False,
+                        help="reads live from Airtable instead of the local mirror")
+    parser.add_argument('--no_cache', dest='no_cache', action='store_true', default=False,
+                        help="re-reads the spreadsheet instead of using the cached copy from an earlier run")
+    parser.add_argument('--stats_json', dest='stats_json', default=None,
+                        help="writes a summary of the Airtable calls made, with their timings, to this JSON file")
     args = parser.parse_args()
     return args
                             
@@ -144,6 +154,7 @@ def main():
     kwvars = parse_args(args)
     global logger
     logger = make_log.init_log(loglevel_print=kwvars['loglevel_print'])
+    airtable.report_call_stats_at_exit(kwvars['stats_json'])
     embed_metadata(kwvars)
     logger.info("embed_md has completed successfully")
 
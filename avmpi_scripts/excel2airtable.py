@@ -1,12 +1,21 @@
 '''
 uploads metadata in Excel spreadsheets to Airtable
 '''
+import re
+import json
+import time
+import uuid
+import zlib
+import queue
 import argparse
 import pathlib
 import logging
+import threading
 from pprint import pformat
 import make_log
+import util
 import services.airtable.airtable as airtable
+import services.airtable.outbox as outbox
 import services.excel.excel as excel
 
 
@@ -29,18 +38,34 @@ def get_record_type_from_sheet(sheet_name: str) -> str:
     return record_type
     
 
-def process_rows(rows: dict, record_type: str, kwvars: dict):
+def process_rows(rows: dict, record_type: str, kwvars: dict) -> dict | None:
     '''
     processes row(s) in sheet
+    returns the totals sent in --batch mode
     '''
     if kwvars['input_validation']:
         # validate it
-        logger.debug("validating sheet against required fields...")
-        missing_fields = excel.validate_required_fields(list(rows.values()), record_type)
-        if missing_fields:
-            logger.error(pformat(missing_fields))
-            raise ValueError("Excel file is missing required fields")
+        logger.debug("validating sheet against field_mappings.json...")
+        problems = excel.validate_rows(rows, record_type)
+        if problems:
+            logger.error(excel.format_problems(problems))
+            raise ValueError(f"Excel file has {len(problems)} problems, fix them and run again")
         logger.debug("validation complete")
+    if len(rows) > 1:
+        # a few OR(...) searches per linked table, instead of one search per linked cell
+        logger.debug("prefetching linked records...")
+        link_terms = airtable.prefetch_link_fields(rows, getattr(airtable, record_type))
+        logger.debug(f"distinct linked values in sheet: {link_terms}")
+    if kwvars['shard']:
+        # shards run in separate processes, so only --create_links creates bare linked records
+        missing = airtable.missing_link_terms(rows, getattr(airtable, record_type))
+        if missing:
+            for (table_name, _), terms in missing.items():
+                logger.error(f"not in {table_name} yet: {', '.join(str(term) for term in terms)}")
+            raise RuntimeError("linked records are missing, run excel2airtable.py --create_links "
+                               "on the whole sheet before running its shards")
+    if kwvars['batch']:
+        return process_rows_batch(rows, record_type, kwvars)
     # parse each row to AirtableRecord() object
     logger.info("parsing row to Airtable record...")
     for row in rows:
@@ -63,32 +88,362 @@ def process_rows(rows: dict, record_type: str, kwvars: dict):
             logger.info("row processed successfully")
 
 
+class OutboxUploader(threading.Thread):
+    '''
+    upload stage of process_rows_batch()
+
+    writes converted records to the outbox, and sends them every send_every records
+    while the rows after them are still being converted
+    the queue in front of it is bounded, so when Airtable is the slow part
+    conversion waits, instead of converted rows piling up in memory
+    '''
+
+    def __init__(self, table_name: str, key_fields: list,
+                 send_every: int = 100, maxsize: int = 200, total: int = None):
+        super().__init__(daemon=True, name='uploader')
+        self.table_name = table_name
+        self.key_fields = key_fields
+        self.send_every = send_every
+        self.total = total
+        self.done = 0
+        self.records = queue.Queue(maxsize)
+        self.totals = {"created": 0, "updated": 0, "failed": 0, "pending": 0, "calls": 0}
+        self.error = None
+
+    def add(self, fields: dict, idempotency_key: str, payload_hash: str = None):
+        '''
+        blocks while the queue is full
+        '''
+        if self.error:
+            raise RuntimeError("upload stopped, see above") from self.error
+        self.records.put((fields, idempotency_key, payload_hash))
+
+    def _send(self):
+        result = airtable.drain_outbox()
+        for total in ('created', 'updated', 'failed', 'calls'):
+            self.totals[total] += result[total]
+        self.totals['pending'] = result['pending']
+
+    def run(self):
+        atbl_outbox = airtable.get_outbox()
+        queued = 0
+        while True:
+            record = self.records.get()
+            if self.error:
+                # keep emptying the queue, so nothing waits on it
+                if record is None:
+                    return
+                continue
+            try:
+                if record is None:
+                    if queued:
+                        self._send()
+                    return
+                fields, idempotency_key, payload_hash = record
+                atbl_outbox.enqueue(self.table_name, 'upsert', fields, idempotency_key,
+                                    key_fields=self.key_fields, payload_hash=payload_hash)
+                queued += 1
+                if queued >= self.send_every:
+                    self._send()
+                    self.done += queued
+                    queued = 0
+                    if self.total:
+                        logger.info(f"{self.table_name}: {self.done} of {self.total} rows sent")
+            except Exception as exc:
+                logger.exception(exc)
+                self.error = exc
+                if record is None:
+                    return
+
+    def close(self) -> dict:
+        '''
+        sends anything still queued, then stops
+        returns the totals for everything sent
+        '''
+        self.records.put(None)
+        self.join()
+        if self.error:
+            raise RuntimeError("there was a problem sending records to Airtable") from self.error
+        return self.totals
+
+
+def process_rows_batch(rows: dict, record_type: str, kwvars: dict) -> dict:
+    '''
+    non-interactive bulk version of process_rows()
+
+    each converted row is written to the local outbox first, then sent in batches
+    anything left in the outbox by an earlier, interrupted run is sent before starting
+    and rows that haven't changed since they were last queued are not converted again
+
+    converting rows (on kwvars['workers'] threads) and uploading them happen at once,
+    connected by a bounded queue
+    so a big sheet takes about as long as the slower of the two
+    '''
+    logger.info(f"parsing {len(rows)} rows to Airtable records...")
+    if record_type == "PhysicalAssetRecord":
+        record_class = airtable.PhysicalAssetRecord
+    elif record_type == "DigitalAssetRecord":
+        record_class = airtable.DigitalAssetRecord
+    else:
+        record_class = airtable.PhysicalAssetActionRecord
+    # anything left over from an interrupted run goes first
+    airtable.drain_outbox()
+    if record_class is airtable.PhysicalAssetActionRecord:
+        return queue_asset_actions(rows, record_type, kwvars)
+    primary_field_name = record_class._get_primary_field_name()
+    table_name = record_class.meta.table_name
+    atbl_outbox = airtable.get_outbox()
+    already_queued = 0
+
+    def rows_to_convert():
+        nonlocal already_queued
+        for row in rows:
+            # one outbox entry per row, holding a hash of the row's values when it was last queued
+            # so a row changed A -> B -> A is sent each time, but an unchanged row isn't
+            idempotency_key = outbox.make_idempotency_key(kwvars['input'].name, record_type, row)
+            payload_hash = outbox.make_payload_hash(list(rows[row].values()))
+            if atbl_outbox.unchanged(idempotency_key, payload_hash):
+                already_queued += 1
+                continue
+            yield rows[row], idempotency_key, payload_hash
+
+    def convert_row(row_to_convert: tuple) -> tuple[dict, str, str]:
+        row, idempotency_key, payload_hash = row_to_convert
+        atbl_rec = record_class().from_xlsx(row)
+        return atbl_rec.to_record(only_writable=True)['fields'], idempotency_key, payload_hash
+
+    uploader = OutboxUploader(table_name, [primary_field_name], total=len(rows))
+    uploader.start()
+    try:
+        for fields, idempotency_key, payload_hash in util.map_ordered(convert_row, rows_to_convert(),
+                                                                       workers=kwvars['workers']):
+            uploader.add(fields, idempotency_key, payload_hash)
+    finally:
+        logger.info("sending the rest of the records to Airtable...")
+        totals = uploader.close()
+    if already_queued:
+        logger.info(f"{already_queued} rows haven't changed since an earlier run sent or queued them, "
+                    f"skipping them")
+    report_totals(totals)
+    return totals
+
+
+def queue_asset_actions(rows: dict, record_type: str, kwvars: dict) -> dict:
+    '''
+    the primary field of the action log is a formula, so it can't be upserted on
+    instead the whole sheet is compared to the existing log entries for its physical assets
+    and only new/ changed actions are queued
+    '''
+    atbl_recs = [airtable.PhysicalAssetActionRecord().from_xlsx(rows[row]) for row in rows]
+    plan = airtable.plan_asset_actions(atbl_recs)
+    logger.info(f"actions in sheet: {len(plan['create'])} new, {len(plan['update'])} changed, "
+                f"{plan['unchanged']} unchanged")
+    if plan['failed']:
+        logger.error(f"{plan['failed']} actions could not be matched to the log, see above for details")
+    atbl_outbox = airtable.get_outbox()
+    table_name = airtable.PhysicalAssetActionRecord.meta.table_name
+    # the plan is made against what's in Airtable right now, so its writes belong to this run
+    # (an interrupted run's writes were drained before planning, and so are already in the plan)
+    run_id = uuid.uuid4().hex
+    for fields in plan['create']:
+        idempotency_key = outbox.make_idempotency_key(kwvars['input'].name, record_type,
+                                                      run_id, 'create', fields)
+        atbl_outbox.enqueue(table_name, 'create', fields, idempotency_key)
+    for record in plan['update']:
+        idempotency_key = outbox.make_idempotency_key(kwvars['input'].name, record_type,
+                                                      run_id, 'update', record)
+        atbl_outbox.enqueue(table_name, 'update', record, idempotency_key)
+    return send_outbox()
+
+
+def send_outbox() -> dict:
+    '''
+    sends everything queued, and reports on it
+    '''
+    logger.info("sending records to Airtable in batches...")
+    totals = airtable.drain_outbox()
+    report_totals(totals)
+    return totals
+
+
+def report_totals(totals: dict):
+    '''
+    logs what was sent, and what wasn't
+    '''
+    logger.info(f"records sent: {totals}")
+    if totals['failed']:
+        logger.error(f"{totals['failed']} records failed to upload, see above for details")
+        logger.error("once fixed in Airtable, run again with --retry_failed to resend them")
+    if totals['pending']:
+        logger.error(f"{totals['pending']} records could not be sent, run again to resume")
+
+
+'''
+the column each kind of row is sharded on
+rows for the same record always go to the same shard, so shards never write the same record
+asset actions go by their physical asset, since the whole log for one asset is compared at once
+'''
+shard_key_columns = {
+    'PhysicalAssetRecord': 'A',
+    'DigitalAssetRecord': 'A',
+    'PhysicalAssetActionRecord': 'B',
+}
+
+
+def parse_row_range(value: str) -> tuple[int, int | None]:
+    '''
+    "START-END" -> (START, END), "START-" -> (START, None)
+    '''
+    match = re.fullmatch(r'\s*(\d+)\s*-\s*(\d*)\s*', value)
+    if not match or (match.group(2) and int(match.group(2)) < int(match.group(1))):
+        raise argparse.ArgumentTypeError(f"{value} is not a row range, e.g. 5-1000, or 5- for row 5 to the end")
+    return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    '''
+    "i/N" -> (i, N), shards are numbered from 1
+    '''
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"{value} is not a shard, e.g. 2/4 for the second of 4")
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard(row: dict, row_index: int, record_type: str, shards: int) -> int:
+    '''
+    which shard, numbered from 1, a row belongs to
+    crc32 rather than hash(), so it's the same in every process and on every machine
+    '''
+    key = row.get(shard_key_columns.get(record_type, 'A'))
+    if key is None or key == '':
+        key = row_index
+    return zlib.crc32(str(key).strip().encode('utf-8')) % shards + 1
+
+
+def select_shard(rows: dict, record_type: str, shard: int, shards: int) -> dict:
+    '''
+    just the rows in this shard of the sheet
+    '''
+    return {row_index: row for row_index, row in rows.items()
+            if get_shard(row, row_index, record_type, shards) == shard}
+
+
+def default_results_filepath(kwvars: dict) -> pathlib.Path:
+    shard, shards = kwvars['shard']
+    return pathlib.Path.cwd() / f"{kwvars['input'].stem}.shard-{shard}-of-{shards}.results.json"
+
+
+def write_results(results: dict, filepath: pathlib.Path):
+    with open(filepath, 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+    logger.info(f"results written to {filepath}")
+
+
+def merge_results(filepaths: list) -> dict:
+    '''
+    combines the results files of every shard of a run into one
+    adds up the totals for each sheet, and lists any shards that are missing
+    '''
+    merged = {"input": None, "rows": None, "shards": None, "shards_merged": [], "shards_missing": [],
+              "sheets": {}, "totals": {"rows": 0, "created": 0, "updated": 0, "failed": 0,
+                                       "pending": 0, "calls": 0}}
+    for filepath in filepaths:
+        with open(filepath, 'r') as results_file:
+            results = json.load(results_file)
+        for key in ('input', 'rows', 'shards'):
+            if merged[key] is None:
+                merged[key] = results[key]
+            elif merged[key] != results[key]:
+                raise RuntimeError(f"{filepath} is from a different run, its {key} is {results[key]}, "
+                                   f"not {merged[key]}")
+        if results['shard'] in merged['shards_merged']:
+            raise RuntimeError(f"{filepath} is shard {results['shard']}, which was already merged")
+        merged['shards_merged'].append(results['shard'])
+        for sheet_name, sheet_totals in results['sheets'].items():
+            merged_sheet = merged['sheets'].setdefault(sheet_name, dict.fromkeys(sheet_totals, 0))
+            for total, value in sheet_totals.items():
+                merged_sheet[total] = merged_sheet.get(total, 0) + value
+                merged['totals'][total] = merged['totals'].get(total, 0) + value
+    merged['shards_merged'].sort()
+    if merged['shards']:
+        merged['shards_missing'] = [shard for shard in range(1, merged['shards'] + 1)
+                                    if shard not in merged['shards_merged']]
+    return merged
+
+
+def report_merged_results(merged: dict):
+    logger.info(f"{len(merged['shards_merged'])} of {merged['shards']} shards of {merged['input']}: "
+                f"{merged['totals']}")
+    if merged['shards_missing']:
+        logger.error(f"no results for shards {', '.join(str(shard) for shard in merged['shards_missing'])}, "
+                     f"run them with --shard")
+    if merged['totals']['failed'] or merged['totals']['pending']:
+        logger.error("some records weren't sent, run the shards they're in again to resume")
+
+
 def excel_to_airtable(kwvars: dict):
     '''
     manages the upload of an Excel sheet to Airtable
     '''
     logger.info("preparing to parse Excel metadata to Airtable...")
-    # get the spreadsheet
-    workbook = excel.load_all_worksheets(kwvars['input'])
+    if not excel.is_manifest(kwvars['input']):
+        # a spreadsheet that isn't one of our templates is turned away before any of it is read
+        excel.require_workbook_type(kwvars['input'], ('Unit-AssetsMetadata', 'Vendor-AssetsMetadata'))
+    if kwvars['fresh']:
+        airtable.use_mirror(False)
+    if kwvars['shard']:
+        # each shard resumes from, and sends, only its own outbox
+        airtable.use_outbox(f"outbox.shard-{kwvars['shard'][0]}-of-{kwvars['shard'][1]}.sqlite")
+    if kwvars['retry_failed']:
+        retried = airtable.get_outbox().retry_failed()
+        logger.info(f"{retried} failed records put back in the outbox to resend")
+    if kwvars['refresh_schema']:
+        logger.info("refreshing cached Airtable schema...")
+        airtable.get_base_schema(airtable.config()['bases']['Assets']['base_id'], refresh=True)
+    min_row, max_row = kwvars['rows'] or (None, None)
+    started = time.time()
+    sheets_totals = {}
     if kwvars['sheet']:
-        sheet = workbook[kwvars['sheet']]
         record_type = get_record_type_from_sheet(kwvars['sheet'])
         if not record_type:
             return
-        if not kwvars['row']:
-            rows = sheet
-        else:
-            try:
-                rows = {kwvars['row']: sheet[kwvars['row']]}
-            except KeyError:
-                raise RuntimeError(f"specified row {kwvars['row']} is empty or does not exist")
-        process_rows(rows, record_type, kwvars)
+        # only the sheet, or the row(s), asked for is read from the spreadsheet
+        rows = excel.load_worksheet(kwvars['input'], kwvars['sheet'], kwvars['row'],
+                                    use_cache=kwvars['workbook_cache'], min_row=min_row, max_row=max_row)
+        if kwvars['row'] and kwvars['row'] not in rows:
+            raise RuntimeError(f"specified row {kwvars['row']} is empty or does not exist")
+        sheets = {kwvars['sheet']: rows}
     else:
-        for sheet_name, rows in workbook.items():
-            record_type = get_record_type_from_sheet(sheet_name)
-            if not record_type:
-                continue
-            process_rows(rows, record_type, kwvars)
+        # get the spreadsheet
+        workbook = excel.load_all_worksheets(kwvars['input'], use_cache=kwvars['workbook_cache'])
+        sheets = {sheet_name: excel.select_rows(rows, min_row, max_row) if kwvars['rows'] else rows
+                  for sheet_name, rows in workbook.items()}
+    for sheet_name, rows in sheets.items():
+        record_type = get_record_type_from_sheet(sheet_name)
+        if not record_type:
+            continue
+        if kwvars['create_links']:
+            created = airtable.create_link_records(rows, getattr(airtable, record_type))
+            logger.info(f"bare linked records created for {sheet_name}: {created or 'none needed'}")
+            continue
+        if kwvars['shard']:
+            shard, shards = kwvars['shard']
+            sheet_rows = len(rows)
+            rows = select_shard(rows, record_type, shard, shards)
+            logger.info(f"shard {shard} of {shards}: {len(rows)} of the {sheet_rows} rows in {sheet_name}")
+        if not rows:
+            sheets_totals[sheet_name] = {"rows": 0}
+            continue
+        totals = process_rows(rows, record_type, kwvars)
+        sheets_totals[sheet_name] = {"rows": len(rows), **(totals or {})}
+    if kwvars['results_json'] or kwvars['shard']:
+        shard, shards = kwvars['shard'] or (1, 1)
+        write_results({"input": kwvars['input'].name, "rows": kwvars['rows'],
+                       "shard": shard, "shards": shards,
+                       "started": started, "finished": time.time(), "sheets": sheets_totals},
+                      pathlib.Path(kwvars['results_json']) if kwvars['results_json']
+                      else default_results_filepath(kwvars))
 
 
 def parse_args(args: argparse.Namespace):
@@ -102,6 +457,12 @@ def parse_args(args: argparse.Namespace):
         kwvars['loglevel_print'] = logging.DEBUG
     else:
         kwvars['loglevel_print'] = logging.INFO
+    kwvars['merge_results'] = args.merge_results
+    kwvars['results_json'] = args.results_json
+    if args.merge_results:
+        return kwvars
+    if not args.input:
+        raise RuntimeError("an input spreadsheet is needed, use -i")
     kwvars['input'] = pathlib.Path(args.input)
     if args.no_validation:
         kwvars['input_validation'] = False
@@ -109,6 +470,16 @@ def parse_args(args: argparse.Namespace):
         kwvars['input_validation'] = True
     kwvars['sheet'] = args.sheet
     kwvars['row'] = args.row
+    kwvars['rows'] = args.rows
+    kwvars['shard'] = args.shard
+    kwvars['create_links'] = args.create_links
+    kwvars['batch'] = args.batch
+    kwvars['refresh_schema'] = args.refresh_schema
+    kwvars['retry_failed'] = args.retry_failed
+    kwvars['fresh'] = args.fresh
+    kwvars['workers'] = args.workers
+    kwvars['workbook_cache'] = not args.no_cache
+    kwvars['stats_json'] = args.stats_json
     return kwvars
 
 
@@ -127,14 +498,54 @@ def init_args() -> argparse.Namespace:
                         "print all log messages to command line")
     parser.add_argument('-i', '--input', dest='input',
                         metavar='',
-                        help="the input spreadsheet to upload")
+                        help="the input spreadsheet to upload, or a CSV, JSONL or Parquet manifest\n"
+                        "named after the sheet it replaces, e.g. \"Digital Assets.csv\", or use -s")
     parser.add_argument('--no_validation', dest='no_validation', action='store_true', default=False, 
                         help="overrides the validation of required fields for input Excel xlsx files")
     parser.add_argument('-s', '--sheet', dest='sheet', default=None,
                         help="uploads an individual sheet by name, e.g. Assets-Unit-Provided-template")
     parser.add_argument('-r', '--row', dest='row', default=0, type=int,
                         help="uploads an individual row by row number, e.g. -r 5 will upload row 5")
+    parser.add_argument('--rows', dest='rows', default=None, type=parse_row_range,
+                        help="uploads only rows START to END, e.g. --rows 5-1000, or --rows 5- for row 5 to the end")
+    parser.add_argument('--shard', dest='shard', default=None, type=parse_shard,
+                        help="uploads only shard i of N of the rows, e.g. --shard 2/4\n"
+                        "run each of 1/4 to 4/4 at once, in different windows or on different machines,\n"
+                        "each writes its own results file, combine them with --merge_results. needs --batch\n"
+                        "run --create_links on the whole sheet first")
+    parser.add_argument('--create_links', dest='create_links', action='store_true', default=False,
+                        help="only creates the linked records (Containers, Physical Assets etc.)\n"
+                        "that the rows link to but aren't in Airtable yet, and uploads nothing else\n"
+                        "run it once before --shard, so shards don't each create the same record")
+    parser.add_argument('--results_json', dest='results_json', default=None,
+                        help="writes what was sent from each sheet to this JSON file\n"
+                        "with --shard, defaults to <input>.shard-i-of-N.results.json in the current folder")
+    parser.add_argument('--merge_results', dest='merge_results', nargs='+', default=None,
+                        metavar='RESULTS_JSON',
+                        help="combines the results files of every shard and reports on the whole run\n"
+                        "with --results_json, also writes the combined results there")
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true', default=False,
+                        help="non-interactive bulk mode, uploads records in batches of 10\n"
+                        "without prompting before each record")
+    parser.add_argument('--refresh_schema', dest='refresh_schema', action='store_true', default=False,
+                        help="re-downloads the Airtable schema instead of using the cached copy")
+    parser.add_argument('--retry_failed', dest='retry_failed', action='store_true', default=False,
+                        help="resends records that Airtable rejected on an earlier --batch run")
+    parser.add_argument('--workers', dest='workers', default=4, type=int,
+                        help="number of rows converted at once in --batch mode, default 4")
+    parser.add_argument('--fresh', dest='fresh', action='store_true', default=False,
+                        help="reads live from Airtable instead of the local mirror")
+    parser.add_argument('--no_cache', dest='no_cache', action='store_true', default=False,
+                        help="re-reads the spreadsheet instead of using the cached copy from an earlier run")
+    parser.add_argument('--stats_json', dest='stats_json', default=None,
+                        help="writes a summary of the Airtable calls made, with their timings, to this JSON file")
     args = parser.parse_args()
+    if args.shard and not args.batch:
+        parser.error("--shard only works with --batch")
+    if args.shard and args.create_links:
+        parser.error("run --create_links on the whole sheet, without --shard")
+    if args.rows and args.row:
+        parser.error("use either -r or --rows, not both")
     return args
                             
 
@@ -147,6 +558,13 @@ def main():
     kwvars = parse_args(args)
     global logger
     logger = make_log.init_log(loglevel_print=kwvars['loglevel_print'])
+    if kwvars['merge_results']:
+        merged = merge_results(kwvars['merge_results'])
+        report_merged_results(merged)
+        if kwvars['results_json']:
+            write_results(merged, pathlib.Path(kwvars['results_json']))
+        return
+    airtable.report_call_stats_at_exit(kwvars['stats_json'])
     excel_to_airtable(kwvars)
     logger.info("excel2airtable has completed successfully")
 
@@ -22,6 +22,31 @@ def get_field_map(obj_type: str) -> dict:
     return field_mapping[obj_type]
 
 
+_xlsx_plans = {}
+
+
+def get_xlsx_plan(obj_type: str) -> list[tuple[str, str]]:
+    '''
+    compiles the field mapping for obj_type once
+    into a flat list of (column, attr_name) for every field that comes from XLSX
+    '''
+    try:
+        return _xlsx_plans[obj_type]
+    except KeyError:
+        pass
+    plan = []
+    for attr_name, mapping in get_field_map(obj_type).items():
+        if not mapping.get('xlsx'):
+            continue
+        try:
+            column = mapping['xlsx']['column']
+        except TypeError:
+            column = mapping['xlsx']
+        plan.append((column, attr_name))
+    _xlsx_plans[obj_type] = plan
+    return plan
+
+
 class BWFDescription(object):
     '''
     BWF Description field is a mess so it gets its own class
@@ -119,15 +144,8 @@ class BroadcastWaveFile(object):
         '''
         creates BWF object from a row in Excel metadata template
         '''
-        field_map = get_field_map('BroadcastWaveFile')
         instance = cls()
-        for attr_name, mapping in field_map.items():
-            try:
-                column = mapping['xlsx']['column']
-            except TypeError:
-                column = mapping['xlsx']
-            except Exception as exc:
-                raise RuntimeError(exc)
+        for column, attr_name in get_xlsx_plan('BroadcastWaveFile'):
             value = row[column]
             if not value:
                 continue
@@ -2,20 +2,29 @@
 handler for Airtable calls for AVMPI
 '''
 from pprint import pprint
+import os
 import re
 import ast
+import atexit
 import time
 import json
 import pathlib
 import logging
 import requests
-from datetime import timedelta, datetime
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import timedelta, datetime, date, time as datetime_time
 from pprint import pformat
 from pyairtable import Api, Base, Table
 from pyairtable.orm import Model, fields
-from pyairtable.formulas import match
+from pyairtable.formulas import match, OR, EQ, RECORD_ID
 from pyairtable.api import types as pyairtable_types
-from typing import Self, Any
+from typing import Self, Any, Callable, Iterator, Iterable, NamedTuple
+from . import ratelimit
+from . import outbox
+from . import mirror
+from . import callstats
 
 RecordDict = pyairtable_types.RecordDict
 
@@ -53,6 +62,490 @@ def get_field_map(obj_type: str) -> str:
     return field_mapping[obj_type]
 
 
+def get_cache_dir() -> pathlib.Path:
+    '''
+    returns the directory where local caches are kept
+    set in airtable_config.json main.cache_dir, defaults to ~/.avmpi_scripts
+    '''
+    cache_dir = config()['main'].get('cache_dir')
+    if cache_dir:
+        cache_dirpath = pathlib.Path(cache_dir)
+    else:
+        cache_dirpath = pathlib.Path.home() / '.avmpi_scripts'
+    cache_dirpath.mkdir(parents=True, exist_ok=True)
+    return cache_dirpath
+
+
+_rate_governor = None
+
+
+def get_rate_governor() -> ratelimit.RateGovernor:
+    '''
+    returns the rate governor shared by every script on this machine
+    settings are in airtable_config.json rate_limit
+    '''
+    global _rate_governor
+    if _rate_governor is None:
+        rate_conf = config().get('rate_limit', {})
+        _rate_governor = ratelimit.RateGovernor(get_cache_dir() / 'ratelimit.sqlite',
+                                                rate_conf.get('requests_per_second', 5),
+                                                rate_conf.get('burst', 5))
+    return _rate_governor
+
+
+def current_wait_time(base_id: str = None) -> float:
+    '''
+    how long the next Airtable request from this machine would have to wait
+    '''
+    if not base_id:
+        base_id = config()['bases']['Assets']['base_id']
+    return get_rate_governor().wait_time(base_id)
+
+
+_call_stats = callstats.CallStats()
+
+
+def get_call_stats() -> callstats.CallStats:
+    '''
+    returns the record of every Airtable request made this run
+    '''
+    return _call_stats
+
+
+def report_call_stats(json_filepath: pathlib.Path = None):
+    '''
+    logs a summary of this run's Airtable requests, per table and operation
+    and writes it (with every call) to json_filepath, if given
+    '''
+    call_stats = get_call_stats()
+    if not call_stats.calls and not json_filepath:
+        return
+    logger.info(call_stats.format_summary())
+    if json_filepath:
+        call_stats.write_json(json_filepath)
+        logger.info(f"Airtable call stats written to {json_filepath}")
+
+
+def report_call_stats_at_exit(json_filepath: pathlib.Path = None):
+    '''
+    for the scripts: report_call_stats() when the script exits, however it exits
+    '''
+    atexit.register(report_call_stats, json_filepath)
+
+
+def new_api() -> Api:
+    '''
+    returns an Api where every request goes through the shared rate governor
+    the governor handles 429s, so pyairtable's own retries are turned off
+
+    connection pool size, timeouts and retries for dropped connections
+    are set in airtable_config.json http
+    most code wants the shared get_api() instead
+    '''
+    atbl_conf = config()
+    rate_conf = atbl_conf.get('rate_limit', {})
+    http_conf = atbl_conf.get('http', {})
+    # endpoint_url is only set to point the scripts at a stand-in server, e.g. in tests
+    endpoint_url = atbl_conf['main'].get('endpoint_url') or 'https://api.airtable.com'
+    timeout = (http_conf.get('connect_timeout_seconds', 10), http_conf.get('read_timeout_seconds', 60))
+    atbl_api = Api(get_api_key(), timeout=timeout, retry_strategy=None, endpoint_url=endpoint_url)
+    atbl_api.session = ratelimit.GovernedSession(get_rate_governor,
+                                                 max_retries=rate_conf.get('max_retries', 5),
+                                                 get_call_stats=get_call_stats)
+    # only failures to connect are retried here, nothing has reached Airtable yet so it's always safe
+    connect_retries = http_conf.get('connect_retries', 3)
+    adapter = HTTPAdapter(pool_connections=http_conf.get('pool_size', 10),
+                          pool_maxsize=http_conf.get('pool_size', 10),
+                          max_retries=Retry(total=connect_retries, connect=connect_retries,
+                                            read=0, status=0, other=0, backoff_factor=0.5))
+    atbl_api.session.mount('https://', adapter)
+    atbl_api.session.mount('http://', adapter)
+    # the Authorization header lives on the session
+    atbl_api.api_key = get_api_key()
+    return atbl_api
+
+
+_api = None
+_api_lock = threading.Lock()
+
+
+def get_api() -> Api:
+    '''
+    returns the Api shared by every table and Record() class in this process
+    so its pool of keep-alive connections gets reused, instead of a new
+    connection (and TLS handshake) for every lookup
+    '''
+    global _api
+    with _api_lock:
+        if _api is None:
+            _api = new_api()
+        return _api
+
+
+_outbox = None
+_outbox_filename = 'outbox.sqlite'
+
+
+def get_outbox() -> outbox.Outbox:
+    '''
+    returns the local outbox that Airtable writes are queued in
+    '''
+    global _outbox
+    if _outbox is None:
+        _outbox = outbox.Outbox(get_cache_dir() / _outbox_filename)
+    return _outbox
+
+
+def use_outbox(filename: str):
+    '''
+    switches this run to its own outbox file in the cache directory
+    so processes uploading different shards of a sheet at once don't send each other's entries
+    '''
+    global _outbox, _outbox_filename
+    if _outbox is not None:
+        _outbox.close()
+    _outbox = None
+    _outbox_filename = filename
+
+
+def drain_outbox() -> dict:
+    '''
+    sends everything pending in the outbox to the Assets base
+    '''
+    atbl_base = connect_one_base('Assets')
+    return get_outbox().drain(lambda table_name: atbl_base[table_name])
+
+
+_mirror = None
+_mirror_enabled = None
+_mirror_synced = set()
+
+
+def get_mirror() -> mirror.Mirror:
+    '''
+    returns the local mirror of the tables in airtable_config.json
+    settings are in airtable_config.json mirror
+    '''
+    global _mirror
+    if _mirror is None:
+        mirror_conf = config().get('mirror', {})
+        _mirror = mirror.Mirror(get_cache_dir() / 'mirror.sqlite',
+                                mirror_conf.get('full_sync_hours', 24),
+                                mirror_conf.get('overlap_seconds', 300))
+    return _mirror
+
+
+def use_mirror(enabled: bool):
+    '''
+    turns reads from the local mirror on or off for this run
+    scripts turn it off with --fresh
+    '''
+    global _mirror_enabled
+    _mirror_enabled = enabled
+    for key, table_index in list(_table_indexes.items()):
+        if table_index.all_fields:
+            del _table_indexes[key]
+
+
+def mirror_enabled() -> bool:
+    '''
+    the mirror is off unless airtable_config.json mirror.enabled turns it on
+    delta syncs go by LAST_MODIFIED_TIME(), which doesn't change when a lookup/ rollup field does
+    so mirrored lookup fields can be out of date
+    '''
+    if _mirror_enabled is None:
+        return config().get('mirror', {}).get('enabled', False)
+    return _mirror_enabled
+
+
+def is_mirrored(table: Table) -> bool:
+    '''
+    only the tables listed in airtable_config.json are mirrored
+    '''
+    for base_conf in config()['bases'].values():
+        if base_conf['base_id'] == table.base.id and table.name in base_conf['tables']:
+            return True
+    return False
+
+
+def sync_mirror(table: Table, full: bool = False) -> int:
+    '''
+    brings the mirror of table up to date, once per run
+    returns the number of page requests it took
+    '''
+    key = (table.base.id, table.name)
+    if key in _mirror_synced and not full:
+        return 0
+    pages = get_mirror().sync(table, full=full)
+    _mirror_synced.add(key)
+    return pages
+
+
+_base_schemas = {}
+_schema_lock = threading.Lock()
+
+
+def _fetch_base_schema(base_id: str) -> dict:
+    '''
+    gets the schema for every table in a base from the Airtable metadata API
+    and boils it down to what we use: primary field, field types, select options
+    '''
+    atbl_api = get_api()
+    atbl_base = atbl_api.base(base_id)
+    response = atbl_api.get(atbl_base.urls.tables)
+    tables = {}
+    for table in response['tables']:
+        table_fields = {}
+        primary_field_name = None
+        for field in table['fields']:
+            field_info = {"id": field['id'], "type": field['type']}
+            try:
+                field_info['options'] = [choice['name'] for choice in field['options']['choices']]
+            except (KeyError, TypeError):
+                pass
+            table_fields[field['name']] = field_info
+            if field['id'] == table['primaryFieldId']:
+                primary_field_name = field['name']
+        tables[table['name']] = {"id": table['id'],
+                                 "primary_field": primary_field_name,
+                                 "fields": table_fields}
+    return {"base_id": base_id, "fetched_at": time.time(), "tables": tables}
+
+
+def get_base_schema(base_id: str, refresh: bool = False) -> dict:
+    '''
+    returns the schema for a base
+    fetched once per run at most, and kept on disk between runs
+    for schema_cache.ttl_hours in airtable_config.json
+    refresh=True skips the disk copy and fetches a new one
+    '''
+    if not refresh and base_id in _base_schemas:
+        return _base_schemas[base_id]
+    # conversion threads can all ask at once, only one of them fetches
+    with _schema_lock:
+        if not refresh and base_id in _base_schemas:
+            return _base_schemas[base_id]
+        return _load_base_schema(base_id, refresh)
+
+
+def _load_base_schema(base_id: str, refresh: bool) -> dict:
+    ttl_seconds = config().get('schema_cache', {}).get('ttl_hours', 24) * 3600
+    schema_filepath = get_cache_dir() / f"schema_{base_id}.json"
+    base_schema = None
+    if not refresh and schema_filepath.exists():
+        try:
+            with open(schema_filepath, 'r') as schema_file:
+                base_schema = json.load(schema_file)
+        except json.JSONDecodeError:
+            # e.g. written by an older version that didn't write it in one go
+            logger.warning(f"cached schema for base {base_id} is unreadable, fetching it again")
+            base_schema = None
+        if base_schema and time.time() - base_schema['fetched_at'] > ttl_seconds:
+            logger.debug(f"cached schema for base {base_id} is out of date")
+            base_schema = None
+    if not base_schema:
+        logger.debug(f"fetching schema for base {base_id}...")
+        base_schema = _fetch_base_schema(base_id)
+        # written to a temp file, then moved into place in one go
+        # so other scripts starting up at the same time never read half a file
+        tmp_filepath = schema_filepath.with_name(f"{schema_filepath.name}.{os.getpid()}.tmp")
+        with open(tmp_filepath, 'w') as schema_file:
+            json.dump(base_schema, schema_file)
+        os.replace(tmp_filepath, schema_filepath)
+    _base_schemas[base_id] = base_schema
+    return base_schema
+
+
+def get_table_schema(base_id: str, table_name: str) -> dict:
+    '''
+    returns the cached schema for one table
+    if the table isn't in the cached schema, the schema is refreshed once
+    in case the table is new
+    '''
+    base_schema = get_base_schema(base_id)
+    if table_name not in base_schema['tables']:
+        base_schema = get_base_schema(base_id, refresh=True)
+    try:
+        return base_schema['tables'][table_name]
+    except KeyError:
+        raise RuntimeError(f"no table named {table_name} in base {base_id}")
+
+
+def convert_multi_select(value: str) -> list:
+    '''
+    comma-separated cell -> multiple select options
+    '''
+    return [val for val in value.split(',')]
+
+
+def convert_barcode(value: Any) -> str:
+    '''
+    barcodes come out of Excel as numbers, sometimes floats,
+    and out of CSVs as text, sometimes with a trailing .0
+    '''
+    #value = {"text": str(int(value))}
+    if isinstance(value, str):
+        # not int(float()), long barcodes lose digits as floats
+        return value.strip().split('.')[0]
+    return str(int(value))
+
+
+def convert_secondary_asset_id(value: Any) -> Any:
+    '''
+    numeric IDs lose their trailing .0, anything else is left alone
+    '''
+    try:
+        return str(int(value))
+    except (TypeError, ValueError):
+        return value
+
+
+def convert_to_list(value: Any) -> list:
+    '''
+    single value -> list, for multiple select fields
+    '''
+    return [value]
+
+
+def convert_size_value(value: Any) -> int | float:
+    '''
+    pulls the number out of sizes like "7 in." or "1200ft"
+    '''
+    if isinstance(value, (int, float)):
+        return value
+    num_str = re.match(r'\d+(\.\d+)?|\.\d+', value.strip()).group()
+    if "." in num_str:
+        return float(num_str)
+    return int(num_str)
+
+
+def convert_float(value: Any) -> float:
+    return float(value)
+
+
+def convert_number(value: Any) -> int | float:
+    '''
+    number fields, for values that come in as text, e.g. from a CSV manifest
+    '''
+    if isinstance(value, (int, float)):
+        return value
+    value = str(value).strip()
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def convert_title_case(value: str) -> str:
+    return value.title()
+
+
+def convert_date(value: Any) -> datetime | None:
+    '''
+    YYYY-MM-DD -> datetime, anything unparseable -> None
+    '''
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    try:
+        return datetime.strptime(str(value).strip(), '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def convert_duration(value: Any) -> Any:
+    '''
+    mm:ss or hh:mm:ss -> timedelta
+    Excel gives time formatted cells as times, or datetimes when they're over a day
+    plain numbers are seconds, like Airtable's durations
+    '''
+    if isinstance(value, datetime):
+        # back to days since Excel's epoch, which openpyxl counts from 1899-12-31 up to its 1900-02-29 bug
+        return value - (datetime(1899, 12, 31) if value < datetime(1900, 3, 1) else datetime(1899, 12, 30))
+    if isinstance(value, datetime_time):
+        return timedelta(hours=value.hour, minutes=value.minute, seconds=value.second)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return timedelta(seconds=value)
+    if not isinstance(value, str) or ':' not in value:
+        return value
+    time_components = value.strip().split(':')
+    if len(time_components) == 2:
+        # assume mm:ss
+        minutes, seconds = map(int, time_components)
+        return timedelta(minutes=minutes, seconds=seconds)
+    elif len(time_components) == 3:
+        # hh:mm:ss
+        hours, minutes, seconds = map(int, time_components)
+        return timedelta(hours=hours, minutes=minutes, seconds=seconds)
+    return value
+
+
+'''
+attributes that need an extra layer of formatting between XLSX and Airtable
+number fields that aren't listed get convert_number(), see compile_conversion_plan()
+'''
+attr_converters = {
+    'brand_stock': convert_multi_select,
+    'asset_barcode': convert_barcode,
+    'physical_asset_barcode': convert_barcode,
+    'color': convert_to_list,
+    'sound': convert_to_list,
+    'base_substrate': convert_to_list,
+    'secondary_asset_id': convert_secondary_asset_id,
+    'size_value': convert_size_value,
+    'asset_size': convert_float,
+    'size_type': convert_title_case,
+    'date_value': convert_date,
+    'asset_creation_date': convert_date,
+    'asset_duration': convert_duration,
+}
+
+
+NUMBER_FIELD_TYPES = ('number', 'float', 'integer')
+
+
+class ConversionStep(NamedTuple):
+    '''
+    one entry in a compiled conversion plan:
+    read column, convert it (if needed), set it on attr_name
+    '''
+    column: str
+    attr_name: str
+    converter: Callable | None
+    is_link: bool
+
+
+_conversion_plans = {}
+
+
+def compile_conversion_plan(record_class: type, field_map: dict) -> list[ConversionStep]:
+    '''
+    walks field_mappings.json once per record type
+    and flattens it into the list of steps from_xlsx() runs on every row
+    '''
+    try:
+        return _conversion_plans[record_class]
+    except KeyError:
+        pass
+    plan = []
+    for attr_name, mapping in field_map.items():
+        if not mapping.get('xlsx') or not mapping.get('atbl'):
+            continue
+        try:
+            column = mapping['xlsx']['column']
+        except TypeError:
+            column = mapping['xlsx']
+        converter = attr_converters.get(attr_name)
+        if not converter and isinstance(mapping['atbl'], dict) and \
+                mapping['atbl'].get('type') in NUMBER_FIELD_TYPES:
+            converter = convert_number
+        plan.append(ConversionStep(column, attr_name, converter,
+                                   attr_name in record_class.link_field_attrs))
+    _conversion_plans[record_class] = plan
+    return plan
+
+
 class AVMPIAirtableRecord:
     '''
     super class for the various AirtableRecord() classes we'll create later
@@ -60,142 +553,97 @@ class AVMPIAirtableRecord:
     notably, send() and from_xlsx()
     '''
     primary_field = None
+    link_field_attrs = ['DigitalAsset', 'PhysicalAsset', 'PhysicalFormat',
+                        'LocationPrep', 'LocationDelivery', 'Collection',
+                        'Container', 'Generation']
 
     def _fix_problem_attrs(self, attr_name: str, value: str) -> Any:
         '''
         for some of these we need an extra layer of formatting
+        see attr_converters
         '''
-        multi_select_fields = ['brand_stock']
-        if attr_name in multi_select_fields:
-            value = [val for val in value.split(',')]
-        if 'asset_barcode' in attr_name:
-            #value = {"text": str(int(value))}
-            value = str(int(value))
-        if attr_name == 'color' or attr_name == 'sound':
-            value = [value]
-        if attr_name == 'secondary_asset_id':
-            try:
-                value = str(int(value))
-            except:
-                pass
-        if attr_name == 'size_value':
-            if isinstance(value, (int, float)):
-                pass
-            else:
-                num_str = ''.join(re.findall(r'\d+|\.', value))
-                if "." in num_str:
-                    value = float(num_str)
-                else:
-                    value = int(num_str)
-        if attr_name == 'base_substrate':
-            value = [value]
-        if attr_name == 'asset_size':
-            value = float(value)
-        if attr_name == 'size_type':
-            value = value.title()
-        if attr_name in ('date_value', 'asset_creation_date'):
-            try:
-                value = datetime.strptime(value, '%Y-%m-%d')
-            except ValueError:
-                value = None
-        if attr_name == 'asset_duration':
-            if ':' in value:
-                time_components = value.split(':')
-                if len(time_components) == 2:
-                    # assume mm:ss
-                    minutes, seconds = map(int, value.split(':'))
-                    value = timedelta(minutes=minutes, seconds=seconds)
-                elif len(time_components) == 3:
-                    # hh:mm:ss
-                    hours, minutes, seconds = map(int, value.split(':'))
-                    value = timedelta(hours=hours, minutes=minutes, seconds=seconds)
-        return value
+        try:
+            return attr_converters[attr_name](value)
+        except KeyError:
+            return value
 
-    def _set_link_field(self, attr_name: str, value: str) -> list:
+    @staticmethod
+    def _get_link_target(attr_name: str) -> tuple[str, str, type]:
         '''
-        sets the values for a linked field
-        little bit of a hack but it works great
+        for a link field attribute, returns
+        the linked table name, its primary key name, and its Record() class
         '''
-        atbl_api_key = get_api_key()
-        atbl_api = Api(atbl_api_key)
-        atbl_conf = config()
-        base_id = atbl_conf['bases']['Assets']['base_id']
         if attr_name == 'DigitalAsset':
-            table_name = 'Digital Assets'
-            primary_key_name = 'Digital Asset ID'
-            the_class = DigitalAssetRecord()
+            return 'Digital Assets', 'Digital Asset ID', DigitalAssetRecord
         elif attr_name == 'PhysicalAsset':
-            table_name = 'Physical Assets'
-            primary_key_name = 'Physical Asset ID'
-            the_class = PhysicalAssetRecord()
+            return 'Physical Assets', 'Physical Asset ID', PhysicalAssetRecord
         elif attr_name == 'PhysicalFormat':
-            table_name = 'AV Formats'
-            primary_key_name = 'Term'
-            the_class = PhysicalFormatRecordSyncd()
+            return 'AV Formats', 'Term', PhysicalFormatRecordSyncd
         elif attr_name == 'Collection':
-            table_name = 'Collections'
-            primary_key_name = 'Collection Title'
-            the_class = CollectionRecordSyncd()
+            return 'Collections', 'Collection Title', CollectionRecordSyncd
         elif 'Location' in attr_name:
-            table_name = 'Locations'
-            primary_key_name = 'Name'
-            the_class = LocationRecordSyncd()
+            return 'Locations', 'Name', LocationRecordSyncd
         elif 'Container' in attr_name:
-            table_name = 'Containers'
-            primary_key_name = 'Container Name'
-            the_class = ContainerRecord()
+            return 'Containers', 'Container Name', ContainerRecord
         elif 'Generation' in attr_name:
-            table_name = 'Generations'
-            primary_key_name = 'Term'
-            the_class = GenerationRecord()
-        if isinstance(self, PhysicalAssetRecord) and table_name in ['Digital Assets', 'Generations']:
+            return 'Generations', 'Term', GenerationRecord
+        raise RuntimeError(f"{attr_name} is not a link field")
+
+    def _is_multi_link(self, table_name: str) -> bool:
+        '''
+        Physical Assets can link to several Digital Assets/ Generations in one cell
+        '''
+        return isinstance(self, PhysicalAssetRecord) and table_name in ['Digital Assets', 'Generations']
+
+    @staticmethod
+    def _split_link_terms(value: str) -> list:
+        '''
+        splits a cell with several linked terms in it
+        '''
+        if ',' in value:
+            values = value.split(',')
+        elif ';' in value:
+            values = value.split(';')
+        else:
+            values = [value.strip()]
+        return [item.strip() for item in values]
+
+    def _set_link_field(self, attr_name: str, value: str) -> list:
+        '''
+        sets the values for a linked field
+        little bit of a hack but it works great
+
+        lookups go through link_resolver, so each term is only searched for
+        (or created) once per run
+        linked records are bare ids, use hydrate() if their fields are needed
+        '''
+        table_name, primary_key_name, the_class = self._get_link_target(attr_name)
+        if self._is_multi_link(table_name):
             atbl_recs = []
-            if ',' in value:
-                values = value.split(',')
-            elif ';' in value:
-                values = value.split(';')
-            else:
-                values = [value.strip()]
-            values = [item.strip() for item in values]
-            for link_rec_term in values:
-                atbl_tbl = atbl_api.table(base_id, table_name)
+            for link_rec_term in self._split_link_terms(value):
                 logger.debug(f"searching for {link_rec_term} in field {primary_key_name} in table {table_name}")
-                result = atbl_tbl.all(formula=match({primary_key_name: link_rec_term}))
-                if not result:
+                record_id = link_resolver.resolve(table_name, primary_key_name, link_rec_term,
+                                                  create=table_name != 'Generations')
+                if not record_id:
                     logger.warning(f"while parsing linked field, no record was in linked table for:")
                     logger.warning(f"\nvalue: {link_rec_term}\nprimary_key_name: {primary_key_name}\ntable: {table_name}")
-                    if table_name == 'Generations':
-                        logger.warning("Please add that value to the linked/ syncd table, "\
-                                "or edit that value in the original spreadsheet to match existing values, and try again")
-                        exit()
-                    logger.warning("creating bare record to link to")
-                    result = atbl_tbl.create({primary_key_name: link_rec_term})
-                    result = [result]
-                    logger.debug(f"result: {result[0]}")
-                atbl_rec = the_class.from_id(result[0]['id'])
+                    logger.warning("Please add that value to the linked/ syncd table, "\
+                            "or edit that value in the original spreadsheet to match existing values, and try again")
+                    exit()
+                atbl_rec = the_class.from_id(record_id, fetch=False, memoize=True)
                 logger.debug(pformat(atbl_rec))
                 atbl_recs.append(atbl_rec)
             return atbl_recs
-        atbl_tbl = atbl_api.table(base_id, table_name)
-        result = atbl_tbl.all(formula=match({primary_key_name: value}))
-        if not result:
-            logger.warning(f"table: {table_name}\nprimary key: {primary_key_name}\nvalue: {value} did not return any results initially")
-            logger.warning("creating bare record to link to...")
-            try:
-                result = atbl_tbl.create({primary_key_name: value})
-                result = [result]
-            except requests.exceptions.HTTPError as exc:
-                logger.error("the script encountered an error while trying to create a bare linked record")
-                logger.error("this was likely because the value does not exist in a linked, sync'd table")
-                logger.error(f"linked table: {table_name}")
-                logger.error(f"value: {value}")
-                # logger.exception(exc, stack_info=True)
-                raise RuntimeError("please ensure the value above exists in the table and try again")
         try:
-            atbl_rec = the_class.from_id(result[0]['id'])
-            atbl_rec.save()
-        except:
-            print(the_class)
+            record_id = link_resolver.resolve(table_name, primary_key_name, value)
+        except requests.exceptions.HTTPError as exc:
+            logger.error("the script encountered an error while trying to create a bare linked record")
+            logger.error("this was likely because the value does not exist in a linked, sync'd table")
+            logger.error(f"linked table: {table_name}")
+            logger.error(f"value: {value}")
+            # logger.exception(exc, stack_info=True)
+            raise RuntimeError("please ensure the value above exists in the table and try again")
+        atbl_rec = the_class.from_id(record_id, fetch=False, memoize=True)
         return [atbl_rec]
 
     @classmethod
@@ -204,31 +652,13 @@ class AVMPIAirtableRecord:
         creates an Airtable record from a row of an XLSX spreadsheet
         '''
         instance = cls()
-        problem_attrs = ['asset_barcode', 'color', 'sound', 'asset_duration', 'asset_size',
-                         'secondary_asset_id', 'physical_asset_barcode', 'date_value', 'asset_creation_date',
-                         'brand_stock', 'size_type', 'size_value', 'base_substrate']
-        link_field_attrs = ['DigitalAsset', 'PhysicalAsset', 'PhysicalFormat',
-                            'LocationPrep', 'LocationDelivery', 'Collection',
-                            'Container', 'Generation']
-        for attr_name, mapping in field_map.items():
-            try:
-                assert mapping['xlsx']
-            except KeyError:
-                continue
-            if not mapping['atbl']:
-                continue
-            try:
-                column = mapping['xlsx']['column']
-            except TypeError:
-                column = mapping['xlsx']
-            except Exception as exc:
-                raise RuntimeError
+        for column, attr_name, converter, is_link in compile_conversion_plan(cls, field_map):
             value = row[column]
             if not value:
                 continue
-            if attr_name in problem_attrs:
-                value = instance._fix_problem_attrs(attr_name, value)
-            if attr_name in link_field_attrs:
+            if converter:
+                value = converter(value)
+            if is_link:
                 value = instance._set_link_field(attr_name, value)
             try:
                 setattr(instance, attr_name, value)
@@ -241,20 +671,30 @@ class AVMPIAirtableRecord:
                 raise RuntimeError("there was a problem parsing the above value to an Airtable field")
         return instance
 
+    @classmethod
+    def get_table_schema(cls) -> dict:
+        '''
+        returns the cached schema for this record's table:
+        primary field name, and the type (and select options) of each field
+        '''
+        return get_table_schema(cls.meta.base_id, cls.meta.table_name)
+
+    @classmethod
+    def _get_primary_field_name(cls) -> str:
+        '''
+        looks up the name of the primary field in the cached table schema
+        '''
+        primary_field_name = cls.get_table_schema()['primary_field']
+        if not primary_field_name:
+            raise RuntimeError(f"no primary field found in schema for table {cls.meta.table_name}")
+        return primary_field_name
+
     def _get_primary_key_info(self) -> tuple[str, str]:
         '''
         for send()
         gets primary key name and value
         '''
-        atbl_tbl = self.meta.table
-        # atbl_tbl_schema = Base.table(atbl_tbl.name).schema
-        atbl_tbl_schema = atbl_tbl.schema()
-        # atbl_tbl_schema = atbl_mtd.get_table_schema(atbl_tbl)
-        primary_field_id = atbl_tbl_schema.primary_field_id
-        for field in atbl_tbl_schema.fields:
-            if field.id == primary_field_id:
-                primary_field_name = field.name
-                break
+        primary_field_name = self._get_primary_field_name()
         try:
             self_primary_field_value = self._fields[primary_field_name]
         except KeyError:
@@ -272,13 +712,15 @@ class AVMPIAirtableRecord:
         logger.debug(f"searching table {atbl_tbl.name}")
         logger.debug(f"in field {primary_field_name}")
         logger.debug(f"for value {self_primary_field_value}")
-        response = atbl_tbl.all(formula=match({primary_field_name: self_primary_field_value}))
+        # only the id is needed, the local values are filled in on top of it
+        response = atbl_tbl.all(formula=match({primary_field_name: self_primary_field_value}),
+                                fields=[primary_field_name])
         if len(response) > 1:
             logger.error(f"too many results for {self_primary_field_value} in field {primary_field_name}")
             raise ValueError("duplicate records in table")
         elif len(response) > 0:
             logger.debug("result found, updating Airtable record with local values...")
-            atbl_rec_remote = self.from_id(response[0]['id'])
+            atbl_rec_remote = self.from_id(response[0]['id'], fetch=False)
         else:
             logger.debug("no results found")
             return None
@@ -305,7 +747,6 @@ class AVMPIAirtableRecord:
         '''
         try:
             atbl_rec.save()
-            time.sleep(0.1)
             if atbl_rec.exists():
                 return atbl_rec
             else:
@@ -490,16 +931,16 @@ class PhysicalAssetActionRecord(Model, AVMPIAirtableRecord):
         we can't search on it
         so, we make our own custom search here
         '''
-        atbl_tbl = self.get_table()
+        atbl_tbl = self.meta.table
         filter_formula = "AND({Asset} = '" + self.PhysicalAsset[0].physical_asset_id + "', "\
                 "{Activity Type} = '" + self.activity_type + "')"
-        response = atbl_tbl.all(formula=filter_formula)
+        response = atbl_tbl.all(formula=filter_formula, fields=["Asset", "Activity Type"])
         if len(response) > 1:
-            logger.error(f"too many results for {self_primary_field_value} in field {primary_field_name}")
+            logger.error(f"too many results for {self.activity_type} on {self.PhysicalAsset[0].physical_asset_id}")
             raise ValueError("duplicate records in table")
         elif len(response) > 0:
             logger.debug("result found, updating Airtable record with local values...")
-            atbl_rec_remote = self.from_id(response[0]['id'])
+            atbl_rec_remote = self.from_id(response[0]['id'], fetch=False)
             for field, value in self._fields.items():
                 try:
                     atbl_rec_remote._fields[field] = value
@@ -512,7 +953,6 @@ class PhysicalAssetActionRecord(Model, AVMPIAirtableRecord):
         logger.debug(atbl_rec_remote.__dict__)
         try:
             atbl_rec_remote.save()
-            time.sleep(0.1)
             if atbl_rec_remote.exists():
                 return atbl_rec_remote
             else:
@@ -638,21 +1078,204 @@ def set_link_fields():
     adds class attributes for above classes for link fields
     happens here + called globally because
     we need all of the Record() classes definied before linking them
+
+    links are lazy, i.e. linked records are bare ids until hydrate()d
     '''
-    setattr(PhysicalAssetRecord, 'DigitalAsset', fields.LinkField('Digital Assets', DigitalAssetRecord))
-    setattr(PhysicalAssetRecord, 'PhysicalFormat', fields.LinkField('Physical Format', PhysicalFormatRecordSyncd))
-    setattr(PhysicalAssetRecord, 'LocationPrep', fields.LinkField('Current Location', LocationRecordSyncd))
-    setattr(PhysicalAssetRecord, 'LocationDelivery', fields.LinkField('Delivery Location', LocationRecordSyncd))
-    setattr(PhysicalAssetRecord, 'Collection', fields.LinkField('Collection', CollectionRecordSyncd))
-    setattr(DigitalAssetRecord, 'PhysicalAsset', fields.LinkField('Original Physical Asset', PhysicalAssetRecord))
-    setattr(DigitalAssetRecord, 'Container', fields.LinkField('Container', ContainerRecord))
-    setattr(PhysicalAssetActionRecord, 'PhysicalAsset', fields.LinkField('Asset', PhysicalAssetRecord))
-    setattr(PhysicalAssetRecord, 'Generation', fields.LinkField('Generation', GenerationRecord))
+    setattr(PhysicalAssetRecord, 'DigitalAsset', fields.LinkField('Digital Assets', DigitalAssetRecord, lazy=True))
+    setattr(PhysicalAssetRecord, 'PhysicalFormat', fields.LinkField('Physical Format', PhysicalFormatRecordSyncd, lazy=True))
+    setattr(PhysicalAssetRecord, 'LocationPrep', fields.LinkField('Current Location', LocationRecordSyncd, lazy=True))
+    setattr(PhysicalAssetRecord, 'LocationDelivery', fields.LinkField('Delivery Location', LocationRecordSyncd, lazy=True))
+    setattr(PhysicalAssetRecord, 'Collection', fields.LinkField('Collection', CollectionRecordSyncd, lazy=True))
+    setattr(DigitalAssetRecord, 'PhysicalAsset', fields.LinkField('Original Physical Asset', PhysicalAssetRecord, lazy=True))
+    setattr(DigitalAssetRecord, 'Container', fields.LinkField('Container', ContainerRecord, lazy=True))
+    setattr(PhysicalAssetActionRecord, 'PhysicalAsset', fields.LinkField('Asset', PhysicalAssetRecord, lazy=True))
+    setattr(PhysicalAssetRecord, 'Generation', fields.LinkField('Generation', GenerationRecord, lazy=True))
 
 
 set_link_fields()
 
 
+def use_governed_api():
+    '''
+    points every Record() class at the shared Api, which goes through the rate governor
+    '''
+    for record_class in AVMPIAirtableRecord.__subclasses__():
+        record_class.meta.api = get_api()
+
+
+use_governed_api()
+
+
+class LinkResolver:
+    '''
+    per-run cache of linked record lookups
+    keyed on (table, primary key, term) -> record id
+
+    the same Collection, AV Format, Location etc. shows up on thousands of rows
+    so we only want to search for each one once,
+    and never create the same bare record twice
+    lookups are locked, so rows can be converted on several threads at once
+    '''
+
+    def __init__(self, atbl_base: dict = None):
+        self._atbl_base = atbl_base
+        self.record_ids = {}
+        self.missing = set()
+        self._lock = threading.RLock()
+
+    @property
+    def atbl_base(self) -> dict:
+        if self._atbl_base is None:
+            self._atbl_base = connect_one_base('Assets')
+        return self._atbl_base
+
+    @staticmethod
+    def _cache_key(table_name: str, primary_key_name: str, term: Any) -> tuple[str, str, str]:
+        return table_name, primary_key_name, str(term).strip()
+
+    def prefetch(self, table_name: str, primary_key_name: str, terms: Iterable) -> int:
+        '''
+        searches the linked table for every term that isn't cached yet,
+        as many terms per query as fit (see find_many()), and caches them
+        after this, terms that weren't found are known to be missing from the table
+        mirrored tables are answered from the local mirror
+        returns the number of terms found
+        '''
+        with self._lock:
+            return self._prefetch(table_name, primary_key_name, terms)
+
+    def _prefetch(self, table_name: str, primary_key_name: str, terms: Iterable) -> int:
+        terms = {self._cache_key(table_name, primary_key_name, term): term for term in terms}
+        terms = {cache_key: term for cache_key, term in terms.items()
+                 if cache_key not in self.record_ids and cache_key not in self.missing}
+        if not terms:
+            return 0
+        atbl_tbl = self.atbl_base[table_name]
+        logger.debug(f"prefetching {len(terms)} {primary_key_name} values from {table_name}")
+        results = find_many(list(terms.values()), primary_key_name, atbl_tbl, fields=[primary_key_name])
+        count = 0
+        for cache_key, term in terms.items():
+            if results[term]:
+                self.record_ids[cache_key] = results[term][0]['id']
+                count += 1
+            else:
+                self.missing.add(cache_key)
+        return count
+
+    def resolve(self, table_name: str, primary_key_name: str,
+                term: Any, create: bool = True) -> str | None:
+        '''
+        returns the record id for term in the linked table
+        if it doesn't exist, creates a bare record (once), unless create=False
+        '''
+        cache_key = self._cache_key(table_name, primary_key_name, term)
+        if cache_key in self.record_ids:
+            return self.record_ids[cache_key]
+        with self._lock:
+            return self._resolve(table_name, primary_key_name, term, create, cache_key)
+
+    def _resolve(self, table_name: str, primary_key_name: str, term: Any,
+                 create: bool, cache_key: tuple) -> str | None:
+        self._prefetch(table_name, primary_key_name, [term])
+        if cache_key in self.record_ids:
+            return self.record_ids[cache_key]
+        if not create:
+            return None
+        atbl_tbl = self.atbl_base[table_name]
+        logger.warning(f"table: {table_name}\nprimary key: {primary_key_name}\nvalue: {term} did not return any results initially")
+        logger.warning("creating bare record to link to...")
+        result = atbl_tbl.create({primary_key_name: term})
+        logger.debug(f"result: {result}")
+        remember_record(atbl_tbl, result)
+        self.record_ids[cache_key] = result['id']
+        self.missing.discard(cache_key)
+        return result['id']
+
+    def reset(self):
+        with self._lock:
+            self.record_ids.clear()
+            self.missing.clear()
+
+
+link_resolver = LinkResolver()
+
+
+def get_link_terms(rows: dict, record_class: type) -> dict:
+    '''
+    returns every distinct linked value in the rows
+    as {(linked table, primary key, whether a bare record is created if it's missing): {terms}}
+    '''
+    terms_by_target = {}
+    for attr_name, mapping in record_class.field_map.items():
+        if attr_name not in record_class.link_field_attrs:
+            continue
+        try:
+            column = mapping['xlsx']['column']
+        except TypeError:
+            column = mapping['xlsx']
+        except KeyError:
+            continue
+        table_name, primary_key_name, _ = record_class._get_link_target(attr_name)
+        is_multi_link = record_class()._is_multi_link(table_name)
+        # see _set_link_field(), missing Generations in a multi link cell are an error
+        create = not (is_multi_link and table_name == 'Generations')
+        terms = terms_by_target.setdefault((table_name, primary_key_name, create), set())
+        for row in rows.values():
+            value = row[column]
+            if not value:
+                continue
+            if is_multi_link:
+                terms.update(record_class._split_link_terms(value))
+            else:
+                terms.add(value)
+    return terms_by_target
+
+
+def prefetch_link_fields(rows: dict, record_class: type) -> dict:
+    '''
+    before converting a sheet, looks up every distinct linked value in it
+    with a handful of OR(...) searches per linked table, instead of one search per cell
+    returns the number of distinct terms in the sheet for each linked table
+    '''
+    terms_by_target = get_link_terms(rows, record_class)
+    link_terms = {}
+    for (table_name, primary_key_name, _), terms in terms_by_target.items():
+        link_resolver.prefetch(table_name, primary_key_name, terms)
+        link_terms[table_name] = link_terms.get(table_name, 0) + len(terms)
+    return link_terms
+
+
+def missing_link_terms(rows: dict, record_class: type) -> dict:
+    '''
+    returns the linked values in the rows that aren't in Airtable yet,
+    and would be created as bare records while converting them
+    as {(linked table, primary key): [terms]}
+    '''
+    missing = {}
+    for (table_name, primary_key_name, create), terms in get_link_terms(rows, record_class).items():
+        if not create:
+            continue
+        link_resolver.prefetch(table_name, primary_key_name, terms)
+        for term in sorted(terms, key=str):
+            if link_resolver.resolve(table_name, primary_key_name, term, create=False) is None:
+                missing.setdefault((table_name, primary_key_name), []).append(term)
+    return missing
+
+
+def create_link_records(rows: dict, record_class: type) -> dict:
+    '''
+    creates a bare record for every linked value in the rows that isn't in Airtable yet
+    so that rows converted later, e.g. in several processes at once, only ever link to them
+    returns the number of records created in each linked table
+    '''
+    created = {}
+    for (table_name, primary_key_name), terms in missing_link_terms(rows, record_class).items():
+        for term in terms:
+            link_resolver.resolve(table_name, primary_key_name, term)
+        created[table_name] = created.get(table_name, 0) + len(terms)
+    return created
+
+
 def connect_one_base(base_name: str) -> Base:
     '''
     returns a connection to every table in a base
@@ -661,15 +1284,249 @@ def connect_one_base(base_name: str) -> Base:
     atbl_conf = config()
     atbl_base = {}
     atbl_base_id = atbl_conf['bases'][base_name]['base_id']
-    api = Api(atbl_conf['main']['api_key'])
+    api = get_api()
     for table_name in atbl_conf['bases'][base_name]['tables']:
         atbl_tbl = api.table(atbl_base_id, table_name)
         atbl_base.update({table_name: atbl_tbl})
     return atbl_base
 
 
+class TableIndex:
+    '''
+    in-memory copy of every record in a table
+    hashed on one or more fields, so that find() can answer
+    from memory instead of running a formula query per lookup
+
+    with all_fields, the records are complete (e.g. from the mirror)
+    and any other field gets indexed the first time it's looked up
+    '''
+
+    def __init__(self, table: Table, index_fields: list, all_fields: bool = False):
+        self.table = table
+        self.all_fields = all_fields
+        self.indexes = {field: {} for field in index_fields}
+        self.records_by_id = {}
+        self.page_requests = 0
+
+    @property
+    def index_fields(self) -> list:
+        return list(self.indexes)
+
+    @property
+    def record_count(self) -> int:
+        return len(self.records_by_id)
+
+    @staticmethod
+    def _index_keys(value: Any) -> list:
+        '''
+        returns the key(s) a field value is stored under
+        lookup/ multiple fields come back as lists,
+        so we index each item and the comma-joined string, like a formula would see it
+        '''
+        if value is None:
+            return []
+        if isinstance(value, list):
+            keys = [TableIndex._index_key(item) for item in value]
+            keys.append(', '.join(str(item) for item in value))
+            return list(dict.fromkeys(keys))
+        return [TableIndex._index_key(value)]
+
+    @staticmethod
+    def _index_key(value: Any) -> str:
+        '''
+        normalizes a value so 1234, 1234.0 and '1234' all find the same record
+        '''
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+
+    def add(self, record: RecordDict):
+        '''
+        adds (or replaces) a record in the index
+        use after creating/ updating records mid-run to keep the index current
+        '''
+        self.remove(record['id'])
+        self.records_by_id[record['id']] = record
+        for field, index in self.indexes.items():
+            for key in self._index_keys(record['fields'].get(field)):
+                index.setdefault(key, []).append(record)
+
+    def remove(self, record_id: str):
+        '''
+        drops a record from the index, if it's in there
+        '''
+        record = self.records_by_id.pop(record_id, None)
+        if not record:
+            return
+        for field, index in self.indexes.items():
+            for key in self._index_keys(record['fields'].get(field)):
+                kept = [rec for rec in index[key] if rec['id'] != record_id]
+                if kept:
+                    index[key] = kept
+                else:
+                    del index[key]
+
+    def load(self, **options: Any) -> int:
+        '''
+        pulls the whole table, one page at a time
+        returns the number of page requests it took
+        '''
+        pages = 0
+        for page in self.table.iterate(**options):
+            pages += 1
+            for record in page:
+                self.add(record)
+        self.page_requests += pages
+        return pages
+
+    def covers(self, field: str) -> bool:
+        '''
+        whether lookup() can answer for field
+        '''
+        return self.all_fields or field in self.indexes
+
+    def index_field(self, field: str):
+        '''
+        indexes the records already loaded on another field
+        '''
+        if field in self.indexes:
+            return
+        index = self.indexes[field] = {}
+        for record in self.records_by_id.values():
+            for key in self._index_keys(record['fields'].get(field)):
+                index.setdefault(key, []).append(record)
+
+    def lookup(self, query: Any, field: str) -> list:
+        '''
+        returns every record where field == query
+        '''
+        if field not in self.indexes and self.all_fields:
+            self.index_field(field)
+        return list(self.indexes[field].get(self._index_key(query), []))
+
+
+_table_indexes = {}
+
+
+def _table_index_key(table: Table) -> tuple[str, str]:
+    return table.base.id, table.name
+
+
+def mirror_index(table: Table) -> TableIndex | None:
+    '''
+    returns an index of every record in table, read from the local mirror
+    the mirror is synced first, once per run
+    None if the mirror is turned off or doesn't cover table
+    '''
+    if not mirror_enabled() or not is_mirrored(table):
+        return None
+    table_index = get_table_index(table)
+    if table_index and table_index.all_fields:
+        return table_index
+    pages = sync_mirror(table)
+    table_index = TableIndex(table, [], all_fields=True)
+    for record in get_mirror().iterate(table):
+        table_index.add(record)
+    table_index.page_requests = pages
+    logger.debug(f"loaded {table_index.record_count} records in {table.name} from the local mirror")
+    _table_indexes[_table_index_key(table)] = table_index
+    return table_index
+
+
+def remember_record(table: Table, record: RecordDict):
+    '''
+    keeps the index and mirror of table current after a record was created/ updated
+    '''
+    table_index = get_table_index(table)
+    if table_index:
+        table_index.add(record)
+    if mirror_enabled() and is_mirrored(table):
+        get_mirror().put(table, record)
+
+
+def prefetch(table: Table, index_fields: list, **options: Any) -> TableIndex:
+    '''
+    opt-in prefetch mode for find()
+
+    reads every record in table once, with paginated reads,
+    and indexes them on index_fields, e.g. ["Digital Asset ID"]
+    after this, find() on those fields in that table is answered from memory
+
+    mirrored tables are read from the local mirror instead, options are ignored
+    '''
+    table_index = mirror_index(table)
+    if table_index:
+        for field in index_fields:
+            table_index.index_field(field)
+        return table_index
+    logger.info(f"prefetching Airtable table: {table.name}")
+    logger.info(f"indexing fields: {index_fields}")
+    table_index = TableIndex(table, index_fields)
+    pages = table_index.load(**options)
+    logger.info(f"indexed {table_index.record_count} records from {pages} page requests")
+    _table_indexes[_table_index_key(table)] = table_index
+    return table_index
+
+
+def get_table_index(table: Table) -> TableIndex | None:
+    '''
+    returns the prefetched index for table, if there is one
+    '''
+    return _table_indexes.get(_table_index_key(table))
+
+
+def clear_prefetch(table: Table = None):
+    '''
+    forgets the prefetched index for table, or every index if no table is given
+    '''
+    if table is None:
+        _table_indexes.clear()
+    else:
+        _table_indexes.pop(_table_index_key(table), None)
+
+
+def _read_options(fields: list = None, **options: Any) -> dict:
+    '''
+    only asks Airtable for fields, if given
+    '''
+    if fields is not None:
+        options['fields'] = list(fields)
+    return {option: value for option, value in options.items() if value is not None}
+
+
+def _project_record(record: RecordDict, fields: list = None) -> RecordDict:
+    '''
+    trims a record from an index down to fields, like Airtable would have
+    '''
+    if fields is None:
+        return record
+    return {**record, "fields": {field: record['fields'][field]
+                                 for field in fields if field in record['fields']}}
+
+
+def iterate_records(table: Table, fields: list = None, formula: Any = None,
+                    page_size: int = None) -> Iterator[RecordDict]:
+    '''
+    yields every record in table (or every match for formula), one at a time
+    only one page is held in memory, for big scans like building caches and exports
+    '''
+    for page in table.iterate(**_read_options(fields, formula=formula, page_size=page_size)):
+        yield from page
+
+
+def find_pages(query: Any, field: str, table: Table, fields: list = None,
+               page_size: int = None) -> Iterator[list[RecordDict]]:
+    '''
+    generator version of find(), yields the records where field == query a page at a time
+    always reads from Airtable
+    '''
+    logger.debug(f"searching Airtable table {table.name} in field {field} for value {query}")
+    yield from table.iterate(**_read_options(fields, formula=match({field: query}),
+                                             page_size=page_size))
+
+
 def find(query: Any, field: str, table: Table, 
-         single_result: bool = False) -> RecordDict | list:
+         single_result: bool = False, fields: list = None) -> RecordDict | list:
     '''
     queries field in table
     if single result is desired:
@@ -677,12 +1534,27 @@ def find(query: Any, field: str, table: Table,
     --raises error if more than 1 record found
     else:
     --returns list of found records
+
+    fields limits the fields returned for each record, e.g. ["Digital Asset ID"]
+    when only the record id is needed
+
+    if the table was prefetch()ed on field, or is mirrored, the answer comes from memory
+    anything missing from the mirror is double-checked in Airtable
     '''
     logger.info(f"searching Airtable table: {table}")
     logger.info(f"for value: {query}")
     logger.info(f"in field: {field}")
     try:
-        results = table.all(formula=match({field: query}))
+        table_index = get_table_index(table) or mirror_index(table)
+        if table_index and table_index.covers(field):
+            results = [_project_record(record, fields) for record in table_index.lookup(query, field)]
+        else:
+            results = None
+        if results is None or (not results and table_index.all_fields):
+            results = table.all(**_read_options(fields, formula=match({field: query})))
+            if table_index and table_index.all_fields and fields is None:
+                for record in results:
+                    remember_record(table, record)
         if results:
             if single_result and len(results) >1:
                 raise ValueError
@@ -698,6 +1570,105 @@ def find(query: Any, field: str, table: Table,
         raise RuntimeError("there was an error searching Airtable")
 
 
+def find_many(values: list, field: str, table: Table, single_result: bool = False,
+              fields: list = None) -> dict:
+    '''
+    bulk version of find(), e.g. to check whether every DAID in a folder exists
+
+    values in the index/ mirror are answered from memory, like find()
+    the rest are searched for with as many values in each OR(...) formula
+    as fit under the URL limit, so 1,000 values take a handful of requests
+
+    returns {value: [records]}, with an empty list for values that weren't found
+    if single result is desired:
+    --returns {value: record or None}
+    --raises error if any value has more than 1 record
+    '''
+    values = list(dict.fromkeys(values))
+    logger.info(f"searching Airtable table {table} for {len(values)} values in field {field}")
+    results = {value: [] for value in values}
+    values_by_key = {TableIndex._index_key(value): value for value in values}
+    table_index = get_table_index(table) or mirror_index(table)
+    remaining = values
+    if table_index and table_index.covers(field):
+        remaining = []
+        for value in values:
+            results[value] = [_project_record(record, fields) for record in table_index.lookup(value, field)]
+            if not results[value] and table_index.all_fields:
+                remaining.append(value)
+    if remaining:
+        # field has to come back, to tell which value each record matched
+        read_fields = None if fields is None else list(dict.fromkeys([*fields, field]))
+        requests_made = 0
+        for formula in or_formulas([match({field: value}) for value in remaining]):
+            for page in table.iterate(**_read_options(read_fields, formula=formula)):
+                requests_made += 1
+                for record in page:
+                    if table_index and table_index.all_fields and fields is None:
+                        remember_record(table, record)
+                    for key in TableIndex._index_keys(record['fields'].get(field)):
+                        if key in values_by_key:
+                            results[values_by_key[key]].append(_project_record(record, fields))
+        logger.debug(f"searched for {len(remaining)} values in {requests_made} requests")
+    duplicates = [value for value, records in results.items() if len(records) > 1]
+    if duplicates:
+        logger.warning(f"more than one record in {table.name} for: {duplicates}")
+        if single_result:
+            raise RuntimeError(f"too many results for {len(duplicates)} values, expected 1 each")
+    if single_result:
+        return {value: records[0] if records else None for value, records in results.items()}
+    return results
+
+
+def hydrate(atbl_recs: list) -> list:
+    '''
+    fills in the fields of Record()s that are just an id, in place, like fetch() does
+    e.g. linked records, which stay bare ids until something needs their fields
+
+    mirrored tables are read from the local mirror
+    otherwise each table takes one RECORD_ID() OR(...) query per chunk of ids,
+    instead of a GET per record
+    '''
+    recs_by_class = {}
+    for atbl_rec in atbl_recs:
+        if atbl_rec.id and not atbl_rec._fetched:
+            recs_by_class.setdefault(type(atbl_rec), {}).setdefault(atbl_rec.id, []).append(atbl_rec)
+    for record_class, recs_by_id in recs_by_class.items():
+        atbl_tbl = record_class.meta.table
+        records = {}
+        table_index = mirror_index(atbl_tbl)
+        if table_index:
+            records = {record_id: table_index.records_by_id[record_id] for record_id in recs_by_id
+                       if record_id in table_index.records_by_id}
+        remaining = [record_id for record_id in recs_by_id if record_id not in records]
+        for formula in or_formulas([EQ(RECORD_ID(), record_id) for record_id in remaining]):
+            for record in iterate_records(atbl_tbl, formula=formula):
+                records[record['id']] = record
+                if table_index:
+                    remember_record(atbl_tbl, record)
+        missing = [record_id for record_id in recs_by_id if record_id not in records]
+        if missing:
+            raise RuntimeError(f"no records in {atbl_tbl.name} with ids {missing}")
+        logger.debug(f"hydrated {len(recs_by_id)} records from {atbl_tbl.name}, "
+                     f"{len(recs_by_id) - len(remaining)} from the local mirror")
+        for record_id, record in records.items():
+            atbl_rec_remote = record_class.from_record(record, memoize=False)
+            for atbl_rec in recs_by_id[record_id]:
+                atbl_rec._fields = dict(atbl_rec_remote._fields)
+                atbl_rec._changed.clear()
+                atbl_rec._fetched = True
+                atbl_rec.created_time = atbl_rec_remote.created_time
+    return atbl_recs
+
+
+def load_records(record_class: type, record_ids: list) -> list:
+    '''
+    bulk version of Record.from_id(), for many ids at once
+    '''
+    return hydrate([record_class.from_id(record_id, fetch=False, memoize=True)
+                    for record_id in record_ids])
+
+
 def parse_asset_actions(atbl_rec: PhysicalAssetActionRecord) -> list:
     '''
     uh each action in the log gets its own record
@@ -708,21 +1679,124 @@ def parse_asset_actions(atbl_rec: PhysicalAssetActionRecord) -> list:
     atbl_recs = []
     actions = getattr(atbl_rec, 'activity_type')
     physical_asset = getattr(atbl_rec, 'PhysicalAsset')
+    hydrate(physical_asset[:1])
     atbl_rec_par = PhysicalAssetRecord()
     atbl_rec_par.physical_asset_id = physical_asset[0].physical_asset_id
     atbl_rec_par = atbl_rec_par.send()
+    for action in split_actions(actions):
+        atbl_rec_paar = PhysicalAssetActionRecord(
+                activity_type=action,
+                PhysicalAsset=[atbl_rec_par])
+        atbl_recs.append(atbl_rec_paar)
+    return atbl_recs
+
+
+def split_actions(actions: str | None) -> list[str]:
+    '''
+    the Activity Type cell can list several actions, separated by ; or ,
+    an empty cell means an A-D Transfer
+    '''
     if not actions:
-        actions = ['A-D Transfer']
+        return ['A-D Transfer']
     elif ';' in actions:
         actions = actions.split(';')
     elif ',' in actions:
         actions = actions.split(',')
     else:
         actions = [actions]
-    for action in actions:
-        atbl_rec_paar = PhysicalAssetActionRecord(
-                activity_type=action.strip(),
-                PhysicalAsset=[atbl_rec_par])
-        atbl_recs.append(atbl_rec_paar)
-    return atbl_recs
+    return [action.strip() for action in actions if action.strip()]
+
+
+# Airtable caps request URLs at 16,000 characters, and formulas get longer when url-encoded
+MAX_FORMULA_LENGTH = 4000
+
+
+def or_formulas(clauses: list, max_length: int = MAX_FORMULA_LENGTH) -> Iterator[str]:
+    '''
+    joins clauses into as few OR(...) formulas as fit in max_length characters each
+    so one query can stand in for a search per value
+    '''
+    chunk = []
+    length = len('OR()')
+    for clause in clauses:
+        clause = str(clause)
+        if chunk and length + len(clause) + 2 > max_length:
+            yield str(OR(*chunk))
+            chunk = []
+            length = len('OR()')
+        chunk.append(clause)
+        length += len(clause) + 2
+    if chunk:
+        yield str(OR(*chunk))
+
+
+def plan_asset_actions(atbl_recs: list[PhysicalAssetActionRecord]) -> dict:
+    '''
+    sheet-wide version of parse_asset_actions() + send()
+
+    expands every row's actions, one log entry per physical asset and action,
+    then looks up the existing log entries for all of the sheet's physical assets
+    with a few OR(...) queries, instead of one search per action
+
+    returns the writes to make:
+    create -- fields for each new log entry
+    update -- {"id", "fields"} for each existing entry with different values
+    unchanged, failed -- counts
+    '''
+    atbl_tbl = PhysicalAssetActionRecord.meta.table
+    key_field_names = [PhysicalAssetActionRecord.PhysicalAsset.field_name,
+                       PhysicalAssetActionRecord.activity_type.field_name]
+    asset_field_name, activity_field_name = key_field_names
+    plan = {"create": [], "update": [], "unchanged": 0, "failed": 0}
+    # the same physical asset is usually on many rows, so each one is only handled once
+    physical_assets = {}
+    local_actions = {}
+    for atbl_rec in atbl_recs:
+        if not atbl_rec.PhysicalAsset:
+            logger.error("no Physical Asset ID in row, skipping")
+            plan['failed'] += 1
+            continue
+        atbl_rec_par = atbl_rec.PhysicalAsset[0]
+        if not atbl_rec_par.id:
+            atbl_rec_par = atbl_rec_par.send()
+        atbl_rec_par = physical_assets.setdefault(atbl_rec_par.id, atbl_rec_par)
+        for action in split_actions(atbl_rec.activity_type):
+            atbl_rec_paar = PhysicalAssetActionRecord(activity_type=action,
+                                                      PhysicalAsset=[atbl_rec_par])
+            fields = atbl_rec_paar.to_record(only_writable=True)['fields']
+            # rows for the same asset and action are merged, later rows win
+            local_actions.setdefault((atbl_rec_par.id, action), {}).update(fields)
+    if not local_actions:
+        return plan
+    # the physical assets are bare links, their IDs are needed for the query
+    hydrate([atbl_rec_par for atbl_rec_par in physical_assets.values()
+             if not atbl_rec_par.physical_asset_id])
+    fetch_fields = sorted({field for fields in local_actions.values() for field in fields})
+    remote_actions = {}
+    clauses = [match({asset_field_name: atbl_rec_par.physical_asset_id})
+               for atbl_rec_par in physical_assets.values()]
+    for formula in or_formulas(clauses):
+        for record in iterate_records(atbl_tbl, fields=fetch_fields, formula=formula):
+            for asset_record_id in record['fields'].get(asset_field_name, []):
+                key = (asset_record_id, record['fields'].get(activity_field_name))
+                remote_actions.setdefault(key, []).append(record)
+    for key, fields in local_actions.items():
+        records = remote_actions.get(key, [])
+        if len(records) > 1:
+            logger.error(f"too many results for {key[1]} on {key[0]}, "
+                         f"duplicate records in {atbl_tbl.name}: {[record['id'] for record in records]}")
+            plan['failed'] += 1
+        elif records:
+            changed = {field: value for field, value in fields.items()
+                       if field not in key_field_names and records[0]['fields'].get(field) != value}
+            if changed:
+                plan['update'].append({"id": records[0]['id'], "fields": changed})
+            else:
+                plan['unchanged'] += 1
+        else:
+            plan['create'].append(fields)
+    logger.debug(f"{len(local_actions)} actions on {len(physical_assets)} physical assets: "
+                 f"{len(plan['create'])} new, {len(plan['update'])} changed, "
+                 f"{plan['unchanged']} unchanged, {plan['failed']} failed")
+    return plan
 
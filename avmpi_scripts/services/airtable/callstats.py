@@ -0,0 +1,137 @@
+'''
+per-run record of every Airtable request:
+table, operation, status, bytes and latency
+
+the GovernedSession records each request here,
+and the scripts print a summary (and optionally write it as JSON) at exit
+'''
+import json
+import time
+import logging
+import pathlib
+import threading
+import urllib.parse
+
+logger = logging.getLogger('main_logger')
+
+
+def describe_request(method: str, url: str, body: dict = None) -> tuple[str, str]:
+    '''
+    works out the table and operation from a request to the Airtable API
+    e.g. GET .../v0/appXXX/QC%20Log -> ('QC Log', 'list')
+    '''
+    parts = [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(url).path.split('/') if part]
+    method = method.upper()
+    if len(parts) >= 2 and parts[1] == 'meta':
+        return 'meta', 'schema' if parts[-1] == 'tables' else parts[-1]
+    if len(parts) < 3:
+        return 'other', method.lower()
+    table_name = parts[2]
+    if len(parts) == 3:
+        if method == 'GET':
+            return table_name, 'list'
+        if method == 'POST':
+            return table_name, 'create'
+        if method in ('PATCH', 'PUT'):
+            if body and 'performUpsert' in body:
+                return table_name, 'upsert'
+            return table_name, 'update'
+        if method == 'DELETE':
+            return table_name, 'delete'
+    elif parts[3] == 'listRecords':
+        return table_name, 'list'
+    elif method == 'GET':
+        return table_name, 'get'
+    elif method in ('PATCH', 'PUT'):
+        return table_name, 'update'
+    elif method == 'DELETE':
+        return table_name, 'delete'
+    return table_name, method.lower()
+
+
+def percentile(values: list, pct: float) -> float:
+    '''
+    nearest-rank percentile of an already sorted list
+    '''
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+class CallStats:
+    '''
+    thread-safe list of every Airtable request made this run
+    '''
+
+    def __init__(self):
+        self.calls = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, table_name: str, operation: str, status: int | None,
+               response_bytes: int, seconds: float, waited: float = 0.0):
+        '''
+        status is None when the request didn't get a response, e.g. a timeout
+        waited is time spent waiting on the rate governor before sending
+        '''
+        with self._lock:
+            self.calls.append({"table": table_name, "operation": operation, "status": status,
+                               "bytes": response_bytes, "seconds": seconds, "waited": waited})
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.started = time.time()
+
+    def summary(self) -> list[dict]:
+        '''
+        one row per table and operation, with call counts and latencies in ms
+        '''
+        with self._lock:
+            calls = list(self.calls)
+        groups = {}
+        for call in calls:
+            groups.setdefault((call['table'], call['operation']), []).append(call)
+        rows = []
+        for (table_name, operation), group in sorted(groups.items()):
+            latencies = sorted(call['seconds'] * 1000 for call in group)
+            rows.append({"table": table_name, "operation": operation,
+                         "calls": len(group),
+                         "errors": sum(1 for call in group if not call['status'] or call['status'] >= 400),
+                         "bytes": sum(call['bytes'] for call in group),
+                         "waited_ms": round(sum(call['waited'] for call in group) * 1000, 1),
+                         "p50_ms": round(percentile(latencies, 50), 1),
+                         "p95_ms": round(percentile(latencies, 95), 1),
+                         "p99_ms": round(percentile(latencies, 99), 1)})
+        return rows
+
+    def format_summary(self) -> str:
+        '''
+        the summary as a table to print
+        '''
+        rows = self.summary()
+        total_seconds = sum(call['seconds'] for call in self.calls)
+        total_waited = sum(call['waited'] for call in self.calls)
+        lines = [f"Airtable calls this run: {len(self.calls)}, {total_seconds:.1f} s in requests, "
+                 f"{total_waited:.1f} s waiting on the rate limit"]
+        if not rows:
+            return lines[0]
+        width = max(len('table'), *(len(row['table']) for row in rows))
+        lines.append(f"{'table':<{width}}  {'operation':<9}  {'calls':>5}  {'errors':>6}  "
+                     f"{'bytes':>9}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}")
+        for row in rows:
+            lines.append(f"{row['table']:<{width}}  {row['operation']:<9}  {row['calls']:>5}  "
+                         f"{row['errors']:>6}  {row['bytes']:>9}  {row['p50_ms']:>8}  "
+                         f"{row['p95_ms']:>8}  {row['p99_ms']:>8}")
+        return '\n'.join(lines)
+
+    def write_json(self, filepath: pathlib.Path):
+        '''
+        writes the summary, and every call, to a JSON file
+        '''
+        with self._lock:
+            calls = list(self.calls)
+        with open(filepath, 'w') as json_file:
+            json.dump({"started": self.started, "finished": time.time(),
+                       "summary": self.summary(), "calls": calls}, json_file, indent=4)
@@ -0,0 +1,188 @@
+'''
+local mirror of Airtable tables
+
+keeps a copy of every record in a SQLite file, so lookups don't need the network
+the first sync of a table pulls everything,
+after that only records modified since the last sync are fetched
+'''
+import json
+import time
+import sqlite3
+import logging
+import pathlib
+import threading
+from datetime import datetime, timezone
+from typing import Iterator
+from pyairtable import Table
+from pyairtable.api.types import RecordDict
+from pyairtable.formulas import IS_AFTER, LAST_MODIFIED_TIME
+
+logger = logging.getLogger('main_logger')
+
+
+class Mirror:
+    '''
+    SQLite copy of Airtable tables, keyed on base id and table name
+
+    deleted records only show up in a full sync,
+    so a full pull is done again every full_sync_hours
+    the delta window overlaps the last sync by overlap_seconds,
+    to cover clock differences between us and Airtable
+    one Mirror can be shared between threads
+    '''
+
+    def __init__(self, filepath: pathlib.Path, full_sync_hours: float = 24,
+                 overlap_seconds: float = 300):
+        self.filepath = pathlib.Path(filepath)
+        self.full_sync_hours = full_sync_hours
+        self.overlap_seconds = overlap_seconds
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.filepath, timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS records ("
+                           "base_id TEXT NOT NULL, "
+                           "table_name TEXT NOT NULL, "
+                           "record_id TEXT NOT NULL, "
+                           "created_time TEXT, "
+                           "fields TEXT NOT NULL, "
+                           "synced REAL, "
+                           "PRIMARY KEY (base_id, table_name, record_id))")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(records)")]
+        if 'synced' not in columns:
+            self._conn.execute("ALTER TABLE records ADD COLUMN synced REAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS syncs ("
+                           "base_id TEXT NOT NULL, "
+                           "table_name TEXT NOT NULL, "
+                           "last_sync REAL NOT NULL, "
+                           "last_full_sync REAL NOT NULL, "
+                           "PRIMARY KEY (base_id, table_name))")
+
+    @staticmethod
+    def _table_key(table: Table) -> tuple[str, str]:
+        return table.base.id, table.name
+
+    def last_sync(self, table: Table) -> tuple[float, float] | None:
+        '''
+        returns when table was last synced, and last fully synced
+        or None if it's never been synced
+        '''
+        with self._lock:
+            row = self._conn.execute("SELECT last_sync, last_full_sync FROM syncs "
+                                     "WHERE base_id = ? AND table_name = ?",
+                                     self._table_key(table)).fetchone()
+        return tuple(row) if row else None
+
+    def _write(self, table: Table, records: list, synced: float):
+        base_id, table_name = self._table_key(table)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO records "
+                                       "(base_id, table_name, record_id, created_time, fields, synced) "
+                                       "VALUES (?, ?, ?, ?, ?, ?)",
+                                       [(base_id, table_name, record['id'], record.get('createdTime'),
+                                         json.dumps(record['fields']), synced) for record in records])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _finish_sync(self, table: Table, started: float, full: bool):
+        '''
+        moves the watermark up
+        after a full pull, anything that wasn't in it has been deleted from Airtable
+        '''
+        base_id, table_name = self._table_key(table)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if full:
+                    self._conn.execute("DELETE FROM records WHERE base_id = ? AND table_name = ? "
+                                       "AND (synced IS NULL OR synced < ?)",
+                                       (base_id, table_name, started))
+                    last_full_sync = started
+                else:
+                    last_full_sync = self.last_sync(table)[1]
+                self._conn.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)",
+                                   (base_id, table_name, started, last_full_sync))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def sync(self, table: Table, full: bool = False) -> int:
+        '''
+        brings the mirror of table up to date
+        full pull if asked for, if the table's never been synced, or if the last one is too old
+        otherwise just the records modified since the last sync
+        each page is written as it comes in, so memory use doesn't grow with the table
+        an interrupted sync leaves the watermark where it was, and is done again next time
+        returns the number of page requests it took
+        '''
+        started = time.time()
+        last_sync = self.last_sync(table)
+        if not full and (not last_sync or started - last_sync[1] > self.full_sync_hours * 3600):
+            full = True
+        if full:
+            logger.info(f"pulling every record in {table.name} to the local mirror...")
+            options = {}
+        else:
+            since = datetime.fromtimestamp(last_sync[0] - self.overlap_seconds, tz=timezone.utc)
+            logger.debug(f"pulling records in {table.name} modified since {since.isoformat()}")
+            options = {"formula": IS_AFTER(LAST_MODIFIED_TIME(), since)}
+        pages = 0
+        count = 0
+        for page in table.iterate(**options):
+            pages += 1
+            count += len(page)
+            self._write(table, page, started)
+        self._finish_sync(table, started, full)
+        logger.debug(f"mirrored {count} records from {table.name} in {pages} page requests")
+        return pages
+
+    def iterate(self, table: Table) -> Iterator[RecordDict]:
+        '''
+        yields every mirrored record in table, as Airtable would return it
+        '''
+        with self._lock:
+            cursor = self._conn.execute("SELECT record_id, created_time, fields FROM records "
+                                        "WHERE base_id = ? AND table_name = ?",
+                                        self._table_key(table))
+        while True:
+            # a page at a time, so other threads can use the connection in between
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield {"id": row[0], "createdTime": row[1], "fields": json.loads(row[2])}
+
+    def records(self, table: Table) -> list[RecordDict]:
+        '''
+        every mirrored record in table, as Airtable would return it
+        '''
+        return list(self.iterate(table))
+
+    def put(self, table: Table, record: RecordDict):
+        '''
+        writes a record we just created/ updated, so the mirror doesn't wait for the next sync
+        '''
+        self._write(table, [record], time.time())
+
+    def clear(self, table: Table = None):
+        '''
+        forgets table, or everything, so the next sync is a full pull
+        '''
+        with self._lock:
+            if table is None:
+                self._conn.execute("DELETE FROM records")
+                self._conn.execute("DELETE FROM syncs")
+            else:
+                self._conn.execute("DELETE FROM records WHERE base_id = ? AND table_name = ?",
+                                   self._table_key(table))
+                self._conn.execute("DELETE FROM syncs WHERE base_id = ? AND table_name = ?",
+                                   self._table_key(table))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
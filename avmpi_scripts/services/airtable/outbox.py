@@ -0,0 +1,375 @@
+'''
+durable outbox for Airtable writes
+
+every mutation is written to a local SQLite file before it's sent
+so an interrupted upload can pick up where it left off
+'''
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import pathlib
+import hashlib
+import requests
+import threading
+from typing import Any, Callable
+from pyairtable import Api, Table
+
+logger = logging.getLogger('main_logger')
+
+AMBIGUOUS_CREATE_ERROR = "they may already be in Airtable, check before resending them with --retry_failed"
+
+
+def make_idempotency_key(*parts: Any) -> str:
+    '''
+    stable key for what a mutation is for, from whatever identifies it
+    e.g. input file name, record type and row number
+    '''
+    key_str = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def make_payload_hash(payload: Any) -> str:
+    '''
+    hash of what a mutation says, e.g. its payload, or the row it was converted from
+    '''
+    return make_idempotency_key(payload)
+
+
+class Outbox:
+    '''
+    SQLite-backed queue of Airtable mutations
+
+    each entry has a record type (the table it goes to), an operation
+    (upsert, create or update), its payload, an idempotency key and a status
+    status goes pending -> sending -> sent, or -> failed when Airtable rejects it
+    entries are claimed (sending) by one drain() at a time,
+    so scripts sharing an outbox file never send the same entry twice
+
+    there's one entry per idempotency key, e.g. per spreadsheet row
+    it holds a hash of the payload last queued for that key,
+    so an unchanged row isn't sent again, and a changed one replaces its entry
+    one Outbox can be shared between threads
+    '''
+
+    def __init__(self, filepath: pathlib.Path):
+        self.filepath = pathlib.Path(filepath)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.filepath, timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "record_type TEXT NOT NULL, "
+                           "operation TEXT NOT NULL, "
+                           "payload TEXT NOT NULL, "
+                           "key_fields TEXT, "
+                           "idempotency_key TEXT UNIQUE NOT NULL, "
+                           "status TEXT NOT NULL DEFAULT 'pending', "
+                           "attempts INTEGER NOT NULL DEFAULT 0, "
+                           "last_error TEXT, "
+                           "record_id TEXT, "
+                           "updated REAL, "
+                           "payload_hash TEXT, "
+                           "owner TEXT)")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(entries)")]
+        # outbox from an earlier version
+        for column in ('payload_hash', 'owner'):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE entries ADD COLUMN {column} TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_status ON entries (status)")
+
+    def enqueue(self, record_type: str, operation: str, payload: dict,
+                idempotency_key: str, key_fields: list = None, payload_hash: str = None) -> bool:
+        '''
+        adds a mutation to the outbox, as the entry for idempotency_key
+        payload_hash defaults to a hash of the payload
+
+        returns False, and changes nothing, if the entry is already there with the same hash
+        whether it's pending, sent or failed (see retry_failed())
+        an entry with a different hash is replaced, and goes back to pending
+        '''
+        if operation not in ('upsert', 'create', 'update'):
+            raise ValueError(f"unknown outbox operation {operation}")
+        payload_hash = payload_hash or make_payload_hash(payload)
+        values = (record_type, operation, json.dumps(payload),
+                  json.dumps(key_fields) if key_fields else None, time.time(), payload_hash)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT payload_hash FROM entries WHERE idempotency_key = ?",
+                                         (idempotency_key,)).fetchone()
+                if row and row[0] == payload_hash:
+                    return False
+                if row:
+                    self._conn.execute("UPDATE entries SET record_type = ?, operation = ?, payload = ?, "
+                                       "key_fields = ?, updated = ?, payload_hash = ?, "
+                                       "status = 'pending', attempts = 0, last_error = NULL, owner = NULL "
+                                       "WHERE idempotency_key = ?", (*values, idempotency_key))
+                else:
+                    self._conn.execute("INSERT INTO entries (record_type, operation, payload, key_fields, "
+                                       "updated, payload_hash, idempotency_key) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?)", (*values, idempotency_key))
+                return True
+            finally:
+                self._conn.execute("COMMIT")
+
+    def unchanged(self, idempotency_key: str, payload_hash: str) -> bool:
+        '''
+        whether the entry for idempotency_key was queued with this hash
+        e.g. to skip converting a row that's the same as when it was last sent
+        '''
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM entries WHERE idempotency_key = ? AND payload_hash = ?",
+                                     (idempotency_key, payload_hash)).fetchone()
+        return row is not None
+
+    def status(self, idempotency_key: str) -> str | None:
+        '''
+        returns pending/ sent/ failed, or None if the key isn't in the outbox
+        '''
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM entries WHERE idempotency_key = ?",
+                                     (idempotency_key,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self) -> dict:
+        '''
+        number of entries in each status
+        '''
+        counts = {"pending": 0, "sent": 0, "failed": 0}
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM entries GROUP BY status").fetchall()
+        for status, count in rows:
+            counts[status] = count
+        return counts
+
+    def pending(self) -> list[dict]:
+        '''
+        every entry that still needs sending, oldest first
+        '''
+        with self._lock:
+            rows = self._conn.execute("SELECT id, record_type, operation, payload, key_fields, attempts "
+                                      "FROM entries WHERE status = 'pending' ORDER BY id").fetchall()
+        return [{"id": row[0], "record_type": row[1], "operation": row[2],
+                 "payload": json.loads(row[3]),
+                 "key_fields": json.loads(row[4]) if row[4] else None,
+                 "attempts": row[5]} for row in rows]
+
+    def retry_failed(self) -> int:
+        '''
+        puts failed entries back in the queue, e.g. after fixing a select option in Airtable
+        '''
+        with self._lock:
+            cursor = self._conn.execute("UPDATE entries SET status = 'pending', attempts = 0 "
+                                        "WHERE status = 'failed'")
+            return cursor.rowcount
+
+    def _claim(self, owner: str, limit: int) -> list[dict]:
+        '''
+        marks up to limit pending entries as being sent by owner, in one statement
+        so two processes draining the same outbox never get the same entry
+        returns the claimed entries, oldest first
+        '''
+        with self._lock:
+            self._conn.execute("UPDATE entries SET status = 'sending', owner = ?, updated = ? "
+                               "WHERE id IN (SELECT id FROM entries WHERE status = 'pending' "
+                               "ORDER BY id LIMIT ?)", (owner, time.time(), limit))
+            rows = self._conn.execute("SELECT id, record_type, operation, payload, key_fields, attempts "
+                                      "FROM entries WHERE status = 'sending' AND owner = ? ORDER BY id",
+                                      (owner,)).fetchall()
+        return [{"id": row[0], "record_type": row[1], "operation": row[2],
+                 "payload": json.loads(row[3]),
+                 "key_fields": json.loads(row[4]) if row[4] else None,
+                 "attempts": row[5]} for row in rows]
+
+    def _release(self, owner: str):
+        '''
+        puts entries owner claimed but didn't send back in the queue
+        '''
+        with self._lock:
+            self._conn.execute("UPDATE entries SET status = 'pending', owner = NULL "
+                               "WHERE status = 'sending' AND owner = ?", (owner,))
+
+    def _recover_stale(self, stale_seconds: float) -> int:
+        '''
+        a drain() that was killed mid-send leaves its claimed entries as sending
+        upserts and updates can safely be sent again
+        creates might already be in Airtable, so they're marked failed to be checked by hand
+        returns the number of creates marked failed
+        '''
+        stale = time.time() - stale_seconds
+        with self._lock:
+            self._conn.execute("UPDATE entries SET status = 'pending', owner = NULL "
+                               "WHERE status = 'sending' AND operation != 'create' AND updated < ?",
+                               (stale,))
+            cursor = self._conn.execute("UPDATE entries SET status = 'failed', owner = NULL, last_error = ? "
+                                        "WHERE status = 'sending' AND operation = 'create' AND updated < ?",
+                                        (AMBIGUOUS_CREATE_ERROR, stale))
+        if cursor.rowcount:
+            logger.error(f"{cursor.rowcount} creates were interrupted while being sent, "
+                         f"{AMBIGUOUS_CREATE_ERROR}")
+        return cursor.rowcount
+
+    def _mark(self, entries: list, status: str, owner: str, error: str = None, record_ids: list = None):
+        '''
+        only changes entries owner still has claimed
+        i.e. not ones replaced by enqueue() while they were being sent
+        '''
+        record_ids = record_ids or [None] * len(entries)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for entry, record_id in zip(entries, record_ids):
+                self._conn.execute("UPDATE entries SET status = ?, attempts = attempts + 1, owner = NULL, "
+                                   "last_error = ?, record_id = COALESCE(?, record_id), updated = ? "
+                                   "WHERE id = ? AND status = 'sending' AND owner = ?",
+                                   (status, error, record_id, time.time(), entry['id'], owner))
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _chunk_entries(entries: list, batch_size: int) -> list[list]:
+        '''
+        groups entries that can go in the same request:
+        same table, operation and key fields, at most batch_size,
+        and for upserts no two entries matching on the same key
+        '''
+        chunks = []
+        chunk = []
+        chunk_group = None
+        chunk_keys = set()
+        for entry in entries:
+            group = (entry['record_type'], entry['operation'], json.dumps(entry['key_fields']))
+            merge_key = None
+            if entry['operation'] == 'upsert':
+                merge_key = json.dumps([entry['payload'].get(field) for field in entry['key_fields']])
+            if chunk and (group != chunk_group or len(chunk) >= batch_size or merge_key in chunk_keys):
+                chunks.append(chunk)
+                chunk = []
+                chunk_keys = set()
+            chunk.append(entry)
+            chunk_group = group
+            if merge_key:
+                chunk_keys.add(merge_key)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def _send_chunk(atbl_tbl: Table, chunk: list) -> tuple[list[str], int, int]:
+        '''
+        sends one chunk in one request
+        returns the record ids in order, and how many were created/ updated
+        '''
+        operation = chunk[0]['operation']
+        if operation == 'upsert':
+            response = atbl_tbl.batch_upsert([{"fields": entry['payload']} for entry in chunk],
+                                             key_fields=chunk[0]['key_fields'])
+            return ([record['id'] for record in response['records']],
+                    len(response['createdRecords']), len(response['updatedRecords']))
+        elif operation == 'create':
+            response = atbl_tbl.batch_create([entry['payload'] for entry in chunk])
+            return [record['id'] for record in response], len(response), 0
+        else:
+            response = atbl_tbl.batch_update([entry['payload'] for entry in chunk])
+            return [record['id'] for record in response], 0, len(response)
+
+    def drain(self, get_table: Callable[[str], Table],
+              batch_size: int = Api.MAX_RECORDS_PER_REQUEST,
+              max_attempts: int = 5, backoff_seconds: float = 2.0,
+              claim_size: int = 100, stale_seconds: float = 900) -> dict:
+        '''
+        replays every pending entry, in batches
+        claim_size entries at a time are claimed, so other processes draining
+        the same outbox send different entries
+
+        network problems, rate limiting (429) and server errors (5xx) are retried with backoff
+        if they don't clear up, the entries stay pending for the next run
+        except creates that timed out waiting for Airtable's answer,
+        which may have been created, so they're marked failed instead of being sent twice
+        Airtable rejecting a batch (any other 4xx) sends its entries one at a time,
+        so only the bad ones get marked failed
+
+        returns counts of created/ updated/ failed/ still pending entries,
+        and the number of requests made
+        '''
+        result = {"created": 0, "updated": 0, "failed": 0, "pending": 0, "calls": 0}
+        result['failed'] += self._recover_stale(stale_seconds)
+        pending = self.counts()['pending']
+        if not pending:
+            return result
+        logger.info(f"sending {pending} pending entries from the outbox...")
+        owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        try:
+            while True:
+                entries = self._claim(owner, claim_size)
+                if not entries:
+                    break
+                if not self._send_chunks(self._chunk_entries(entries, batch_size), get_table, owner,
+                                         result, max_attempts, backoff_seconds):
+                    break
+        finally:
+            self._release(owner)
+        result['pending'] = self.counts()['pending']
+        logger.info(f"outbox: {result['created']} created, {result['updated']} updated, "
+                    f"{result['failed']} failed, {result['pending']} pending, "
+                    f"in {result['calls']} Airtable calls")
+        return result
+
+    def _send_chunks(self, chunks: list, get_table: Callable[[str], Table], owner: str,
+                     result: dict, max_attempts: int, backoff_seconds: float) -> bool:
+        '''
+        sends claimed chunks, adding to result
+        returns False if Airtable couldn't be reached, and the rest should wait for next time
+        '''
+        while chunks:
+            chunk = chunks.pop(0)
+            atbl_tbl = get_table(chunk[0]['record_type'])
+            attempt = 0
+            while True:
+                attempt += 1
+                result['calls'] += 1
+                try:
+                    record_ids, created, updated = self._send_chunk(atbl_tbl, chunk)
+                except requests.exceptions.HTTPError as exc:
+                    status_code = exc.response.status_code if exc.response is not None else None
+                    # still over the rate limit after GovernedSession's own retries, try again later
+                    if status_code and 400 <= status_code < 500 and status_code != 429:
+                        if len(chunk) > 1:
+                            # find the bad entry by sending them one at a time
+                            chunks[0:0] = [[entry] for entry in chunk]
+                        else:
+                            logger.error(f"Airtable rejected outbox entry for {chunk[0]['record_type']}")
+                            logger.error(exc)
+                            self._mark(chunk, 'failed', owner, error=str(exc))
+                            result['failed'] += 1
+                        break
+                    error = exc
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+                    timed_out = isinstance(exc, requests.exceptions.ReadTimeout)
+                    if timed_out and chunk[0]['operation'] == 'create':
+                        # the request got there, so the records may have been created
+                        logger.error(f"no answer from Airtable after sending {len(chunk)} new "
+                                     f"{chunk[0]['record_type']} records, {AMBIGUOUS_CREATE_ERROR}")
+                        self._mark(chunk, 'failed', owner, error=AMBIGUOUS_CREATE_ERROR)
+                        result['failed'] += len(chunk)
+                        break
+                    error = exc
+                else:
+                    self._mark(chunk, 'sent', owner, record_ids=record_ids)
+                    logger.debug(f"batch sent to {chunk[0]['record_type']}: "
+                                 f"{created} created, {updated} updated")
+                    result['created'] += created
+                    result['updated'] += updated
+                    break
+                if attempt >= max_attempts:
+                    logger.error("could not send to Airtable, leaving the rest of the outbox for next time")
+                    logger.error(error)
+                    return False
+                logger.warning(f"problem sending to Airtable, retrying: {error}")
+                time.sleep(backoff_seconds * 2 ** (attempt - 1))
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
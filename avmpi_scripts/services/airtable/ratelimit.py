@@ -0,0 +1,156 @@
+'''
+keeps every AVMPI script running on this machine
+under Airtable's limit of 5 requests per second per base
+'''
+import re
+import time
+import random
+import sqlite3
+import logging
+import pathlib
+import threading
+import requests
+from typing import Any, Callable
+from . import callstats
+
+logger = logging.getLogger('main_logger')
+
+
+class RateGovernor:
+    '''
+    token bucket shared by every process on the host
+
+    the bucket lives in a small SQLite file, so excel2airtable, validate_media,
+    embed_md and add_equip_aal all draw from the same tokens
+    SQLite does the cross-process locking for us, on Windows too
+    '''
+
+    def __init__(self, state_filepath: pathlib.Path, requests_per_second: float = 5.0,
+                 burst: int = 5):
+        self.state_filepath = pathlib.Path(state_filepath)
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.state_filepath, timeout=30,
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                           "key TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)")
+
+    def _update(self, key: str, take: bool, block_seconds: float = 0) -> float:
+        '''
+        refills the bucket for key, and optionally takes a token or blocks it
+        returns how long the caller needs to wait, 0 if a token was taken
+        '''
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute("SELECT tokens, updated, blocked_until FROM buckets "
+                                         "WHERE key = ?", (key,)).fetchone()
+                if row:
+                    tokens, updated, blocked_until = row
+                    tokens = min(self.burst, tokens + (now - updated) * self.requests_per_second)
+                else:
+                    tokens, blocked_until = self.burst, 0
+                if block_seconds:
+                    blocked_until = max(blocked_until, now + block_seconds)
+                if now < blocked_until:
+                    wait = blocked_until - now
+                elif tokens >= 1:
+                    wait = 0.0
+                    if take:
+                        tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.requests_per_second
+                self._conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                                   (key, tokens, now, blocked_until))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def acquire(self, key: str = 'default') -> float:
+        '''
+        blocks until a request is allowed
+        returns how long we waited
+        '''
+        waited = 0.0
+        while True:
+            wait = self._update(key, take=True)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def wait_time(self, key: str = 'default') -> float:
+        '''
+        how long the next request would have to wait right now
+        '''
+        return self._update(key, take=False)
+
+    def block(self, seconds: float, key: str = 'default'):
+        '''
+        after a 429, nobody on this host sends anything for a while
+        '''
+        self._update(key, take=False, block_seconds=seconds)
+
+    def close(self):
+        self._conn.close()
+
+
+def get_bucket_key(url: str) -> str:
+    '''
+    the limit is per base, so the bucket is keyed on the base id in the URL
+    '''
+    result = re.search(r'app[A-Za-z0-9]{14}', url)
+    if result:
+        return result.group(0)
+    return 'default'
+
+
+class GovernedSession(requests.Session):
+    '''
+    requests.Session that takes a token from the governor before every request
+    and backs off with jitter when Airtable still answers 429
+    every attempt is recorded in the CallStats from get_call_stats, if given
+    '''
+
+    def __init__(self, get_governor: Callable[[], RateGovernor],
+                 max_retries: int = 5, backoff_seconds: float = 1.0,
+                 max_backoff_seconds: float = 30.0,
+                 get_call_stats: Callable[[], callstats.CallStats] = None):
+        super().__init__()
+        self.get_governor = get_governor
+        self.get_call_stats = get_call_stats
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    def request(self, method: str, url: str, *args: Any, **kwargs: Any) -> requests.Response:
+        governor = self.get_governor()
+        key = get_bucket_key(url)
+        call_stats = self.get_call_stats() if self.get_call_stats else None
+        if call_stats:
+            table_name, operation = callstats.describe_request(method, url, kwargs.get('json'))
+        for attempt in range(self.max_retries + 1):
+            waited = governor.acquire(key)
+            started = time.perf_counter()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.exceptions.RequestException:
+                if call_stats:
+                    call_stats.record(table_name, operation, None, 0,
+                                      time.perf_counter() - started, waited)
+                raise
+            if call_stats:
+                call_stats.record(table_name, operation, response.status_code, len(response.content),
+                                  time.perf_counter() - started, waited)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            # exponential backoff, with jitter so processes don't all retry at once
+            backoff = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)
+            backoff = backoff * random.uniform(0.5, 1.5)
+            logger.warning(f"Airtable rate limit hit, backing off for {backoff:.1f} seconds")
+            governor.block(backoff, key)
+        return response
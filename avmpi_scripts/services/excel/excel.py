@@ -1,12 +1,28 @@
 '''
 handles all things Excel / xlsx for AVMPI
 '''
+import os
+import re
+import csv
+import time
+import json
+import pickle
+import zipfile
+import hashlib
 import logging
 import pathlib
-import json
 import openpyxl
 from pprint import pformat
-from openpyxl.utils import get_column_letter
+from datetime import date, datetime, time as datetime_time, timedelta
+from typing import Any, Callable, Iterator, NamedTuple
+from collections.abc import Mapping
+from xml.etree import ElementTree
+from openpyxl.utils import get_column_letter, column_index_from_string
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    # only needed for Parquet manifests
+    pq = None
 
 Workbook = openpyxl.workbook.workbook.Workbook
 Worksheet = openpyxl.worksheet.worksheet.Worksheet
@@ -25,6 +41,20 @@ def config() -> dict:
     return excel_conf
 
 
+def get_workbook_cache_dir() -> pathlib.Path:
+    '''
+    returns the directory where parsed workbooks are cached
+    set in excel_config.json workbook_cache.dir, defaults to ~/.avmpi_scripts/workbooks
+    '''
+    cache_dir = config().get('workbook_cache', {}).get('dir')
+    if cache_dir:
+        cache_dirpath = pathlib.Path(cache_dir)
+    else:
+        cache_dirpath = pathlib.Path.home() / '.avmpi_scripts' / 'workbooks'
+    cache_dirpath.mkdir(parents=True, exist_ok=True)
+    return cache_dirpath
+
+
 def load_field_mappings() -> dict:
     '''
     loads field mappings from config
@@ -36,57 +66,502 @@ def load_field_mappings() -> dict:
     return field_mapping
 
 
-def get_workbook_type(workbook: Workbook) -> str | None:
+WORKBOOK_TYPES = ('Unit-AssetsMetadata', 'Vendor-AssetsMetadata', 'Unit-BWF')
+
+
+def read_sheet_names(filepath: pathlib.Path) -> list[str]:
+    '''
+    returns the names of the sheets in an xlsx, in order
+    straight from the workbook part in the zip, without openpyxl or reading any cells
+    '''
+    try:
+        with zipfile.ZipFile(filepath) as xlsx_zip:
+            # the package relationships say where the workbook part is, it's nearly always xl/workbook.xml
+            workbook_part = 'xl/workbook.xml'
+            try:
+                rels = ElementTree.fromstring(xlsx_zip.read('_rels/.rels'))
+            except KeyError:
+                rels = []
+            for rel in rels:
+                if rel.get('Type', '').endswith('/officeDocument'):
+                    workbook_part = rel.get('Target').lstrip('/')
+                    break
+            sheet_names = []
+            with xlsx_zip.open(workbook_part) as workbook_xml:
+                for _, element in ElementTree.iterparse(workbook_xml):
+                    if element.tag.rsplit('}', 1)[-1] == 'sheet':
+                        sheet_names.append(element.get('name'))
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as exc:
+        raise RuntimeError(f"{filepath} is not an xlsx spreadsheet: {exc}")
+    return sheet_names
+
+
+def get_workbook_type(workbook: Workbook | list[str]) -> str | None:
     '''
     looks through the sheets in teh workbook to determine if this is
     Unit metadata or Vendor metadata
+    workbook can be an opened Workbook, or its sheet names from read_sheet_names()
     '''
     conf = config()
-    unit_sheetnames = list(conf['Unit-AssetsMetadata'].keys())
-    vendor_sheetnames = list(conf['Vendor-AssetsMetadata'].keys())
-    bwf_sheetnames = list(conf['Unit-BWF'].keys())
-    workbook_sheetnames = [sheet for sheet in workbook.sheetnames]
-    if unit_sheetnames == workbook_sheetnames:
-        return 'Unit-AssetsMetadata'
-    elif vendor_sheetnames == workbook_sheetnames:
-        return 'Vendor-AssetsMetadata'
-    elif bwf_sheetnames == workbook_sheetnames:
-        return 'Unit-BWF'
-    else:
-        return None
+    workbook_sheetnames = list(workbook.sheetnames if isinstance(workbook, Workbook) else workbook)
+    for workbook_type in WORKBOOK_TYPES:
+        if list(conf[workbook_type].keys()) == workbook_sheetnames:
+            return workbook_type
+    return None
 
 
-def load_all_worksheets(filepath: pathlib.Path) -> dict:
+def sniff_workbook_type(filepath: pathlib.Path) -> str | None:
     '''
-    loads all worksheets from xlsx at filepath into dictionary
-    where each key is the worksheet name
-    and each value is a list of rows, which themselves are dictionaries
-    of key: value paires where the key is the column letter and value is cell value
+    the workbook type of the xlsx at filepath, from its sheet names alone
+    quick enough to check a whole folder of spreadsheets
     '''
-    logger.debug(f"loading Excel spreadsheet from {filepath}...")
-    workbook = openpyxl.load_workbook(filepath)
-    workbook_type = get_workbook_type(workbook)
+    return get_workbook_type(read_sheet_names(filepath))
+
+
+def require_workbook_type(filepath: pathlib.Path, workbook_types: tuple = WORKBOOK_TYPES) -> str:
+    '''
+    returns the workbook type of the xlsx at filepath,
+    raises RuntimeError if it isn't one of workbook_types, before any cells are read
+    '''
+    workbook_type = sniff_workbook_type(filepath)
     if not workbook_type:
-        raise RuntimeError("could not identify if workbook is Vendor or Unit type")
+        raise RuntimeError(f"could not identify if workbook {filepath} is Vendor or Unit type, "
+                           f"its sheets don't match any of the templates in excel_config.json")
+    if workbook_type not in workbook_types:
+        raise RuntimeError(f"{filepath} is a {workbook_type} workbook, expected {' or '.join(workbook_types)}")
+    return workbook_type
+
+
+def open_workbook(filepath: pathlib.Path) -> Workbook:
+    '''
+    opens the workbook read-only, so cells are streamed from the file as they're read
+    instead of the whole workbook being loaded up front
+    close() it when done, read-only workbooks keep the file open
+    '''
+    return openpyxl.load_workbook(filepath, read_only=True)
+
+
+def get_data_sheets(workbook_type: str) -> dict:
+    '''
+    returns the excel_config.json settings for each sheet in that type of workbook that has data,
+    i.e. isn't skipped, e.g. {"first_row_with_data": 5, "last_column_with_data": "AI"}
+    '''
+    return {sheet_name: sheet_conf for sheet_name, sheet_conf in config()[workbook_type].items()
+            if not sheet_conf.get('skip')}
+
+
+class SheetRow(Mapping):
+    '''
+    one row of a worksheet, read like a dict of column letter: cell value
+    e.g. row['A'], row.get('B'), row.items()
+
+    the values are a tuple, and the column letter -> position map is shared
+    by every row in the sheet with the same width, instead of each row being its own dict
+    '''
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns: dict, values: tuple):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, column: str):
+        return self._values[self._columns[column]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._columns)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+    def values(self) -> tuple:
+        return self._values
+
+
+def iter_worksheet_rows(sheet: Worksheet, min_row: int, max_row: int = None,
+                        last_column: str = None) -> Iterator[tuple[int, SheetRow]]:
+    '''
+    yields (row number in the sheet, row) for every row with data, as it's read
+    where row is a SheetRow of column letter: cell value
+    column letters are worked out once for the sheet, not for every cell
+
+    read-only sheets drop empty cells off the end of a row,
+    so every row gets at least the columns up to last_column, and up to the widest row so far
+    '''
+    width = column_index_from_string(last_column) if last_column else 0
+    columns = {get_column_letter(column_index): column_index - 1 for column_index in range(1, width + 1)}
+    for row_index, row in enumerate(sheet.iter_rows(values_only=True, min_row=min_row, max_row=max_row),
+                                    start=min_row):
+        if not any(cell is not None for cell in row):
+            continue
+        if len(row) > len(columns):
+            # a new map, rather than growing the old one, since earlier rows (maybe on other threads) still use it
+            columns = {get_column_letter(column_index): column_index - 1
+                       for column_index in range(1, len(row) + 1)}
+        elif len(row) < len(columns):
+            row = tuple(row) + (None,) * (len(columns) - len(row))
+        yield row_index, SheetRow(columns, tuple(row))
+
+
+def iter_worksheet(filepath: pathlib.Path, sheet_name: str, min_row: int = None,
+                   max_row: int = None) -> Iterator[tuple[int, SheetRow]]:
+    '''
+    streams the rows of one worksheet, without reading the rest of the workbook
+    min_row and max_row limit it to those rows of the sheet
+    filepath can also be a manifest, see iter_manifest()
+    '''
+    if is_manifest(filepath):
+        yield from iter_manifest(filepath, sheet_name, min_row, max_row)
+        return
+    logger.debug(f"streaming worksheet {sheet_name} from {filepath}...")
+    data_sheets = get_data_sheets(require_workbook_type(filepath))
+    if sheet_name not in data_sheets:
+        raise KeyError(f"{sheet_name} is not a worksheet with data in {filepath}")
+    sheet_conf = data_sheets[sheet_name]
+    workbook = open_workbook(filepath)
+    try:
+        min_row = max(sheet_conf["first_row_with_data"], min_row or 0)
+        yield from iter_worksheet_rows(workbook[sheet_name], min_row, max_row,
+                                       sheet_conf.get("last_column_with_data"))
+    finally:
+        workbook.close()
+
+
+'''
+manifests are plain tables of rows, with a header naming each column,
+that can be used instead of a spreadsheet
+'''
+MANIFEST_SUFFIXES = ('.csv', '.jsonl', '.parquet')
+
+
+def is_manifest(filepath: pathlib.Path) -> bool:
+    return pathlib.Path(filepath).suffix.lower() in MANIFEST_SUFFIXES
+
+
+def get_sheet_conf(sheet_name: str) -> dict:
+    '''
+    returns the excel_config.json settings for a sheet with data, from whichever workbook type has it
+    '''
     conf = config()
-    sheets_data = {}
-    for sheet_name in workbook.sheetnames:
+    for workbook_type in WORKBOOK_TYPES:
+        sheet_conf = conf[workbook_type].get(sheet_name)
+        if sheet_conf and not sheet_conf.get('skip'):
+            return sheet_conf
+    raise KeyError(f"{sheet_name} is not a worksheet with data in any of the templates")
+
+
+def get_manifest_sheet_name(filepath: pathlib.Path, sheet_name: str = None) -> str:
+    '''
+    which sheet a manifest stands in for:
+    sheet_name if given, otherwise the file has to be named after it, e.g. "Digital Assets.csv"
+    '''
+    sheet_name = sheet_name or pathlib.Path(filepath).stem
+    try:
+        get_sheet_conf(sheet_name)
+    except KeyError:
+        raise KeyError(f"can't tell which sheet {filepath} is, name it after the sheet "
+                       f"(e.g. Digital Assets.csv) or say which with -s")
+    return sheet_name
+
+
+def get_manifest_column_names(sheet_name: str) -> dict:
+    '''
+    the header names a manifest can use for each column of the sheet, from field_mappings.json
+    i.e. the attribute name (e.g. digital_asset_id) or Airtable field name (e.g. Digital Asset ID)
+    column letters (e.g. A) can be used as they are
+    '''
+    record_type = get_sheet_conf(sheet_name)['record_type']
+    column_names = {}
+    for attr_name, mapping in load_field_mappings()[record_type].items():
+        if not mapping.get('xlsx'):
+            continue
         try:
-            if conf[workbook_type][sheet_name]['skip']:
-                continue
+            column = mapping['xlsx']['column']
+        except TypeError:
+            column = mapping['xlsx']
+        column_names[attr_name] = column
+        atbl_name = mapping['atbl'].get('name') if isinstance(mapping.get('atbl'), dict) else mapping.get('atbl')
+        if atbl_name:
+            column_names.setdefault(atbl_name, column)
+    return column_names
+
+
+def _manifest_column(header: str, column_names: dict, sheet_name: str) -> str | None:
+    header = str(header).strip()
+    if header in column_names:
+        return column_names[header]
+    if re.fullmatch(r'[A-Z]{1,3}', header):
+        return header
+    logger.warning(f"ignoring manifest column {header}, it isn't a column of {sheet_name} in field_mappings.json")
+    return None
+
+
+class ManifestRowMaker:
+    '''
+    turns a manifest's cells into SheetRows, with the values in the columns the sheet would have them in
+    headers are worked out once, not for every row
+    '''
+
+    def __init__(self, sheet_name: str, headers: list = ()):
+        self.sheet_name = sheet_name
+        self.column_names = get_manifest_column_names(sheet_name)
+        self.width = column_index_from_string(get_sheet_conf(sheet_name).get('last_column_with_data', 'A'))
+        self.positions = {}
+        for header in headers:
+            self.position(header)
+        self._make_columns()
+
+    def _make_columns(self):
+        self.columns = {get_column_letter(column_index): column_index - 1
+                        for column_index in range(1, self.width + 1)}
+
+    def position(self, header: str) -> int | None:
+        '''
+        where the values under header go in the row, None if they aren't used
+        '''
+        try:
+            return self.positions[header]
         except KeyError:
             pass
-        sheet = workbook[sheet_name]
-        start_row = conf[workbook_type][sheet_name]["first_row_with_data"]
-        rows_dict = {}
-        for row_index, row in enumerate(sheet.iter_rows(values_only=True, min_row=start_row), start=start_row):
-            row_data = {}
-            for column_index, cell_value in enumerate(row, start=1):
-                column_letter = get_column_letter(column_index)
-                row_data[column_letter] = cell_value
-            if any(cell is not None for cell in row_data.values()):
-                rows_dict[row_index] = row_data
-        sheets_data[sheet_name] = rows_dict
+        column = _manifest_column(header, self.column_names, self.sheet_name)
+        position = column_index_from_string(column) - 1 if column else None
+        self.positions[header] = position
+        if position is not None and position >= self.width:
+            self.width = position + 1
+            # a new map, rather than growing the old one, like iter_worksheet_rows()
+            self._make_columns()
+        return position
+
+    def make_row(self, cells: list[tuple[int | None, Any]]) -> SheetRow | None:
+        '''
+        cells are (position, value) pairs, with the positions from position()
+        returns None for an empty row, empty strings are empty cells like in a spreadsheet
+        '''
+        values = [None] * self.width
+        empty = True
+        for position, value in cells:
+            if position is None or value is None or value == '':
+                continue
+            values[position] = value
+            empty = False
+        if empty:
+            return None
+        return SheetRow(self.columns, tuple(values))
+
+
+def iter_manifest(filepath: pathlib.Path, sheet_name: str = None, min_row: int = None,
+                  max_row: int = None) -> Iterator[tuple[int, SheetRow]]:
+    '''
+    yields (row number, row) for every row with data in a CSV, JSONL or Parquet manifest,
+    like iter_worksheet() does for a spreadsheet
+    CSV rows are numbered like a spreadsheet would, so the first row after the header is 2
+    JSONL rows are numbered by line, Parquet rows from 1
+    CSV and JSONL are streamed a row at a time, Parquet is read a column at a time
+    '''
+    filepath = pathlib.Path(filepath)
+    sheet_name = get_manifest_sheet_name(filepath, sheet_name)
+    min_row = min_row or 1
+    logger.debug(f"reading {filepath} as {sheet_name}...")
+    suffix = filepath.suffix.lower()
+    if suffix == '.csv':
+        with open(filepath, 'r', newline='', encoding='utf-8-sig') as csv_file:
+            reader = csv.reader(csv_file)
+            headers = next(reader, [])
+            row_maker = ManifestRowMaker(sheet_name, headers)
+            positions = [row_maker.position(header) for header in headers]
+            for row_index, cells in enumerate(reader, start=2):
+                if max_row and row_index > max_row:
+                    break
+                if row_index < min_row:
+                    continue
+                row = row_maker.make_row(zip(positions, cells))
+                if row is not None:
+                    yield row_index, row
+    elif suffix == '.jsonl':
+        row_maker = ManifestRowMaker(sheet_name)
+        with open(filepath, 'r', encoding='utf-8') as jsonl_file:
+            for row_index, line in enumerate(jsonl_file, start=1):
+                if max_row and row_index > max_row:
+                    break
+                if row_index < min_row or not line.strip():
+                    continue
+                # a key we haven't seen yet can widen the row, so positions are found first
+                row = row_maker.make_row([(row_maker.position(header), value)
+                                          for header, value in json.loads(line).items()])
+                if row is not None:
+                    yield row_index, row
+    elif suffix == '.parquet':
+        if pq is None:
+            raise RuntimeError("reading Parquet manifests needs pyarrow, install it with: uv sync --extra parquet")
+        table = pq.read_table(filepath)
+        row_maker = ManifestRowMaker(sheet_name, table.column_names)
+        table = table.slice(min_row - 1, max_row - min_row + 1 if max_row else None)
+        # whole columns to python at once, then zipped into rows,
+        # much quicker than putting each row together a cell at a time
+        empty_column = [None] * table.num_rows
+        columns = [empty_column] * row_maker.width
+        for header in table.column_names:
+            position = row_maker.position(header)
+            if position is not None:
+                columns[position] = [None if value == '' else value for value in table.column(header).to_pylist()]
+        if all(column is empty_column for column in columns):
+            raise RuntimeError(f"none of the columns in {filepath} match a field in field_mappings.json "
+                               f"for {sheet_name}: {', '.join(table.column_names)}")
+        for row_index, values in enumerate(zip(*columns), start=min_row):
+            if values.count(None) < row_maker.width:
+                yield row_index, SheetRow(row_maker.columns, values)
+    else:
+        raise RuntimeError(f"{filepath} is not a manifest, they have to be one of {', '.join(MANIFEST_SUFFIXES)}")
+
+
+# bump when the format of the parsed workbook changes, so old cache files aren't used
+WORKBOOK_CACHE_VERSION = 2
+
+
+def _hash_file(filepath: pathlib.Path) -> str:
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as the_file:
+        for chunk in iter(lambda: the_file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def workbook_cache_key(filepath: pathlib.Path) -> str:
+    '''
+    the workbook's contents, plus the versions of the config that parsing depends on
+    so renaming/ moving the file still hits, and editing it or the config misses
+    '''
+    this_dirpath = pathlib.Path(__file__).parent.absolute()
+    parts = [str(WORKBOOK_CACHE_VERSION), _hash_file(filepath),
+             _hash_file(this_dirpath / "excel_config.json"),
+             _hash_file(this_dirpath.parent.parent / "field_mappings.json")]
+    return hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+
+
+def read_cached_workbook(cache_key: str) -> dict | None:
+    '''
+    returns the parsed workbook from the cache, or None if it isn't there
+    '''
+    cache_filepath = get_workbook_cache_dir() / f"{cache_key}.pickle"
+    try:
+        with open(cache_filepath, 'rb') as cache_file:
+            sheets_data = pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logger.warning(f"ignoring unreadable cached workbook {cache_filepath}: {exc}")
+        return None
+    # mtime is when it was last used, for evict_workbook_cache()
+    os.utime(cache_filepath)
+    return sheets_data
+
+
+def write_cached_workbook(cache_key: str, sheets_data: dict):
+    '''
+    caches the parsed workbook, then trims the cache back down to size
+    '''
+    cache_dirpath = get_workbook_cache_dir()
+    cache_filepath = cache_dirpath / f"{cache_key}.pickle"
+    tmp_filepath = cache_dirpath / f"{cache_key}.{os.getpid()}.tmp"
+    with open(tmp_filepath, 'wb') as cache_file:
+        pickle.dump(sheets_data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filepath, cache_filepath)
+    max_mb = config().get('workbook_cache', {}).get('max_mb', 500)
+    evict_workbook_cache(max_mb * 1024 * 1024)
+
+
+def evict_workbook_cache(max_bytes: int) -> int:
+    '''
+    deletes the least recently used cached workbooks until the cache fits in max_bytes
+    returns the number deleted
+    '''
+    cache_files = []
+    for cache_filepath in get_workbook_cache_dir().glob('*.pickle'):
+        try:
+            stat = cache_filepath.stat()
+        except FileNotFoundError:
+            continue
+        cache_files.append((stat.st_mtime, stat.st_size, cache_filepath))
+    cache_files.sort()
+    total_bytes = sum(size for _, size, _ in cache_files)
+    evicted = 0
+    for _, size, cache_filepath in cache_files:
+        if total_bytes <= max_bytes:
+            break
+        cache_filepath.unlink(missing_ok=True)
+        total_bytes -= size
+        evicted += 1
+    return evicted
+
+
+def load_worksheet(filepath: pathlib.Path, sheet_name: str, row: int = None,
+                   use_cache: bool = True, min_row: int = None, max_row: int = None) -> dict:
+    '''
+    loads one worksheet, or just one row of it, into a dictionary like load_all_worksheets()
+    min_row and max_row load just those rows instead
+    taken from the cached workbook if there is one, otherwise only the rows asked for are read
+    manifests aren't cached, they're quick enough to read again
+    '''
+    if row:
+        min_row = max_row = row
+    if is_manifest(filepath):
+        use_cache = False
+    sheets_data = read_cached_workbook(workbook_cache_key(filepath)) if use_cache else None
+    if sheets_data is not None:
+        logger.debug(f"using cached copy of {filepath}")
+        sheet = sheets_data[sheet_name]
+        if min_row or max_row:
+            return select_rows(sheet, min_row, max_row)
+        return sheet
+    return dict(iter_worksheet(filepath, sheet_name, min_row=min_row, max_row=max_row))
+
+
+def select_rows(rows: dict, min_row: int = None, max_row: int = None) -> dict:
+    '''
+    just the rows numbered min_row to max_row, either end can be left open
+    '''
+    return {row_index: row for row_index, row in rows.items()
+            if (not min_row or row_index >= min_row) and (not max_row or row_index <= max_row)}
+
+
+def load_all_worksheets(filepath: pathlib.Path, use_cache: bool = True) -> dict:
+    '''
+    loads all worksheets from xlsx at filepath into dictionary
+    where each key is the worksheet name
+    and each value is a dictionary of rows, keyed on row number,
+    which themselves are SheetRows of key: value paires where the key is the column letter and value is cell value
+
+    the result is cached, so loading the same spreadsheet again skips parsing it
+    use_cache=False reads the spreadsheet regardless, and doesn't cache it
+
+    filepath can also be a CSV, JSONL or Parquet manifest, named after the sheet it stands in for
+    '''
+    if is_manifest(filepath):
+        sheet_name = get_manifest_sheet_name(filepath)
+        return {sheet_name: dict(iter_manifest(filepath, sheet_name))}
+    if use_cache:
+        cache_key = workbook_cache_key(filepath)
+        sheets_data = read_cached_workbook(cache_key)
+        if sheets_data is not None:
+            logger.debug(f"using cached copy of {filepath}")
+            return sheets_data
+    logger.debug(f"loading Excel spreadsheet from {filepath}...")
+    started = time.perf_counter()
+    data_sheets = get_data_sheets(require_workbook_type(filepath))
+    workbook = open_workbook(filepath)
+    try:
+        sheets_data = {}
+        for sheet_name, sheet_conf in data_sheets.items():
+            sheets_data[sheet_name] = dict(iter_worksheet_rows(workbook[sheet_name],
+                                                               sheet_conf["first_row_with_data"],
+                                                               last_column=sheet_conf.get("last_column_with_data")))
+    finally:
+        workbook.close()
+    logger.debug(f"parsed {filepath} in {time.perf_counter() - started:.1f} seconds")
+    if use_cache:
+        write_cached_workbook(cache_key, sheets_data)
     return sheets_data
 
 
@@ -101,24 +576,180 @@ def validate_row(row: dict, required_columns: list) -> list:
     return missing_values
 
 
-def validate_required_fields(rows: dict, record_type: str) -> list:
+def validate_required_fields(rows: dict | list, record_type: str) -> list:
     '''
     uses rules in field_mappings.json to validate sheet_dict
+    rows is the sheet, keyed on row number, or a list of rows numbered from 0
     '''
     logger.debug("validating worksheet...")
-    _field_map = load_field_mappings()
-    field_map = _field_map[record_type]
-    required_columns = []
+    if not isinstance(rows, Mapping):
+        rows = dict(enumerate(rows))
+    required_columns = [check.column for check in compile_validation_plan(record_type)
+                        if check.problem == 'required']
     missing_values = []
-    for field, mapping in field_map.items():
-        try:
-            assert mapping['xlsx']['required']
-        except (KeyError, TypeError):
-            continue
-        if mapping['xlsx']['required']:
-                required_columns.append(mapping['xlsx']['column'])
-    for row in rows:
+    for row_index, row in rows.items():
         missing_columns = validate_row(row, required_columns)
         if missing_columns:
-            missing_values.append({"row": rows.index(row), "columns": missing_columns})
+            missing_values.append({"row": row_index, "columns": missing_columns})
     return missing_values
+
+
+def is_barcode(value: Any) -> bool:
+    '''
+    barcodes are all digits, Excel sometimes turns them into floats
+    '''
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    if isinstance(value, float):
+        return value.is_integer()
+    return bool(re.fullmatch(r'\d+(\.0+)?', str(value).strip()))
+
+
+def is_size_value(value: Any) -> bool:
+    '''
+    a number, optionally followed by its unit, like 7, "7 in." or "1200ft"
+    '''
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    return bool(re.fullmatch(r'(\d+(\.\d+)?|\.\d+)\s*\D*', str(value).strip()))
+
+
+def is_duration(value: Any) -> bool:
+    '''
+    mm:ss or hh:mm:ss, or a time Excel has already parsed
+    '''
+    if isinstance(value, (datetime_time, timedelta, datetime)):
+        return True
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return True
+    return bool(re.fullmatch(r'\d+:[0-5]\d(:[0-5]\d)?', str(value).strip()))
+
+
+def is_number(value: Any) -> bool:
+    '''
+    a number, or text that is one, like CSV manifests have
+    '''
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    try:
+        float(str(value).strip())
+    except ValueError:
+        return False
+    return True
+
+
+def is_date(value: Any) -> bool:
+    '''
+    YYYY-MM-DD, or a date Excel has already parsed
+    '''
+    if isinstance(value, (datetime, date)):
+        return True
+    try:
+        datetime.strptime(str(value).strip(), '%Y-%m-%d')
+    except ValueError:
+        return False
+    return True
+
+
+'''
+attributes whose values have to be in a certain format, see is_*() above
+'''
+attr_checks = {
+    'asset_barcode': (is_barcode, "not a barcode, should be all digits"),
+    'physical_asset_barcode': (is_barcode, "not a barcode, should be all digits"),
+    'size_value': (is_size_value, "not a size, should be a number optionally followed by a unit, e.g. 7 in."),
+    'asset_duration': (is_duration, "not a duration, should be mm:ss or hh:mm:ss"),
+    'date_value': (is_date, "not a date, should be YYYY-MM-DD"),
+    'asset_creation_date': (is_date, "not a date, should be YYYY-MM-DD"),
+}
+# number fields that aren't listed above are checked with is_number()
+
+
+class ColumnCheck(NamedTuple):
+    '''
+    one entry in a compiled validation plan:
+    the column, the field it holds, and what to check its values for
+    check is None for required columns, which only have to have something in them
+    '''
+    column: str
+    attr_name: str
+    problem: str
+    check: Callable | None
+
+
+_validation_plans = {}
+
+
+def compile_validation_plan(record_type: str) -> list[ColumnCheck]:
+    '''
+    walks field_mappings.json once per record type
+    and flattens it into the list of checks validate_rows() runs on every row
+    '''
+    try:
+        return _validation_plans[record_type]
+    except KeyError:
+        pass
+    plan = []
+    for attr_name, mapping in load_field_mappings()[record_type].items():
+        if not mapping.get('xlsx'):
+            continue
+        try:
+            column = mapping['xlsx']['column']
+            required = mapping['xlsx'].get('required', False)
+        except TypeError:
+            column = mapping['xlsx']
+            required = False
+        if required:
+            plan.append(ColumnCheck(column, attr_name, 'required', None))
+        if attr_name in attr_checks:
+            check, problem = attr_checks[attr_name]
+            plan.append(ColumnCheck(column, attr_name, problem, check))
+        elif isinstance(mapping.get('atbl'), dict) and mapping['atbl'].get('type') in ('number', 'float', 'integer'):
+            plan.append(ColumnCheck(column, attr_name, "not a number", is_number))
+    _validation_plans[record_type] = plan
+    return plan
+
+
+def is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def validate_rows(rows: dict, record_type: str) -> list[dict]:
+    '''
+    checks every row of a sheet against field_mappings.json in one pass:
+    required columns have something in them,
+    and barcodes, sizes, durations and dates are in a format we can upload
+    rows is keyed on row number in the sheet, like load_all_worksheets() returns
+
+    returns every problem found, in sheet order, so they can all be fixed at once
+    each problem is {"row", "column", "field", "value", "problem"}
+    '''
+    logger.debug(f"validating {len(rows)} rows as {record_type}...")
+    plan = compile_validation_plan(record_type)
+    problems = []
+    for row_index, row in rows.items():
+        for column, attr_name, problem, check in plan:
+            value = row.get(column)
+            if check is None:
+                if is_empty(value):
+                    problems.append({"row": row_index, "column": column, "field": attr_name,
+                                     "value": value, "problem": "required, but empty"})
+            elif not is_empty(value) and not check(value):
+                problems.append({"row": row_index, "column": column, "field": attr_name,
+                                 "value": value, "problem": problem})
+    return problems
+
+
+def format_problems(problems: list[dict]) -> str:
+    '''
+    validate_rows() problems, one per line, to log
+    '''
+    return '\n'.join(f"row {problem['row']}, column {problem['column']} ({problem['field']}): "
+                     f"{problem['problem']}" + (f", got {problem['value']!r}" if problem['value'] is not None else '')
+                     for problem in problems)
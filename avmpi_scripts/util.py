@@ -1,9 +1,11 @@
 '''
 utility functions
 '''
-import subprocess
 import logging
-from typing import Optional
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 logger = logging.getLogger('main_logger')
 
@@ -30,3 +32,27 @@ def run_command(cmd: str | list, return_output: bool = False) -> Optional[str]:
     except Exception as exc:
         logger.error(exc, stack_info=True)
         raise RuntimeError("the script encountered a problem while tyring to run that command")
+
+
+def map_ordered(func: Callable[[Any], Any], items: Iterable,
+                workers: int = 4, window: int = None) -> Iterator:
+    '''
+    yields func(item) for every item, run on a pool of worker threads
+    results come out in the same order as items
+    at most window items (default 2 per worker) are in flight at once,
+    so a slow consumer holds back the workers instead of results piling up in memory
+    anything func raises is raised in the caller, and the items after it are dropped
+    '''
+    window = window or workers * 2
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='map_ordered') as executor:
+        try:
+            for item in items:
+                in_flight.append(executor.submit(func, item))
+                if len(in_flight) >= window:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
@@ -9,10 +9,13 @@ import argparse
 from datetime import datetime
 from pprint import pformat
 import services.airtable.airtable as airtable
-from pyairtable import Base
+import services.airtable.outbox as outbox
 import make_log
 import util
 
+logger = logging.getLogger('main_logger')
+
+
 def config() -> dict:
     '''
     creates/ returns config object for MediaConch/ validation setup
@@ -50,63 +53,84 @@ def run_mediaconch(media_fullpath: pathlib.Path, policy_fullpath: pathlib.Path)
         raise RuntimeError("the script encountered an error trying to validate that file")
 
 
-def get_linked_digital_asset_record(daid: str, atbl_base: Base):
+def plan_qc_log_sync(results: list, da_recs_by_daid: dict,
+                     qc_index: airtable.TableIndex, today: str) -> tuple[list, list, list]:
     '''
-    QC Log table links to digital asset table
-    we need to pop record_id from Digital Assets record into QC Log, for new records
+    works out, in memory, which QC Log records need creating and which need updating
+
+    results is a list of (daid, MediaConch status, QC Issues)
+    da_recs_by_daid is the Digital Asset records for each DAID, from airtable.find_many()
+    returns creates, updates, and the DAIDs with no Digital Asset record
     '''
-    atbl_tbl = atbl_base['Digital Assets']
-    result = airtable.find(daid, "Digital Asset ID", atbl_tbl, True)
-    if result:
-        return result
-    else:
-        raise RuntimeError(f"no asset found in {atbl_tbl} with Digital Asset ID {daid}")
+    creates = []
+    updates = []
+    missing = []
+    for daid, status, qc_issues in results:
+        fields = {"MediaConch": status, "QC Issues": qc_issues, "QC Start": today}
+        da_recs = da_recs_by_daid.get(daid, [])
+        if len(da_recs) > 1:
+            raise RuntimeError(f"too many Digital Asset records for {daid}, expected 1, got {len(da_recs)}")
+        if not da_recs:
+            logger.error(f"no asset found in Digital Assets with Digital Asset ID {daid}")
+            missing.append(daid)
+            continue
+        qc_recs = qc_index.lookup(da_recs[0]['id'], "Digital Asset")
+        if len(qc_recs) > 1:
+            raise RuntimeError(f"too many QC Log records for {daid}, expected 1, got {len(qc_recs)}")
+        if qc_recs:
+            logger.info(f"updating QC Log record for {daid}")
+            updates.append({"id": qc_recs[0]['id'], "fields": fields})
+        else:
+            logger.info(f"creating new QC Log record for {daid}")
+            fields["Digital Asset"] = [da_recs[0]['id']]
+            creates.append(fields)
+    return creates, updates, missing
 
 
 def send_results_to_airtable(passes: list, fails: list, inprogress: list):
     '''
     actually sends the results of the validation to Airtable QC Log
+
+    looks up every DAID at once, and reads the QC Log once,
+    then queues every create and update in the outbox and sends them in batches of 10
     '''
     logger.info("sending results to Airtable...")
     atbl_base = airtable.connect_one_base('Assets')
     atbl_tbl = atbl_base['QC Log']
     today = datetime.today().strftime('%Y-%m-%d') 
-    for passed_file in passes:
-        result = airtable.find(passed_file['daid'], "Digital Asset", atbl_tbl, True)
-        if result:
-            logger.info(f"updating QC Log record for {passed_file['daid']}")
-            atbl_tbl.update(result['id'], {"MediaConch": "Pass", "QC Issues": "",
-                                           "QC Start": today})
-        else:
-            logger.info(f"creating new QC Log record for {passed_file['daid']}")
-            atbl_rec_digital_asset = get_linked_digital_asset_record(passed_file['daid'], atbl_base)
-            atbl_tbl.create({"Digital Asset": [atbl_rec_digital_asset['id']],
-                             "MediaConch": "Pass", "QC Issues": "",
-                             "QC Start": today})
-    for failed_file in fails:
-        result = airtable.find(failed_file['daid'], "Digital Asset", atbl_tbl, True)
-        if result:
-            logger.info(f"updating QC Log record for {failed_file['daid']}")
-            atbl_tbl.update(result['id'], {"MediaConch": "Fail", "QC Issues": failed_file['log'],
-                                           "QC Start": today})
-        else:
-            logger.info(f"creating new QC Log record for {failed_file['daid']}")
-            atbl_rec_digital_asset = get_linked_digital_asset_record(failed_file['daid'], atbl_base)
-            atbl_tbl.create({"Digital Asset": [atbl_rec_digital_asset['id']],
-                             "MediaConch": 'Fail', "QC Issues": failed_file['log'],
-                             "QC Start": today})
-    for inprog_file in inprogress:
-        result = airtable.find(inprog_file['daid'], "Digital Asset", atbl_tbl, True)
-        if result:
-            logger.info(f"updating QC Log record for {inprog_file['daid']}")
-            atbl_tbl.update(result['id'], {"MediaConch": "In Progress", "QC Issues": inprog_file['log'],
-                                           "QC Start": today})
-        else:
-            logger.info(f"creating new QC Log record for {inprog_file['daid']}")
-            atbl_rec_digital_asset = get_linked_digital_asset_record(inprog_file['daid'], atbl_base)
-            atbl_tbl.create({"Digital Asset": [atbl_rec_digital_asset['id']],
-                             "MediaConch": 'In Progress', "QC Issues": inprog_file['log'],
-                             "QC Start": today})
+    results = [(passed_file['daid'], "Pass", "") for passed_file in passes]
+    results.extend((failed_file['daid'], "Fail", failed_file['log']) for failed_file in fails)
+    results.extend((inprog_file['daid'], "In Progress", inprog_file['log']) for inprog_file in inprogress)
+    if not results:
+        return
+    calls_before = len(airtable.get_call_stats().calls)
+    atbl_outbox = airtable.get_outbox()
+    # anything left over from an interrupted run goes first
+    airtable.drain_outbox()
+    da_recs_by_daid = airtable.find_many([result[0] for result in results], "Digital Asset ID",
+                                         atbl_base['Digital Assets'], fields=["Digital Asset ID"])
+    # link fields come back as record ids, so the QC Log is indexed on Digital Asset record id
+    qc_index = airtable.prefetch(atbl_tbl, ["Digital Asset"], fields=["Digital Asset"])
+    creates, updates, missing = plan_qc_log_sync(results, da_recs_by_daid, qc_index, today)
+    # one outbox entry per Digital Asset, so a file going Fail -> Pass -> Fail
+    # sends its second Fail, since it's different from the Pass last sent for that file
+    for update in updates:
+        da_record_id = qc_index.records_by_id[update['id']]['fields']['Digital Asset'][0]
+        atbl_outbox.enqueue('QC Log', 'update', update, outbox.make_idempotency_key('QC Log', da_record_id))
+    for create in creates:
+        atbl_outbox.enqueue('QC Log', 'create', create,
+                            outbox.make_idempotency_key('QC Log', create['Digital Asset'][0]))
+    totals = airtable.drain_outbox()
+    calls = len(airtable.get_call_stats().calls) - calls_before
+    logger.info(f"QC Log synced for {len(results) - len(missing)} files: "
+                f"{totals['created']} created, {totals['updated']} updated, "
+                f"in {calls} Airtable calls")
+    if totals['failed'] or totals['pending']:
+        logger.error(f"{totals['failed']} QC Log writes failed and {totals['pending']} are still pending")
+        logger.error("run validate_media again to resend pending writes")
+    if missing:
+        logger.error(pformat(missing))
+        raise RuntimeError(f"no Digital Asset records found for {len(missing)} files, see above")
 
 
 def detect_policy_for_file(file: str, conf: dict) -> pathlib.Path:
@@ -172,6 +196,8 @@ def validate_media(kwvars: dict):
     manages the process of validating media files with MediaConch
     '''
     conf = config()
+    if kwvars['fresh']:
+        airtable.use_mirror(False)
     fails = []
     passes = []
     if not kwvars['daid']:
@@ -257,6 +283,8 @@ def parse_args(args: argparse.Namespace) -> dict:
     else:
         kwvars['dadir'] = None
     kwvars['policy'] = args.policy
+    kwvars['fresh'] = args.fresh
+    kwvars['stats_json'] = args.stats_json
     return kwvars
 
 
@@ -281,6 +309,10 @@ def init_args() -> argparse.Namespace:
                         help="the MediaConch policy that we want to validate against\n"
                         "leave out this option and the script will auto-detect the policy\n"
                         "based on the file extension in validate_media_config.json")
+    parser.add_argument('--fresh', dest='fresh', action='store_true', default=False,
+                        help="reads live from Airtable instead of the local mirror")
+    parser.add_argument('--stats_json', dest='stats_json', default=None,
+                        help="writes a summary of the Airtable calls made, with their timings, to this JSON file")
     args = parser.parse_args()
     return args
 
@@ -294,6 +326,7 @@ def main():
     kwvars = parse_args(args)
     global logger
     logger = make_log.init_log(loglevel_print=kwvars['loglevel_print'])
+    airtable.report_call_stats_at_exit(kwvars['stats_json'])
     validate_media(kwvars)
     logger.info("embed_md has completed successfully")
 
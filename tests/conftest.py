@@ -0,0 +1,64 @@
+'''
+shared pytest setup
+'''
+import sys
+import copy
+import pathlib
+import pytest
+
+'''
+the scripts import their neighbours as top-level modules,
+e.g. import services.airtable.airtable
+so the avmpi_scripts folder goes on the path to be able to import them here
+'''
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute() / 'avmpi_scripts'))
+
+import avmpi_scripts.services.airtable.airtable as avmpi_airtable
+import services.airtable.airtable as scripts_airtable
+import avmpi_scripts.services.excel.excel as avmpi_excel
+import services.excel.excel as scripts_excel
+from .fake_airtable import FakeAirtable, add_assets_base
+
+
+@pytest.fixture(autouse=True)
+def workbook_cache_dir(monkeypatch, tmp_path) -> pathlib.Path:
+    '''
+    keeps parsed workbooks cached by the tests out of the real cache
+    '''
+    cache_dirpath = tmp_path / 'workbooks'
+    cache_dirpath.mkdir()
+    for module in (avmpi_excel, scripts_excel):
+        monkeypatch.setattr(module, 'get_workbook_cache_dir', lambda: cache_dirpath)
+    return cache_dirpath
+
+
+@pytest.fixture
+def fake_airtable(monkeypatch, tmp_path) -> FakeAirtable:
+    '''
+    points the Airtable module at a local FakeAirtable with an empty Assets base
+    via main.endpoint_url, so nothing needs an api_key or touches the real base
+    local state (mirror, outbox, schema cache) goes in tmp_path
+
+    the module is imported under two names (by the tests and by the scripts)
+    so both copies get patched
+    '''
+    fake = FakeAirtable()
+    fake.start()
+    atbl_conf = avmpi_airtable.config()
+    atbl_conf['main'].update(api_key='patFAKE', endpoint_url=fake.url, cache_dir=str(tmp_path))
+    atbl_conf['rate_limit'] = {"requests_per_second": 1000, "burst": 1000, "max_retries": 0}
+    add_assets_base(fake, atbl_conf['bases']['Assets']['base_id'])
+    for module in (avmpi_airtable, scripts_airtable):
+        monkeypatch.setattr(module, 'config', lambda: copy.deepcopy(atbl_conf))
+        for name, value in [('_rate_governor', None), ('_api', None), ('_outbox', None),
+                            ('_outbox_filename', 'outbox.sqlite'),
+                            ('_mirror', None), ('_mirror_enabled', None), ('_mirror_synced', set()),
+                            ('_base_schemas', {}), ('_table_indexes', {})]:
+            monkeypatch.setattr(module, name, value)
+        monkeypatch.setattr(module, 'link_resolver', module.LinkResolver())
+        monkeypatch.setattr(module, '_call_stats', module.callstats.CallStats())
+        for record_class in module.AVMPIAirtableRecord.__subclasses__():
+            monkeypatch.setattr(record_class.meta, 'api', module.get_api())
+            monkeypatch.setattr(record_class, '_memoized', {})
+    yield fake
+    fake.stop()
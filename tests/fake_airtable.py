@@ -0,0 +1,689 @@
+'''
+local stand-in for the Airtable REST API, for tests and benchmarks
+
+serves the endpoints pyairtable uses: list (with filterByFormula), get,
+create, update, upsert, delete and the base schema, from in-memory tables
+every request is logged, so tests can count what a workflow costs
+'''
+import re
+import json
+import time
+import itertools
+import threading
+import pathlib
+import urllib.parse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MAX_RECORDS_PER_REQUEST = 10
+MAX_PAGE_SIZE = 100
+COMPUTED_TYPES = ['autoNumber', 'formula', 'rollup', 'lookup', 'multipleLookupValues',
+                  'count', 'createdTime', 'lastModifiedTime']
+SELECT_TYPES = ['singleSelect', 'multipleSelects']
+
+
+class FakeAirtableError(Exception):
+    '''
+    becomes an Airtable-style error response
+    '''
+
+    def __init__(self, status: int, error_type: str, message: str = ''):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.message = message
+
+
+class FormulaError(FakeAirtableError):
+
+    def __init__(self, message: str):
+        super().__init__(422, 'INVALID_FILTER_BY_FORMULA', message)
+
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<number>\d+(?:\.\d+)?)|
+    (?P<string>'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")|
+    (?P<field>\{(?:\\.|[^}\\])*\})|
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*)|
+    (?P<op><=|>=|!=|[=<>&+\-*/(),])
+    )""", re.VERBOSE)
+UNESCAPE_RE = re.compile(r"\\(.)")
+
+
+def tokenize(formula: str) -> list[tuple[str, str]]:
+    tokens = []
+    position = 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        result = TOKEN_RE.match(formula, position)
+        if not result or result.end() == position:
+            raise FormulaError(f"could not parse formula at: {formula[position:]}")
+        position = result.end()
+        kind = result.lastgroup
+        value = result.group(kind)
+        if kind == 'string':
+            value = UNESCAPE_RE.sub(r"\1", value[1:-1])
+        elif kind == 'field':
+            value = UNESCAPE_RE.sub(r"\1", value[1:-1])
+        tokens.append((kind, value))
+    return tokens
+
+
+class FormulaParser:
+    '''
+    recursive descent parser for the subset of Airtable formulas that pyairtable writes
+    returns a tree of tuples, evaluated per record by FakeTable.evaluate()
+    '''
+
+    def __init__(self, formula: str):
+        self.tokens = tokenize(formula)
+        self.position = 0
+
+    def parse(self) -> tuple:
+        node = self.comparison()
+        if self.position != len(self.tokens):
+            raise FormulaError(f"unexpected {self.tokens[self.position][1]}")
+        return node
+
+    def peek(self) -> tuple[str, str] | None:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self, value: str = None) -> tuple[str, str]:
+        token = self.peek()
+        if token is None or (value is not None and token != ('op', value)):
+            raise FormulaError(f"expected {value or 'a value'}")
+        self.position += 1
+        return token
+
+    def binary(self, operators: list, operand) -> tuple:
+        node = operand()
+        while self.peek() and self.peek()[0] == 'op' and self.peek()[1] in operators:
+            operator = self.take()[1]
+            node = ('op', operator, node, operand())
+        return node
+
+    def comparison(self) -> tuple:
+        return self.binary(['=', '!=', '<', '>', '<=', '>='], self.concatenation)
+
+    def concatenation(self) -> tuple:
+        return self.binary(['&'], self.additive)
+
+    def additive(self) -> tuple:
+        return self.binary(['+', '-'], self.term)
+
+    def term(self) -> tuple:
+        return self.binary(['*', '/'], self.unary)
+
+    def unary(self) -> tuple:
+        if self.peek() == ('op', '-'):
+            self.take()
+            return ('neg', self.unary())
+        return self.primary()
+
+    def primary(self) -> tuple:
+        kind, value = self.take()
+        if kind == 'number':
+            return ('literal', float(value) if '.' in value else int(value))
+        if kind == 'string':
+            return ('literal', value)
+        if kind == 'field':
+            return ('field', value)
+        if kind == 'name':
+            name = value.upper()
+            args = []
+            if self.peek() == ('op', '('):
+                self.take('(')
+                if self.peek() != ('op', ')'):
+                    args.append(self.comparison())
+                    while self.peek() == ('op', ','):
+                        self.take(',')
+                        args.append(self.comparison())
+                self.take(')')
+            if name not in FUNCTIONS:
+                raise FormulaError(f"unknown function {value}")
+            return ('call', name, args)
+        if value == '(':
+            node = self.comparison()
+            self.take(')')
+            return node
+        raise FormulaError(f"unexpected {value}")
+
+
+def _to_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+
+def _to_str(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _to_number(value) -> float:
+    if value in (None, ''):
+        return 0
+    return float(value)
+
+
+def _truthy(value) -> bool:
+    if isinstance(value, str):
+        return value != ''
+    return bool(value)
+
+
+def _compare(operator: str, left, right) -> bool:
+    if isinstance(left, datetime) or isinstance(right, datetime):
+        left, right = _to_datetime(left), _to_datetime(right)
+    elif isinstance(left, (int, float)) or isinstance(right, (int, float)):
+        try:
+            left, right = _to_number(left), _to_number(right)
+        except ValueError:
+            left, right = _to_str(left), _to_str(right)
+    else:
+        left, right = _to_str(left), _to_str(right)
+    if operator == '=':
+        return left == right
+    if operator == '!=':
+        return left != right
+    if left is None or right is None:
+        return False
+    return {'<': left < right, '>': left > right,
+            '<=': left <= right, '>=': left >= right}[operator]
+
+
+def _find(needle, haystack, start=0) -> int:
+    return _to_str(haystack).find(_to_str(needle), int(_to_number(start))) + 1
+
+
+FUNCTIONS = {
+    'AND': lambda record, *args: all(_truthy(arg) for arg in args),
+    'OR': lambda record, *args: any(_truthy(arg) for arg in args),
+    'NOT': lambda record, value: not _truthy(value),
+    'IF': lambda record, test, then, otherwise=None: then if _truthy(test) else otherwise,
+    'TRUE': lambda record: True,
+    'FALSE': lambda record: False,
+    'BLANK': lambda record: None,
+    'RECORD_ID': lambda record: record['id'],
+    'CREATED_TIME': lambda record: _to_datetime(record['createdTime']),
+    'LAST_MODIFIED_TIME': lambda record, *fields: datetime.fromtimestamp(record['modified'], tz=timezone.utc),
+    'DATETIME_PARSE': lambda record, value, *formats: _to_datetime(value),
+    'IS_AFTER': lambda record, left, right: _compare('>', _to_datetime(left), _to_datetime(right)),
+    'IS_BEFORE': lambda record, left, right: _compare('<', _to_datetime(left), _to_datetime(right)),
+    'IS_SAME': lambda record, left, right, *unit: _compare('=', _to_datetime(left), _to_datetime(right)),
+    'LOWER': lambda record, value: _to_str(value).lower(),
+    'UPPER': lambda record, value: _to_str(value).upper(),
+    'TRIM': lambda record, value: _to_str(value).strip(),
+    'LEN': lambda record, value: len(_to_str(value)),
+    'FIND': lambda record, needle, haystack, start=0: _find(needle, haystack, start),
+    'SEARCH': lambda record, needle, haystack, start=0: _find(needle, haystack, start) or None,
+    'CONCATENATE': lambda record, *args: ''.join(_to_str(arg) for arg in args),
+    'ARRAYJOIN': lambda record, value, separator=', ': _to_str(value),
+    'VALUE': lambda record, value: _to_number(value),
+}
+
+
+class FakeTable:
+    '''
+    one table: its fields (name -> type, options) and its records
+    '''
+
+    def __init__(self, fake: 'FakeAirtable', base_id: str, table_id: str, name: str,
+                 fields: dict, primary_field: str = None):
+        self.fake = fake
+        self.base_id = base_id
+        self.id = table_id
+        self.name = name
+        self.fields = {}
+        for field_name, field_info in fields.items():
+            if isinstance(field_info, str):
+                field_info = {"type": field_info}
+            self.fields[field_name] = {"id": fake.new_id('fld'), **field_info}
+        self.primary_field = primary_field or list(self.fields)[0]
+        self.records = {}
+        self._auto_numbers = itertools.count(1)
+
+    def schema(self) -> dict:
+        table_fields = []
+        for field_name, field_info in self.fields.items():
+            field_schema = {"id": field_info['id'], "name": field_name, "type": field_info['type']}
+            if 'options' in field_info:
+                field_schema['options'] = {"choices": [{"id": f"sel{index}", "name": option}
+                                                       for index, option in enumerate(field_info['options'])]}
+            if 'linked_table' in field_info:
+                linked_table = self.fake.table(self.base_id, field_info['linked_table'])
+                field_schema['options'] = {"linkedTableId": linked_table.id,
+                                           "prefersSingleRecordLink": False}
+            table_fields.append(field_schema)
+        return {"id": self.id, "name": self.name,
+                "primaryFieldId": self.fields[self.primary_field]['id'],
+                "fields": table_fields, "views": []}
+
+    def output(self, record: dict, fields: list = None) -> dict:
+        '''
+        the record as the API returns it, empty fields left out
+        '''
+        record_fields = {name: value for name, value in record['fields'].items()
+                         if value is not None and value is not False and value != '' and value != []}
+        if fields is not None:
+            record_fields = {name: value for name, value in record_fields.items() if name in fields}
+        return {"id": record['id'], "createdTime": record['createdTime'], "fields": record_fields}
+
+    def formula_value(self, record: dict, field_name: str):
+        '''
+        what a formula sees for a field
+        linked records show up as their primary field values, lists get joined
+        '''
+        if field_name not in self.fields:
+            raise FormulaError(f"unknown field name: {field_name}")
+        value = record['fields'].get(field_name)
+        linked_table_name = self.fields[field_name].get('linked_table')
+        if linked_table_name and value:
+            linked_table = self.fake.table(self.base_id, linked_table_name)
+            value = [linked_table.records[record_id]['fields'].get(linked_table.primary_field)
+                     for record_id in value if record_id in linked_table.records]
+        if isinstance(value, list):
+            return ', '.join(_to_str(item) for item in value)
+        return value
+
+    def evaluate(self, node: tuple, record: dict):
+        kind = node[0]
+        if kind == 'literal':
+            return node[1]
+        if kind == 'field':
+            return self.formula_value(record, node[1])
+        if kind == 'neg':
+            return -_to_number(self.evaluate(node[1], record))
+        if kind == 'call':
+            args = [self.evaluate(arg, record) for arg in node[2]]
+            return FUNCTIONS[node[1]](record, *args)
+        operator, left, right = node[1], self.evaluate(node[2], record), self.evaluate(node[3], record)
+        if operator == '&':
+            return _to_str(left) + _to_str(right)
+        if operator in '+-*/':
+            left, right = _to_number(left), _to_number(right)
+            if operator == '+':
+                return left + right
+            if operator == '-':
+                return left - right
+            if operator == '*':
+                return left * right
+            return left / right if right else None
+        return _compare(operator, left, right)
+
+    def select(self, formula: str = None) -> list[dict]:
+        records = list(self.records.values())
+        if not formula:
+            return records
+        tree = FormulaParser(formula).parse()
+        return [record for record in records if _truthy(self.evaluate(tree, record))]
+
+    def validate(self, fields: dict, typecast: bool = False):
+        for field_name, value in fields.items():
+            if field_name not in self.fields:
+                raise FakeAirtableError(422, 'UNKNOWN_FIELD_NAME', f'Unknown field name: "{field_name}"')
+            field_info = self.fields[field_name]
+            if field_info['type'] in COMPUTED_TYPES:
+                raise FakeAirtableError(422, 'INVALID_VALUE_FOR_COLUMN',
+                                        f'Field "{field_name}" cannot accept a value because the field is computed')
+            if value in (None, '', []):
+                continue
+            if field_info['type'] in SELECT_TYPES and 'options' in field_info and not typecast:
+                values = value if isinstance(value, list) else [value]
+                for item in values:
+                    if item not in field_info['options']:
+                        raise FakeAirtableError(422, 'INVALID_MULTIPLE_CHOICE_OPTIONS',
+                                                f'Insufficient permissions to create new select option ""{item}""')
+            if 'linked_table' in field_info:
+                linked_table = self.fake.table(self.base_id, field_info['linked_table'])
+                if not isinstance(value, list) or any(record_id not in linked_table.records
+                                                      for record_id in value):
+                    raise FakeAirtableError(422, 'ROW_DOES_NOT_EXIST',
+                                            f'Record ID in field "{field_name}" does not exist')
+
+    def create(self, fields: dict, typecast: bool = False, validate: bool = True) -> dict:
+        if validate:
+            self.validate(fields, typecast)
+        record = {"id": self.fake.new_id('rec'),
+                  "createdTime": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                  "fields": dict(fields), "modified": time.time()}
+        for field_name, field_info in self.fields.items():
+            if field_info['type'] == 'autoNumber':
+                record['fields'][field_name] = next(self._auto_numbers)
+        self.records[record['id']] = record
+        return record
+
+    def get(self, record_id: str) -> dict:
+        try:
+            return self.records[record_id]
+        except KeyError:
+            raise FakeAirtableError(404, 'NOT_FOUND', 'Could not find what you are looking for')
+
+    def update(self, record_id: str, fields: dict, replace: bool = False,
+               typecast: bool = False) -> dict:
+        record = self.get(record_id)
+        self.validate(fields, typecast)
+        if replace:
+            record['fields'] = {name: value for name, value in record['fields'].items()
+                                if self.fields[name]['type'] in COMPUTED_TYPES}
+        record['fields'].update(fields)
+        record['modified'] = time.time()
+        return record
+
+
+class FakeAirtable:
+    '''
+    in-memory Airtable bases, served over HTTP on localhost
+    point pyairtable at it with Api(..., endpoint_url=fake.url)
+    '''
+
+    def __init__(self):
+        self.bases = {}
+        self.requests = []
+        self.url = None
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}{next(self._ids):014d}"
+
+    def add_table(self, base_id: str, name: str, fields: dict,
+                  primary_field: str = None) -> FakeTable:
+        '''
+        fields are name -> type, or name -> {"type", "options", "linked_table"}
+        the first field is the primary field unless primary_field says otherwise
+        '''
+        table = FakeTable(self, base_id, self.new_id('tbl'), name, fields, primary_field)
+        self.bases.setdefault(base_id, {})[name] = table
+        return table
+
+    def table(self, base_id: str, table_name: str) -> FakeTable:
+        '''
+        looks up a table by name or id
+        '''
+        tables = self.bases.get(base_id)
+        if tables is None:
+            raise FakeAirtableError(404, 'NOT_FOUND', f"base {base_id} not found")
+        if table_name in tables:
+            return tables[table_name]
+        for table in tables.values():
+            if table.id == table_name:
+                return table
+        raise FakeAirtableError(404, 'TABLE_NOT_FOUND', f"table {table_name} not found")
+
+    def add_records(self, base_id: str, table_name: str, records: list[dict]) -> list[dict]:
+        '''
+        seeds a table, records are dicts of field values
+        computed fields can be seeded too
+        returns the records as the API would
+        '''
+        table = self.table(base_id, table_name)
+        with self._lock:
+            return [table.output(table.create(fields, validate=False)) for fields in records]
+
+    def records(self, base_id: str, table_name: str) -> list[dict]:
+        table = self.table(base_id, table_name)
+        return [table.output(record) for record in table.records.values()]
+
+    def reset_requests(self):
+        self.requests.clear()
+
+    def count(self, method: str = None, table_name: str = None) -> int:
+        '''
+        number of requests made, optionally only of one method/ to one table
+        '''
+        return len([request for request in self.requests
+                    if (method is None or request['method'] == method)
+                    and (table_name is None or request['table'] == table_name)])
+
+    def start(self) -> str:
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAirtableHandler)
+        self._server.fake = self
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _list(self, table: FakeTable, options: dict) -> dict:
+        records = table.select(options.get('filterByFormula'))
+        if options.get('maxRecords'):
+            records = records[:int(options['maxRecords'])]
+        start = int(options.get('offset') or 0)
+        page_size = min(int(options.get('pageSize') or MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+        page = records[start:start + page_size]
+        response = {"records": [table.output(record, options.get('fields')) for record in page]}
+        if start + page_size < len(records):
+            response['offset'] = str(start + page_size)
+        return response
+
+    @staticmethod
+    def _check_batch(records: list):
+        if not isinstance(records, list) or not records:
+            raise FakeAirtableError(422, 'INVALID_REQUEST_MISSING_FIELDS', 'Could not find field "records"')
+        if len(records) > MAX_RECORDS_PER_REQUEST:
+            raise FakeAirtableError(422, 'INVALID_RECORDS',
+                                    f"You can only send up to {MAX_RECORDS_PER_REQUEST} records per request")
+
+    def _upsert(self, table: FakeTable, body: dict, replace: bool) -> dict:
+        merge_fields = body['performUpsert']['fieldsToMergeOn']
+        typecast = body.get('typecast', False)
+        keys = [tuple(json.dumps(record['fields'].get(field)) for field in merge_fields)
+                for record in body['records']]
+        if len(set(keys)) != len(keys):
+            raise FakeAirtableError(422, 'INVALID_RECORDS',
+                                    'Cannot update the same record multiple times in one request')
+        response = {"records": [], "createdRecords": [], "updatedRecords": []}
+        for record_in, key in zip(body['records'], keys):
+            matches = [record for record in table.records.values()
+                       if tuple(json.dumps(record['fields'].get(field)) for field in merge_fields) == key]
+            if len(matches) > 1:
+                raise FakeAirtableError(422, 'INVALID_RECORDS',
+                                        'Cannot upsert: more than one record matches fieldsToMergeOn')
+            if matches:
+                record = table.update(matches[0]['id'], record_in['fields'], replace, typecast)
+                response['updatedRecords'].append(record['id'])
+            else:
+                record = table.create(record_in['fields'], typecast)
+                response['createdRecords'].append(record['id'])
+            response['records'].append(table.output(record))
+        return response
+
+    def dispatch(self, method: str, parts: list, query: dict, body: dict) -> tuple[int, dict]:
+        '''
+        routes a request, returns the status and the JSON response
+        '''
+        if len(parts) < 3 or parts[0] != 'v0':
+            raise FakeAirtableError(404, 'NOT_FOUND', 'Could not find what you are looking for')
+        if parts[1] == 'meta':
+            if method == 'GET' and len(parts) == 5 and parts[2] == 'bases' and parts[4] == 'tables':
+                tables = self.bases.get(parts[3])
+                if tables is None:
+                    raise FakeAirtableError(404, 'NOT_FOUND', f"base {parts[3]} not found")
+                return 200, {"tables": [table.schema() for table in tables.values()]}
+            raise FakeAirtableError(404, 'NOT_FOUND', 'Could not find what you are looking for')
+        table = self.table(parts[1], parts[2])
+        typecast = body.get('typecast', False)
+        if len(parts) == 3:
+            if method == 'GET':
+                options = {"filterByFormula": query.get('filterByFormula', [None])[0],
+                           "pageSize": query.get('pageSize', [None])[0],
+                           "offset": query.get('offset', [None])[0],
+                           "maxRecords": query.get('maxRecords', [None])[0],
+                           "fields": query.get('fields[]')}
+                return 200, self._list(table, options)
+            if method == 'POST':
+                if 'records' not in body:
+                    return 200, table.output(table.create(body.get('fields', {}), typecast))
+                self._check_batch(body['records'])
+                return 200, {"records": [table.output(table.create(record['fields'], typecast))
+                                         for record in body['records']]}
+            if method in ('PATCH', 'PUT'):
+                self._check_batch(body.get('records'))
+                if 'performUpsert' in body:
+                    return 200, self._upsert(table, body, method == 'PUT')
+                return 200, {"records": [table.output(table.update(record['id'], record['fields'],
+                                                                   method == 'PUT', typecast))
+                                         for record in body['records']]}
+            if method == 'DELETE':
+                record_ids = query.get('records[]', [])
+                self._check_batch(record_ids)
+                for record_id in record_ids:
+                    table.get(record_id)
+                for record_id in record_ids:
+                    del table.records[record_id]
+                return 200, {"records": [{"id": record_id, "deleted": True} for record_id in record_ids]}
+        elif len(parts) == 4:
+            if parts[3] == 'listRecords' and method == 'POST':
+                return 200, self._list(table, body)
+            if method == 'GET':
+                return 200, table.output(table.get(parts[3]))
+            if method in ('PATCH', 'PUT'):
+                return 200, table.output(table.update(parts[3], body.get('fields', {}),
+                                                      method == 'PUT', typecast))
+            if method == 'DELETE':
+                table.get(parts[3])
+                del table.records[parts[3]]
+                return 200, {"id": parts[3], "deleted": True}
+        raise FakeAirtableError(404, 'NOT_FOUND', 'Could not find what you are looking for')
+
+
+class FakeAirtableHandler(BaseHTTPRequestHandler):
+    '''
+    turns HTTP requests into FakeAirtable.dispatch() calls
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method: str):
+        started = time.perf_counter()
+        fake = self.server.fake
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part]
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        try:
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                raise FakeAirtableError(401, 'AUTHENTICATION_REQUIRED', 'Authentication required')
+            with fake._lock:
+                status, payload = fake.dispatch(method, parts, query, body)
+        except FakeAirtableError as exc:
+            status, payload = exc.status, {"error": {"type": exc.error_type, "message": exc.message}}
+        data = json.dumps(payload).encode('utf-8')
+        # logged before answering, so the client never sees a response that isn't counted yet
+        fake.requests.append({"method": method, "path": url.path,
+                              "table": parts[2] if len(parts) > 2 and parts[1] != 'meta' else None,
+                              "status": status, "bytes": len(data),
+                              "seconds": time.perf_counter() - started})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+FIELD_MAPPINGS_FILEPATH = pathlib.Path(__file__).parent.parent / 'avmpi_scripts' / 'field_mappings.json'
+FIELD_TYPES = {'singleSelect': 'singleSelect', 'multipleSelect': 'multipleSelects',
+               'number': 'number', 'float': 'number', 'integer': 'number',
+               'date': 'date', 'duration': 'duration', 'barcode': 'barcode'}
+LINKED_TABLES = {'Digital Assets': 'Digital Assets', 'Digital Asset': 'Digital Assets',
+                 'Original Physical Asset': 'Physical Assets', 'Asset': 'Physical Assets',
+                 'Physical Format': 'AV Formats', 'Collection': 'Collections',
+                 'Current Location': 'Locations', 'Delivery Location': 'Locations',
+                 'Container': 'Containers', 'Generation': 'Generations',
+                 'Equipment Used - Asset Action': 'ALL SI AV EQUIPMENT',
+                 'Equipment Used - Digitization': 'ALL SI AV EQUIPMENT'}
+
+
+def _mapped_fields(field_maps: dict, obj_type: str, field_type: str = None) -> dict:
+    '''
+    the Airtable fields in a field map, with their types
+    field_type overrides the type, e.g. for the computed BWF fields
+    '''
+    table_fields = {}
+    for mapping in field_maps[obj_type].values():
+        if not isinstance(mapping, dict):
+            continue
+        atbl = mapping.get('atbl')
+        if isinstance(atbl, dict):
+            name, mapped_type = atbl['name'], FIELD_TYPES.get(atbl.get('type'), 'singleLineText')
+        else:
+            name, mapped_type = atbl, 'singleLineText'
+        if not name:
+            continue
+        if name in LINKED_TABLES:
+            table_fields[name] = {"type": "multipleRecordLinks", "linked_table": LINKED_TABLES[name]}
+        else:
+            table_fields[name] = field_type or mapped_type
+    return table_fields
+
+
+def add_assets_base(fake: FakeAirtable, base_id: str):
+    '''
+    empty copies of the tables in the AVMPI Assets base, with the fields the scripts use
+    field types come from field_mappings.json
+    '''
+    with open(FIELD_MAPPINGS_FILEPATH, 'r') as field_map_file:
+        field_maps = json.load(field_map_file)
+    for table_name, primary_field in [('AV Formats', 'Term'), ('Collections', 'Collection Title'),
+                                      ('Locations', 'Name'), ('Containers', 'Container Name'),
+                                      ('Generations', 'Term'), ('Creator Role', 'Name'),
+                                      ('All Projects', 'Name'), ('Works', 'Name')]:
+        fake.add_table(base_id, table_name, {primary_field: 'singleLineText'})
+    fake.add_table(base_id, 'ALL SI AV EQUIPMENT', {"Name": 'singleLineText',
+                                                     "Equip. Barcode": 'singleLineText'})
+    fake.add_table(base_id, 'Physical Assets',
+                   {"Physical Asset ID": 'singleLineText',
+                    **_mapped_fields(field_maps, 'PhysicalAssetRecord')})
+    digital_asset_fields = {"Digital Asset ID": 'singleLineText',
+                            **_mapped_fields(field_maps, 'DigitalAssetRecord'),
+                            **_mapped_fields(field_maps, 'BroadcastWaveFile', 'formula'),
+                            **_mapped_fields(field_maps, 'BWFDescription', 'formula')}
+    digital_asset_fields['Transfer Issue-Anomaly Notes'] = 'multilineText'
+    fake.add_table(base_id, 'Digital Assets', digital_asset_fields)
+    fake.add_table(base_id, 'Physical Asset Action Log',
+                   {"Name": 'formula', "Auto ID #": 'autoNumber',
+                    **_mapped_fields(field_maps, 'PhysicalAssetActionRecord'),
+                    "Equipment Used - Asset Action": {"type": "multipleRecordLinks",
+                                                      "linked_table": 'ALL SI AV EQUIPMENT'},
+                    "Equipment Used - Digitization": {"type": "multipleRecordLinks",
+                                                      "linked_table": 'ALL SI AV EQUIPMENT'}})
+    fake.add_table(base_id, 'QC Log',
+                   {"Name": 'formula',
+                    "Digital Asset": {"type": "multipleRecordLinks", "linked_table": 'Digital Assets'},
+                    "MediaConch": {"type": 'singleSelect', "options": ['Pass', 'Fail', 'In Progress']},
+                    "QC Issues": 'multilineText', "QC Start": 'date'})
@@ -0,0 +1,63 @@
+'''
+tests add_equip_aal.py
+'''
+import time
+import pytest
+import add_equip_aal
+
+
+class FakeAALTable:
+    '''
+    stands in for the Asset Action Log table, slow to answer like the real thing
+    '''
+
+    def __init__(self, fail_updates: int = 0):
+        self.updates = []
+        self.fail_updates = fail_updates
+
+    def update(self, record_id, fields):
+        time.sleep(0.2)
+        if self.fail_updates:
+            self.fail_updates -= 1
+            raise ConnectionError("Airtable didn't answer")
+        self.updates.append((record_id, {field: list(value) for field, value in fields.items()}))
+
+
+def test_aal_writer_coalesces_scans():
+    fake_table = FakeAALTable()
+    field = 'Equipment Used - Digitization'
+    writer = add_equip_aal.AALWriter(fake_table, 'recAAL', field, ['recEQP0'], coalesce_seconds=0.1)
+    writer.start()
+    for i in range(1, 6):
+        writer.add(f"recEQP{i}")
+    writer.close()
+    assert fake_table.updates == [('recAAL', {field: [f"recEQP{i}" for i in range(6)]})]
+    assert not writer.is_alive()
+
+
+def test_aal_writer_flushes_on_close():
+    fake_table = FakeAALTable()
+    field = 'Equipment Used - Asset Action'
+    writer = add_equip_aal.AALWriter(fake_table, 'recAAL', field, [], coalesce_seconds=0.05)
+    writer.start()
+    writer.add('recEQP1')
+    time.sleep(0.1)
+    # arrives while the first update is in flight
+    writer.add('recEQP2')
+    writer.close()
+    assert [update[1][field] for update in fake_table.updates] == [['recEQP1'], ['recEQP1', 'recEQP2']]
+
+
+def test_aal_writer_raises_on_close_if_scans_failed():
+    fake_table = FakeAALTable(fail_updates=1)
+    field = 'Equipment Used - Asset Action'
+    writer = add_equip_aal.AALWriter(fake_table, 'recAAL', field, ['recEQP0'], coalesce_seconds=0.05)
+    writer.start()
+    writer.add('recEQP1')
+    time.sleep(0.1)
+    writer.add('recEQP2')
+    with pytest.raises(RuntimeError, match='recEQP1'):
+        writer.close()
+    assert writer.failed == ['recEQP1']
+    # the failed scan isn't in the later update, which still goes through
+    assert fake_table.updates == [('recAAL', {field: ['recEQP0', 'recEQP2']})]
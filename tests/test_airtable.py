@@ -2,9 +2,12 @@
 tests the Airtable module
 '''
 import os
+import re
 import pytest
 import pathlib
-import avmpi_scripts.airtable.airtable as airtable
+from datetime import date, datetime, time, timedelta
+import avmpi_scripts.services.airtable.airtable as airtable
+import avmpi_scripts.services.excel.excel as excel
 
 is_github_actions = os.getenv('GITHUB_ACTIONS') == 'true'
 '''
@@ -23,3 +26,380 @@ def test_get_field_map():
 def test_connect_one_base():
     atbl_base = airtable.connect_one_base('Assets')
     assert atbl_base['Physical Assets']
+
+
+class FakePagedTable:
+    '''
+    stands in for pyairtable.Table, serves records a page at a time
+    '''
+
+    def __init__(self, records: list, page_size: int = 100):
+        self.records = records
+        self.page_size = page_size
+        self.base = type('FakeBase', (), {'id': 'appFAKE'})()
+        self.name = 'Digital Assets'
+        self.page_requests = 0
+        self.formula_queries = 0
+        self.read_options = []
+
+    def iterate(self, **options):
+        self.read_options.append(options)
+        for start in range(0, len(self.records), self.page_size):
+            self.page_requests += 1
+            yield self.records[start:start + self.page_size]
+
+    def all(self, **options):
+        self.read_options.append(options)
+        self.formula_queries += 1
+        return []
+
+
+def test_prefetch_find():
+    records = [{'id': f"rec{i}", 'fields': {'Digital Asset ID': f"daid_{i}.wav", 'Auto ID #': float(i)}}
+               for i in range(2000)]
+    records.append({'id': 'recdupe', 'fields': {'Digital Asset ID': 'daid_7.wav'}})
+    fake_table = FakePagedTable(records)
+    airtable.prefetch(fake_table, ['Digital Asset ID', 'Auto ID #'])
+    try:
+        assert fake_table.page_requests == 21
+        for i in range(100, 2000, 100):
+            assert airtable.find(f"daid_{i}.wav", 'Digital Asset ID', fake_table, True)['id'] == f"rec{i}"
+        assert airtable.find(12, 'Auto ID #', fake_table, True)['id'] == 'rec12'
+        assert airtable.find('nope.wav', 'Digital Asset ID', fake_table) is None
+        assert len(airtable.find('daid_7.wav', 'Digital Asset ID', fake_table)) == 2
+        with pytest.raises(RuntimeError):
+            airtable.find('daid_7.wav', 'Digital Asset ID', fake_table, True)
+        assert fake_table.formula_queries == 0
+        airtable.get_table_index(fake_table).remove('recdupe')
+        assert airtable.find('daid_7.wav', 'Digital Asset ID', fake_table, True)['id'] == 'rec7'
+        # fields that weren't indexed still go to Airtable
+        airtable.find('x', 'Notes', fake_table)
+        assert fake_table.formula_queries == 1
+    finally:
+        airtable.clear_prefetch(fake_table)
+
+
+def test_find_fields():
+    records = [{'id': f"rec{i}", 'fields': {'Digital Asset ID': f"daid_{i}.wav", 'Notes': 'long notes'}}
+               for i in range(250)]
+    fake_table = FakePagedTable(records)
+    airtable.find('daid_1.wav', 'Digital Asset ID', fake_table, fields=['Digital Asset ID'])
+    assert fake_table.read_options[-1]['fields'] == ['Digital Asset ID']
+    airtable.prefetch(fake_table, ['Digital Asset ID'])
+    try:
+        result = airtable.find('daid_1.wav', 'Digital Asset ID', fake_table, True, fields=['Digital Asset ID'])
+        assert result == {'id': 'rec1', 'fields': {'Digital Asset ID': 'daid_1.wav'}}
+        # the index itself keeps every field
+        assert airtable.find('daid_1.wav', 'Digital Asset ID', fake_table, True)['fields']['Notes']
+    finally:
+        airtable.clear_prefetch(fake_table)
+
+
+def test_iterate_records():
+    records = [{'id': f"rec{i}", 'fields': {'Digital Asset ID': f"daid_{i}.wav"}} for i in range(250)]
+    fake_table = FakePagedTable(records)
+    record_iter = airtable.iterate_records(fake_table, fields=['Digital Asset ID'])
+    assert next(record_iter)['id'] == 'rec0'
+    # only the first page has been read so far
+    assert fake_table.page_requests == 1
+    assert fake_table.read_options[-1] == {'fields': ['Digital Asset ID']}
+    assert len(list(record_iter)) == 249
+    assert fake_table.page_requests == 3
+    pages = airtable.find_pages('daid_1.wav', 'Digital Asset ID', fake_table, fields=['Digital Asset ID'])
+    next(pages)
+    assert str(fake_table.read_options[-1]['formula']) == "{Digital Asset ID}='daid_1.wav'"
+
+
+class FakeLinkedTable(FakePagedTable):
+    '''
+    linked table that counts searches and creates
+    '''
+
+    def __init__(self, records: list):
+        super().__init__(records)
+        self.created = []
+
+    def iterate(self, formula=None, **options):
+        self.formula_queries += 1
+        terms = re.findall(r"\{(.*?)\}='(.*?)'", str(formula))
+        yield [record for record in self.records
+               if any(record['fields'].get(field) == value for field, value in terms)]
+
+    def create(self, fields):
+        record = {'id': f"recnew{len(self.created)}", 'fields': fields}
+        self.created.append(record)
+        return record
+
+
+def test_link_resolver():
+    collections = FakeLinkedTable([{'id': 'recC1', 'fields': {'Collection Title': 'NMAI'}}])
+    resolver = airtable.LinkResolver({'Collections': collections})
+    for _ in range(3):
+        assert resolver.resolve('Collections', 'Collection Title', 'NMAI') == 'recC1'
+        assert resolver.resolve('Collections', 'Collection Title', 'New Collection') == 'recnew0'
+    # 1 search for each term, then answered from cache
+    assert collections.formula_queries == 2
+    assert len(collections.created) == 1
+
+
+def test_link_resolver_prefetch():
+    formats = FakeLinkedTable([{'id': f"recF{i}", 'fields': {'Term': f"format {i}"}} for i in range(2500)])
+    resolver = airtable.LinkResolver({'AV Formats': formats})
+    terms = [f"format {i}" for i in range(0, 2500, 10)] + ['Generations']
+    assert resolver.prefetch('AV Formats', 'Term', terms) == 250
+    # only the terms in the sheet are searched for, a handful per query
+    assert formats.page_requests == 0
+    assert formats.formula_queries < 10
+    queries = formats.formula_queries
+    assert resolver.prefetch('AV Formats', 'Term', terms) == 0
+    assert resolver.resolve('AV Formats', 'Term', 'format 2490') == 'recF2490'
+    assert resolver.resolve('AV Formats', 'Term', 'Generations', create=False) is None
+    assert formats.formula_queries == queries
+
+
+def fake_base_schema(base_id: str) -> dict:
+    fake_base_schema.calls += 1
+    return {"base_id": base_id, "fetched_at": airtable.time.time(),
+            "tables": {"Physical Assets": {"id": "tblPA", "primary_field": "Physical Asset ID",
+                                           "fields": {"Physical Asset ID": {"id": "fld1", "type": "singleLineText"},
+                                                      "Size Type": {"id": "fld2", "type": "singleSelect",
+                                                                    "options": ["Feet", "Minutes"]}}}}}
+
+
+def test_base_schema_cache(monkeypatch, tmp_path):
+    fake_base_schema.calls = 0
+    monkeypatch.setattr(airtable, '_fetch_base_schema', fake_base_schema)
+    monkeypatch.setattr(airtable, 'get_cache_dir', lambda: tmp_path)
+    monkeypatch.setattr(airtable, '_base_schemas', {})
+    for _ in range(5):
+        assert airtable.PhysicalAssetRecord._get_primary_field_name() == 'Physical Asset ID'
+    assert fake_base_schema.calls == 1
+    # next run loads it from disk
+    monkeypatch.setattr(airtable, '_base_schemas', {})
+    table_schema = airtable.PhysicalAssetRecord.get_table_schema()
+    assert table_schema['fields']['Size Type']['options'] == ['Feet', 'Minutes']
+    assert fake_base_schema.calls == 1
+    airtable.get_base_schema(airtable.PhysicalAssetRecord.meta.base_id, refresh=True)
+    assert fake_base_schema.calls == 2
+    # half a file, e.g. from an older version writing it while this one read it, is fetched again
+    schema_filepath = tmp_path / f"schema_{airtable.PhysicalAssetRecord.meta.base_id}.json"
+    schema_filepath.write_text(schema_filepath.read_text()[:50])
+    monkeypatch.setattr(airtable, '_base_schemas', {})
+    assert airtable.PhysicalAssetRecord._get_primary_field_name() == 'Physical Asset ID'
+    assert fake_base_schema.calls == 3
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_converters():
+    assert airtable.convert_barcode(39088012345678.0) == '39088012345678'
+    assert airtable.convert_secondary_asset_id(1234.0) == '1234'
+    assert airtable.convert_secondary_asset_id('NMAH-1') == 'NMAH-1'
+    assert airtable.convert_size_value('7 in.') == 7
+    assert airtable.convert_size_value('7.5"') == 7.5
+    assert airtable.convert_size_value(1200) == 1200
+    assert airtable.convert_duration('05:30') == timedelta(minutes=5, seconds=30)
+    assert airtable.convert_duration('1:05:30') == timedelta(hours=1, minutes=5, seconds=30)
+    assert airtable.convert_duration('unknown') == 'unknown'
+    assert airtable.convert_date('2024-02-09') == datetime(2024, 2, 9)
+    assert airtable.convert_date('Feb 2024') is None
+    assert airtable.convert_multi_select('Ampex,Scotch') == ['Ampex', 'Scotch']
+
+
+
+def test_converters_take_what_validation_passes():
+    '''
+    anything excel.validate_rows() lets through has to convert, and be accepted by the field
+    '''
+    checked_values = {
+        'asset_barcode': (excel.is_barcode, [33901000000018, 33901000000018.0, '33901000000018',
+                                             '33901000000018.0', ' 33901000000018 ']),
+        'size_value': (excel.is_size_value, [7, 7.5, '7', '7 in.', '7.5 in.', '1200ft', '.5 in']),
+        'asset_duration': (excel.is_duration, ['5:03', '75:30', '1:02:03', ' 1:02:03 ', 90, 90.5,
+                                               time(1, 2, 3), timedelta(minutes=5), datetime(1900, 1, 1, 12)]),
+        'asset_creation_date': (excel.is_date, ['2024-01-02', ' 2024-01-02', date(2024, 1, 2),
+                                                datetime(2024, 1, 2)]),
+    }
+    record_classes = {'asset_barcode': airtable.PhysicalAssetRecord, 'size_value': airtable.PhysicalAssetRecord,
+                      'asset_duration': airtable.DigitalAssetRecord,
+                      'asset_creation_date': airtable.DigitalAssetRecord}
+    for attr_name, (check, values) in checked_values.items():
+        for value in values:
+            assert check(value), (attr_name, value)
+            converted = airtable.attr_converters[attr_name](value)
+            assert converted is not None, (attr_name, value)
+            setattr(record_classes[attr_name](), attr_name, converted)
+    assert airtable.convert_barcode('33901000000018.0') == '33901000000018'
+    assert airtable.convert_size_value('7.5 in.') == 7.5
+    assert airtable.convert_duration(time(1, 2, 3)) == timedelta(hours=1, minutes=2, seconds=3)
+    assert airtable.convert_duration(90) == timedelta(seconds=90)
+    assert airtable.convert_duration(datetime(1900, 1, 1, 12)) == timedelta(days=1, hours=12)
+
+
+
+def test_from_xlsx_csv_manifest(tmp_path):
+    '''
+    every cell in a CSV is text, number fields have to be converted
+    '''
+    csv_filepath = tmp_path / 'Assets-Unit-Provided-template.csv'
+    csv_filepath.write_text("physical_asset_id,Speed,size_value,asset_barcode\n"
+                            "SIA09-043_V0003OM,7.5,7 in.,33901000000018\n"
+                            "SIA09-043_V0004OM,15,10,\n"
+                            "SIA09-043_V0005OM,fast,10,\n")
+    rows = excel.load_all_worksheets(csv_filepath)['Assets-Unit-Provided-template']
+    first = airtable.PhysicalAssetRecord().from_xlsx(rows[2])
+    assert (first.speed, first.size_value, first.asset_barcode) == (7.5, 7, '33901000000018')
+    assert airtable.PhysicalAssetRecord().from_xlsx(rows[3]).speed == 15
+    problems = [problem for problem in excel.validate_rows(rows, 'PhysicalAssetRecord')
+                if problem['problem'] != "required, but empty"]
+    assert [(problem['row'], problem['field']) for problem in problems] == [(4, 'speed')]
+
+
+def test_compile_conversion_plan():
+    field_map = airtable.get_field_map('PhysicalAssetRecord')
+    plan = airtable.compile_conversion_plan(airtable.PhysicalAssetRecord, field_map)
+    assert plan is airtable.compile_conversion_plan(airtable.PhysicalAssetRecord, field_map)
+    steps = {step.attr_name: step for step in plan}
+    assert steps['physical_asset_id'].column == 'A'
+    assert steps['size_value'].converter is airtable.convert_size_value
+    assert steps['Collection'].is_link
+    # mapped to XLSX but not to Airtable
+    assert 'general_notes' not in steps
+
+
+def test_fake_airtable(fake_airtable):
+    '''
+    the helpers, over HTTP, against the local stand-in for Airtable
+    '''
+    base_id = airtable.config()['bases']['Assets']['base_id']
+    fake_airtable.add_records(base_id, 'Digital Assets',
+                              [{"Digital Asset ID": f"daid_{i}.wav", "Asset Size": i} for i in range(150)])
+    atbl_base = airtable.connect_one_base('Assets')
+    atbl_tbl = atbl_base['Digital Assets']
+    airtable.use_mirror(False)
+    result = airtable.find('daid_7.wav', 'Digital Asset ID', atbl_tbl, True, fields=['Digital Asset ID'])
+    assert result['fields'] == {'Digital Asset ID': 'daid_7.wav'}
+    assert airtable.find(149, 'Asset Size', atbl_tbl, True)['fields']['Digital Asset ID'] == 'daid_149.wav'
+    assert len(list(airtable.iterate_records(atbl_tbl, fields=['Digital Asset ID']))) == 150
+    assert fake_airtable.count('GET', 'Digital Assets') == 4
+    created = atbl_tbl.create({"Digital Asset ID": "new.wav"})
+    assert airtable.find('new.wav', 'Digital Asset ID', atbl_tbl, True)['id'] == created['id']
+    schema = airtable.get_table_schema(base_id, 'QC Log')
+    assert schema['fields']['MediaConch']['options'] == ['Pass', 'Fail', 'In Progress']
+
+
+def test_split_actions():
+    assert airtable.split_actions(None) == ['A-D Transfer']
+    assert airtable.split_actions('Cleaning; Baking;') == ['Cleaning', 'Baking']
+    assert airtable.split_actions('Cleaning, Baking') == ['Cleaning', 'Baking']
+    assert airtable.split_actions('Cleaning') == ['Cleaning']
+
+
+def test_or_formulas():
+    clauses = [airtable.match({'Asset': f"paid_{i}"}) for i in range(100)]
+    formulas = list(airtable.or_formulas(clauses, max_length=200))
+    assert len(formulas) > 1
+    assert all(len(formula) <= 200 for formula in formulas)
+    assert sum(formula.count('{Asset}') for formula in formulas) == 100
+    assert list(airtable.or_formulas(clauses[:1])) == ["OR({Asset}='paid_0')"]
+
+
+def test_plan_asset_actions(fake_airtable):
+    '''
+    one query for the existing log entries of every physical asset in the sheet
+    '''
+    base_id = airtable.config()['bases']['Assets']['base_id']
+    physical_assets = fake_airtable.add_records(base_id, 'Physical Assets',
+                                                [{"Physical Asset ID": f"paid_{i}"} for i in range(3)])
+    fake_airtable.add_records(base_id, 'Physical Asset Action Log',
+                              [{"Asset": [physical_assets[0]['id']], "Activity Type": "A-D Transfer"},
+                               {"Asset": [physical_assets[1]['id']], "Activity Type": "Cleaning"},
+                               {"Asset": [physical_assets[1]['id']], "Activity Type": "Cleaning"}])
+    atbl_recs = []
+    for physical_asset, actions in [(physical_assets[0], 'A-D Transfer; Cleaning'),
+                                    (physical_assets[1], 'Cleaning'),
+                                    (physical_assets[0], None),
+                                    (physical_assets[2], 'Baking')]:
+        atbl_rec_par = airtable.PhysicalAssetRecord.from_id(physical_asset['id'], memoize=True)
+        atbl_recs.append(airtable.PhysicalAssetActionRecord(activity_type=actions,
+                                                            PhysicalAsset=[atbl_rec_par]))
+    fake_airtable.reset_requests()
+    plan = airtable.plan_asset_actions(atbl_recs)
+    assert sorted((fields['Asset'][0], fields['Activity Type']) for fields in plan['create']) == \
+        sorted([(physical_assets[0]['id'], 'Cleaning'), (physical_assets[2]['id'], 'Baking')])
+    assert plan['update'] == []
+    assert plan['unchanged'] == 1
+    assert plan['failed'] == 1
+    assert len(fake_airtable.requests) == 1
+    assert fake_airtable.count('GET', 'Physical Asset Action Log') == 1
+
+
+def test_get_api(fake_airtable):
+    '''
+    one Api, and one pool of connections, for every table and Record() class
+    '''
+    atbl_api = airtable.get_api()
+    assert airtable.get_api() is atbl_api
+    assert airtable.connect_one_base('Assets')['QC Log'].api is atbl_api
+    assert airtable.PhysicalAssetRecord.meta.api is atbl_api
+    assert atbl_api.timeout == (10, 60)
+    adapter = atbl_api.session.get_adapter(fake_airtable.url)
+    assert adapter._pool_maxsize == 10
+    assert adapter.max_retries.connect == 3
+    atbl_tbl = airtable.connect_one_base('Assets')['Digital Assets']
+    for i in range(3):
+        atbl_tbl.create({"Digital Asset ID": f"daid_{i}.wav"})
+    assert len(fake_airtable.records(airtable.config()['bases']['Assets']['base_id'], 'Digital Assets')) == 3
+
+
+def test_find_many(fake_airtable, monkeypatch):
+    '''
+    hundreds of values in a handful of requests, with duplicates flagged
+    '''
+    base_id = airtable.config()['bases']['Assets']['base_id']
+    fake_airtable.add_records(base_id, 'Digital Assets',
+                              [{"Digital Asset ID": f"daid_{i}.wav", "Asset Size": i} for i in range(400)])
+    fake_airtable.add_records(base_id, 'Digital Assets', [{"Digital Asset ID": "daid_5.wav"}])
+    atbl_tbl = airtable.connect_one_base('Assets')['Digital Assets']
+    airtable.use_mirror(False)
+    daids = [f"daid_{i}.wav" for i in range(0, 800, 2)]
+    results = airtable.find_many(daids, 'Digital Asset ID', atbl_tbl, fields=['Asset Size'])
+    assert list(results) == daids
+    assert results['daid_398.wav'][0]['fields'] == {'Asset Size': 398}
+    assert results['daid_400.wav'] == []
+    assert sum(1 for records in results.values() if records) == 200
+    assert fake_airtable.count('GET', 'Digital Assets') + fake_airtable.count('POST', 'Digital Assets') < 10
+    assert airtable.find_many([398, 7], 'Asset Size', atbl_tbl, True)[7]['fields']['Digital Asset ID'] == 'daid_7.wav'
+    assert len(airtable.find_many(['daid_5.wav'], 'Digital Asset ID', atbl_tbl)['daid_5.wav']) == 2
+    with pytest.raises(RuntimeError):
+        airtable.find_many(['daid_4.wav', 'daid_5.wav'], 'Digital Asset ID', atbl_tbl, True)
+    # from the mirror, no requests after the sync
+    airtable.use_mirror(True)
+    airtable.find_many(['daid_3.wav'], 'Digital Asset ID', atbl_tbl)
+    fake_airtable.reset_requests()
+    results = airtable.find_many(daids[:100], 'Digital Asset ID', atbl_tbl, True)
+    assert results['daid_198.wav']['fields']['Asset Size'] == 198
+    assert len(fake_airtable.requests) == 0
+
+
+def test_hydrate(fake_airtable):
+    '''
+    linked records stay bare ids, and are loaded in bulk when their fields are needed
+    '''
+    base_id = airtable.config()['bases']['Assets']['base_id']
+    physical_assets = fake_airtable.add_records(base_id, 'Physical Assets',
+                                                [{"Physical Asset ID": f"paid_{i}"} for i in range(50)])
+    record_ids = [record['id'] for record in physical_assets]
+    airtable.use_mirror(False)
+    atbl_recs = airtable.load_records(airtable.PhysicalAssetRecord, record_ids[:30])
+    assert [atbl_rec.physical_asset_id for atbl_rec in atbl_recs] == [f"paid_{i}" for i in range(30)]
+    assert len(fake_airtable.requests) == 1
+    atbl_rec_par = airtable.PhysicalAssetActionRecord()._set_link_field('PhysicalAsset', 'paid_40')[0]
+    assert atbl_rec_par.id == record_ids[40] and not atbl_rec_par.physical_asset_id
+    fake_airtable.reset_requests()
+    airtable.use_mirror(True)
+    airtable.hydrate([atbl_rec_par, *atbl_recs])
+    assert atbl_rec_par.physical_asset_id == 'paid_40'
+    # already loaded ones are left alone, and the rest come from the mirror after its sync
+    assert len(fake_airtable.requests) == 1
+    with pytest.raises(RuntimeError):
+        airtable.load_records(airtable.PhysicalAssetRecord, ['recMISSING'])
@@ -0,0 +1,99 @@
+'''
+request budgets for each workflow, run against the local FakeAirtable
+
+each benchmark fails if its workflow makes more Airtable requests,
+or takes longer, than the budget recorded in request_budgets.json
+after making a workflow cheaper, record the new numbers with
+AVMPI_RECORD_BUDGETS=true python -m pytest tests/test_benchmarks.py
+'''
+import os
+import json
+import time
+import logging
+import pathlib
+import excel2airtable
+import validate_media
+import files
+
+BUDGETS_FILEPATH = pathlib.Path(__file__).parent / 'request_budgets.json'
+VENDOR_FILEPATH = pathlib.Path(__file__).parent / 'Vendor-AssetsMetadata-template20240307_tests.xlsx'
+BASE_ID = 'appU0Fh8L9xVZBeok'
+record_budgets = os.getenv('AVMPI_RECORD_BUDGETS') == 'true'
+
+
+def check_budget(workflow: str, fake_airtable, seconds: float):
+    '''
+    compares a workflow's request count and wall time to its budget
+    or records them as the new budget
+    '''
+    with open(BUDGETS_FILEPATH, 'r') as budgets_file:
+        budgets = json.load(budgets_file)
+    requests_made = len(fake_airtable.requests)
+    if record_budgets:
+        # time varies a lot between machines, so its budget has plenty of headroom
+        budgets[workflow] = {"requests": requests_made, "seconds": max(5.0, round(seconds * 5, 1))}
+        with open(BUDGETS_FILEPATH, 'w') as budgets_file:
+            json.dump(budgets, budgets_file, indent=4)
+            budgets_file.write('\n')
+        return
+    budget = budgets[workflow]
+    assert requests_made <= budget['requests'], \
+        f"{workflow} made {requests_made} Airtable requests, budget is {budget['requests']}"
+    assert seconds <= budget['seconds'], \
+        f"{workflow} took {seconds:.1f} seconds, budget is {budget['seconds']}"
+
+
+def test_excel2airtable_batch(fake_airtable, monkeypatch):
+    monkeypatch.setattr(excel2airtable, 'logger', logging.getLogger('main_logger'), raising=False)
+    fake_airtable.add_records(BASE_ID, 'Physical Assets',
+                              [{"Physical Asset ID": paid} for paid in
+                               ['SIA09-043_V0003OM', 'SIA09-043_V0004OM', 'sihsfa_LINKER_U14',
+                                'SIA19-095_V0001EM', 'SIA16-090_V0454B']])
+    kwvars = {'input': VENDOR_FILEPATH, 'input_validation': False, 'sheet': None, 'row': 0,
+              'batch': True, 'refresh_schema': False, 'retry_failed': False, 'fresh': False,
+              'workers': 4, 'workbook_cache': True, 'rows': None, 'shard': None, 'results_json': None,
+              'create_links': False}
+    start = time.perf_counter()
+    excel2airtable.excel_to_airtable(kwvars)
+    seconds = time.perf_counter() - start
+    assert len(fake_airtable.records(BASE_ID, 'Digital Assets')) == 4
+    assert len(fake_airtable.records(BASE_ID, 'Physical Asset Action Log')) == 8
+    check_budget('excel2airtable_batch', fake_airtable, seconds)
+
+
+def test_validate_media_qc_sync(fake_airtable):
+    digital_assets = fake_airtable.add_records(BASE_ID, 'Digital Assets',
+                                               [{"Digital Asset ID": f"daid_{i}.mkv"} for i in range(200)])
+    fake_airtable.add_records(BASE_ID, 'QC Log',
+                              [{"Digital Asset": [record['id']], "MediaConch": "Fail"}
+                               for record in digital_assets[:100]])
+    passes = [{'daid': f"daid_{i}.mkv"} for i in range(0, 200, 2)]
+    fails = [{'daid': f"daid_{i}.mkv", 'log': 'bad'} for i in range(1, 200, 2)]
+    start = time.perf_counter()
+    validate_media.send_results_to_airtable(passes, fails, [])
+    seconds = time.perf_counter() - start
+    qc_log = fake_airtable.records(BASE_ID, 'QC Log')
+    assert len(qc_log) == 200
+    assert sum(1 for record in qc_log if record['fields']['MediaConch'] == 'Pass') == 100
+    check_budget('validate_media_qc_sync', fake_airtable, seconds)
+
+
+def test_embed_md_from_airtable(fake_airtable):
+    fake_airtable.add_records(BASE_ID, 'Digital Assets',
+                              [{"Digital Asset ID": f"daid_{i}.wav",
+                                "Originator (BWF)": "US, SI",
+                                "originatorReference (BWF)": f"ref_{i}",
+                                "avmpi_barcode (BWF)": f"3390100000{i:04d}",
+                                "Coding History (BWF)": "A=PCM,F=96000,W=24,M=stereo\nA=PCM",
+                                "IARL (BWF)": "US, SI",
+                                "Copyright (BWF)": "Smithsonian Institution",
+                                "ICRD (BWF)": "2024-01-01",
+                                "Title - Free text (from Original Physical Asset)": ["a title"],
+                                "A-D Transfer - Performed by (BWF)": "a person",
+                                "ISRF (BWF)": "Audio cassette"} for i in range(300)])
+    start = time.perf_counter()
+    bwf = files.BroadcastWaveFile().from_atbl('daid_150.wav')
+    seconds = time.perf_counter() - start
+    assert bwf.originatorReference == 'ref_150'
+    assert bwf.INAM == 'a title'
+    check_budget('embed_md_from_airtable', fake_airtable, seconds)
@@ -0,0 +1,53 @@
+'''
+tests the per-run Airtable call instrumentation
+'''
+import json
+import avmpi_scripts.services.airtable.airtable as airtable
+import avmpi_scripts.services.airtable.callstats as callstats
+
+
+def test_describe_request():
+    url = 'https://api.airtable.com/v0/appU0Fh8L9xVZBeok/QC%20Log'
+    assert callstats.describe_request('GET', url) == ('QC Log', 'list')
+    assert callstats.describe_request('POST', url + '/listRecords') == ('QC Log', 'list')
+    assert callstats.describe_request('GET', url + '/rec123') == ('QC Log', 'get')
+    assert callstats.describe_request('POST', url) == ('QC Log', 'create')
+    assert callstats.describe_request('PATCH', url, {'records': []}) == ('QC Log', 'update')
+    assert callstats.describe_request('PATCH', url, {'performUpsert': {}}) == ('QC Log', 'upsert')
+    assert callstats.describe_request('PATCH', url + '/rec123') == ('QC Log', 'update')
+    assert callstats.describe_request('GET', 'https://api.airtable.com/v0/meta/bases/appU0Fh8L9xVZBeok/tables') \
+        == ('meta', 'schema')
+
+
+def test_summary():
+    call_stats = callstats.CallStats()
+    for ms in range(1, 101):
+        call_stats.record('QC Log', 'list', 200, 10, ms / 1000)
+    call_stats.record('QC Log', 'create', 422, 5, 0.01)
+    call_stats.record('QC Log', 'create', None, 0, 0.02, waited=0.5)
+    rows = {(row['table'], row['operation']): row for row in call_stats.summary()}
+    assert rows[('QC Log', 'list')]['calls'] == 100
+    assert rows[('QC Log', 'list')]['bytes'] == 1000
+    assert (rows[('QC Log', 'list')]['p50_ms'], rows[('QC Log', 'list')]['p95_ms'],
+            rows[('QC Log', 'list')]['p99_ms']) == (50, 95, 99)
+    assert rows[('QC Log', 'create')]['errors'] == 2
+    assert rows[('QC Log', 'create')]['waited_ms'] == 500
+    assert 'p99 ms' in call_stats.format_summary()
+
+
+def test_call_stats_recorded(fake_airtable, tmp_path):
+    base_id = airtable.config()['bases']['Assets']['base_id']
+    fake_airtable.add_records(base_id, 'Digital Assets', [{"Digital Asset ID": "a.wav"}])
+    atbl_tbl = airtable.connect_one_base('Assets')['Digital Assets']
+    airtable.use_mirror(False)
+    airtable.find('a.wav', 'Digital Asset ID', atbl_tbl, True)
+    airtable.find('b.wav', 'Digital Asset ID', atbl_tbl)
+    atbl_tbl.create({"Digital Asset ID": "b.wav"})
+    json_filepath = tmp_path / 'stats.json'
+    airtable.report_call_stats(json_filepath)
+    with open(json_filepath, 'r') as json_file:
+        stats = json.load(json_file)
+    rows = {(row['table'], row['operation']): row for row in stats['summary']}
+    assert rows[('Digital Assets', 'list')]['calls'] == 2
+    assert rows[('Digital Assets', 'create')]['calls'] == 1
+    assert len(stats['calls']) == len(fake_airtable.requests) == 3
@@ -1,6 +1,11 @@
 '''
 handles testing of excel.py
 '''
+import os
+import csv
+import json
+import datetime
+import pickle
 import pytest
 import pathlib
 from pprint import pformat
@@ -47,3 +52,181 @@ def test_validate_required_fields_bad():
     missing_fields = excel.validate_required_fields(rows, 'PhysicalAssetRecord')
     print(missing_fields)
     assert missing_fields
+
+
+def test_validate_rows(monkeypatch):
+    good = {'A': 'daid.wav', 'B': 'SIA09-043_V0003OM', 'C': 33901000000018.0, 'D': 'Box 1', 'E': 'abc123',
+            'H': 'A=PCM', 'J': '2024-01-02', 'K': 12.5, 'L': '01:02:03'}
+    bad = dict(good, C='Tape 2 of 4', E='  ', J='Jan 2nd', L='99:99')
+    rows = {12: good, 40: bad, 41: dict(good, L='75:30', J=None)}
+    problems = excel.validate_rows(rows, 'DigitalAssetRecord')
+    # every problem, each with the row it's on in the sheet
+    assert [(problem['row'], problem['column']) for problem in problems] == \
+        [(40, 'C'), (40, 'E'), (40, 'J'), (40, 'L')]
+    assert problems[1]['problem'] == "required, but empty"
+    assert 'row 40, column L (asset_duration)' in excel.format_problems(problems)
+    no_container = dict(good, D=None)
+    assert excel.validate_required_fields({40: no_container}, 'DigitalAssetRecord') == [{"row": 40, "columns": ['D']}]
+    assert excel.validate_required_fields([no_container], 'DigitalAssetRecord') == [{"row": 0, "columns": ['D']}]
+    # field_mappings.json is only read once per record type
+    monkeypatch.setattr(excel, 'load_field_mappings', lambda: pytest.fail("field mappings re-read"))
+    assert excel.validate_rows({3: good}, 'DigitalAssetRecord') == []
+
+
+def test_value_checks():
+    assert all(excel.is_barcode(value) for value in [33901000000018, 33901000000018.0, '33901000000018'])
+    assert not any(excel.is_barcode(value) for value in [1.5, 'Tape 2', True])
+    assert all(excel.is_size_value(value) for value in [7, 7.5, '7', '7 in.', '1200ft', '.5 in'])
+    assert not any(excel.is_size_value(value) for value in ['seven', '7-8 in'])
+    assert all(excel.is_duration(value) for value in ['5:03', '75:30', '1:02:03'])
+    assert not any(excel.is_duration(value) for value in ['99:99', '1:2', 'an hour'])
+    assert all(excel.is_date(value) for value in ['2024-01-02', datetime.date(2024, 1, 2)])
+    assert not any(excel.is_date(value) for value in ['01/02/2024', '2024-13-01'])
+
+
+def test_sniff_workbook_type(tmp_path, monkeypatch):
+    parent_dir = pathlib.Path(__file__).parent.absolute()
+    for filename, workbook_type in [('Unit-AssetsMetadata-template20240209_tests.xlsx', 'Unit-AssetsMetadata'),
+                                    ('Vendor-AssetsMetadata-template20240307_tests.xlsx', 'Vendor-AssetsMetadata'),
+                                    ('AVMPI_Audio_BWF-EmbedMD_Guide_20240404.xlsx', 'Unit-BWF')]:
+        workbook = excel.open_workbook(parent_dir / filename)
+        assert excel.read_sheet_names(parent_dir / filename) == workbook.sheetnames
+        assert excel.sniff_workbook_type(parent_dir / filename) == excel.get_workbook_type(workbook) == workbook_type
+        workbook.close()
+    vendor_filepath = parent_dir / 'Vendor-AssetsMetadata-template20240307_tests.xlsx'
+    # the wrong template is turned away without opening the workbook
+    monkeypatch.setattr(excel, 'open_workbook', lambda filepath: pytest.fail("workbook was opened"))
+    with pytest.raises(RuntimeError, match='expected Unit-BWF'):
+        excel.require_workbook_type(vendor_filepath, ('Unit-BWF',))
+    not_xlsx = tmp_path / 'not.xlsx'
+    not_xlsx.write_text('a,b\n')
+    with pytest.raises(RuntimeError, match='not an xlsx'):
+        excel.load_all_worksheets(not_xlsx, use_cache=False)
+
+
+def test_load_worksheet():
+    parent_dir = pathlib.Path(__file__).parent.absolute()
+    vendor_filepath = parent_dir / 'Vendor-AssetsMetadata-template20240307_tests.xlsx'
+    workbook = excel.load_all_worksheets(vendor_filepath)
+    for use_cache in (True, False):
+        assert excel.load_worksheet(vendor_filepath, 'Digital Assets',
+                                    use_cache=use_cache) == workbook['Digital Assets']
+        assert excel.load_worksheet(vendor_filepath, 'Digital Assets', 5,
+                                    use_cache=use_cache) == {5: workbook['Digital Assets'][5]}
+        assert excel.load_worksheet(vendor_filepath, 'Digital Assets', 500, use_cache=use_cache) == {}
+    rows = excel.iter_worksheet(vendor_filepath, 'Physical Assets')
+    row_index, row = next(rows)
+    assert (row_index, row) == next(iter(workbook['Physical Assets'].items()))
+    # every row has at least the columns up to last_column_with_data
+    assert all(len(row) >= 12 for row in workbook['Digital Assets'].values())
+    with pytest.raises(KeyError):
+        excel.load_worksheet(vendor_filepath, 'no such sheet')
+
+
+def test_sheet_row():
+    parent_dir = pathlib.Path(__file__).parent.absolute()
+    vendor_filepath = parent_dir / 'Vendor-AssetsMetadata-template20240307_tests.xlsx'
+    rows = excel.load_all_worksheets(vendor_filepath, use_cache=False)['Digital Assets']
+    row = rows[4]
+    assert isinstance(row, excel.SheetRow)
+    assert row['A'] == row.get('A') == 'SIA19-095_V0001EM.mkv'
+    assert row.get('ZZ') is None
+    with pytest.raises(KeyError):
+        row['ZZ']
+    as_dict = dict(row.items())
+    assert row == as_dict
+    assert list(row) == list(as_dict) == list(row.keys())
+    assert list(row.values()) == list(as_dict.values())
+    assert repr(row) == repr(as_dict)
+    # rows the same width share one column map
+    assert all(other._columns is row._columns for other in rows.values() if len(other) == len(row))
+    assert pickle.loads(pickle.dumps(row)) == row
+
+
+def test_workbook_cache(workbook_cache_dir, tmp_path, monkeypatch):
+    parent_dir = pathlib.Path(__file__).parent.absolute()
+    vendor_filepath = tmp_path / 'vendor.xlsx'
+    vendor_filepath.write_bytes((parent_dir / 'Vendor-AssetsMetadata-template20240307_tests.xlsx').read_bytes())
+    workbook = excel.load_all_worksheets(vendor_filepath)
+    assert len(list(workbook_cache_dir.glob('*.pickle'))) == 1
+    # a hit doesn't open the spreadsheet at all
+    monkeypatch.setattr(excel, 'open_workbook', lambda filepath: pytest.fail("workbook was re-read"))
+    assert excel.load_all_worksheets(vendor_filepath) == workbook
+    # same contents under another name is the same entry
+    renamed_filepath = tmp_path / 'renamed.xlsx'
+    vendor_filepath.rename(renamed_filepath)
+    assert excel.load_all_worksheets(renamed_filepath) == workbook
+    monkeypatch.undo()
+    monkeypatch.setattr(excel, 'get_workbook_cache_dir', lambda: workbook_cache_dir)
+    # bypassing the cache re-reads, and doesn't add an entry
+    assert excel.load_all_worksheets(renamed_filepath, use_cache=False) == workbook
+    assert len(list(workbook_cache_dir.glob('*.pickle'))) == 1
+    # a different version of the config is a different key
+    key = excel.workbook_cache_key(renamed_filepath)
+    monkeypatch.setattr(excel, 'WORKBOOK_CACHE_VERSION', excel.WORKBOOK_CACHE_VERSION + 1)
+    assert excel.workbook_cache_key(renamed_filepath) != key
+    # a corrupt entry is ignored
+    (workbook_cache_dir / f"{key}.pickle").write_bytes(b'not a pickle')
+    assert excel.read_cached_workbook(key) is None
+
+
+def test_evict_workbook_cache(workbook_cache_dir):
+    for i in range(4):
+        excel.write_cached_workbook(f"key{i}", {'sheet': {i: {'A': 'x' * 1000}}})
+    excel.read_cached_workbook('key0')
+    # oldest first, except key0 which was just used
+    for i, cache_filepath in enumerate([workbook_cache_dir / f"key{i}.pickle" for i in (1, 2, 3, 0)]):
+        os.utime(cache_filepath, (1000 + i, 1000 + i))
+    entry_bytes = (workbook_cache_dir / 'key0.pickle').stat().st_size
+    assert excel.evict_workbook_cache(entry_bytes * 2) == 2
+    assert sorted(path.stem for path in workbook_cache_dir.glob('*.pickle')) == ['key0', 'key3']
+
+
+def test_manifests(tmp_path):
+    parent_dir = pathlib.Path(__file__).parent.absolute()
+    vendor_filepath = parent_dir / 'Vendor-AssetsMetadata-template20240307_tests.xlsx'
+    rows = excel.load_all_worksheets(vendor_filepath, use_cache=False)['Digital Assets']
+    # headers can be attribute names, Airtable field names or column letters
+    headers = ['digital_asset_id', 'Original Physical Asset', 'C', 'not a field']
+    csv_filepath = tmp_path / 'Digital Assets.csv'
+    with open(csv_filepath, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+        writer.writerow([])
+        for row in rows.values():
+            writer.writerow([row['A'], row['B'], row['C'], 'ignored'])
+    jsonl_filepath = tmp_path / 'delivery.jsonl'
+    with open(jsonl_filepath, 'w') as jsonl_file:
+        for row in rows.values():
+            jsonl_file.write(json.dumps(dict(zip(headers, [row['A'], row['B'], None, 'ignored']))) + '\n')
+    csv_rows = excel.load_all_worksheets(csv_filepath)['Digital Assets']
+    # the blank line is row 2, so the rows start at 3
+    assert list(csv_rows) == list(range(3, 3 + len(rows)))
+    for csv_row, row in zip(csv_rows.values(), rows.values()):
+        assert isinstance(csv_row, excel.SheetRow)
+        assert [csv_row['A'], csv_row['B'], csv_row['D'], csv_row['L']] == [row['A'], row['B'], None, None]
+    assert excel.load_worksheet(csv_filepath, 'Digital Assets', 4) == {4: csv_rows[4]}
+    # JSONL isn't named after a sheet, so it has to be given
+    with pytest.raises(KeyError):
+        excel.load_all_worksheets(jsonl_filepath)
+    jsonl_rows = excel.load_worksheet(jsonl_filepath, 'Digital Assets')
+    assert [(row['A'], row['C']) for row in jsonl_rows.values()] == [(row['A'], None) for row in rows.values()]
+    assert list(excel.load_worksheet(jsonl_filepath, 'Digital Assets', 2)) == [2]
+
+
+def test_parquet_manifest(tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    parquet_filepath = tmp_path / 'Digital Assets.parquet'
+    table = pyarrow.table({'Digital Asset ID': [f"daid_{i}.wav" for i in range(1000)],
+                           'asset_duration': ['01:02:03'] * 999 + [None]})
+    pyarrow.parquet.write_table(table, parquet_filepath)
+    rows = excel.load_all_worksheets(parquet_filepath)['Digital Assets']
+    assert len(rows) == 1000
+    assert rows[1]['A'] == 'daid_0.wav' and rows[1]['L'] == '01:02:03'
+    assert rows[1000]['L'] is None
+    assert excel.load_worksheet(parquet_filepath, 'Digital Assets', 500)[500]['A'] == 'daid_499.wav'
+    # nothing to read, instead of rows that never end
+    pyarrow.parquet.write_table(pyarrow.table({'not a field': ['x', 'y']}), parquet_filepath)
+    with pytest.raises(RuntimeError):
+        excel.load_worksheet(parquet_filepath, 'Digital Assets')
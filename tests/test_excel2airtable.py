@@ -0,0 +1,130 @@
+'''
+tests excel2airtable.py
+'''
+import json
+import logging
+import pathlib
+import argparse
+import pytest
+import excel2airtable
+
+VENDOR_FILEPATH = pathlib.Path(__file__).parent / 'Vendor-AssetsMetadata-template20240307_tests.xlsx'
+BASE_ID = 'appU0Fh8L9xVZBeok'
+
+
+def test_parse_row_range_and_shard():
+    assert excel2airtable.parse_row_range('5-1000') == (5, 1000)
+    assert excel2airtable.parse_row_range('5-') == (5, None)
+    assert excel2airtable.parse_shard('2/4') == (2, 4)
+    for bad_range in ['1000-5', '5', 'a-b']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            excel2airtable.parse_row_range(bad_range)
+    for bad_shard in ['0/4', '5/4', '2']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            excel2airtable.parse_shard(bad_shard)
+
+
+def test_select_shard():
+    rows = {row_index: {'A': f"daid_{row_index}.wav", 'B': f"PA_{row_index // 3}"} for row_index in range(4, 1004)}
+    for record_type in ['DigitalAssetRecord', 'PhysicalAssetActionRecord']:
+        shards = [excel2airtable.select_shard(rows, record_type, shard, 4) for shard in range(1, 5)]
+        # every row is in exactly one shard, and the shards are about even
+        assert sorted(row_index for shard in shards for row_index in shard) == list(rows)
+        assert all(150 < len(shard) < 350 for shard in shards)
+        assert shards[1] == excel2airtable.select_shard(rows, record_type, 2, 4)
+    # every action for a physical asset is in the same shard
+    shard_of_asset = {}
+    for shard in range(1, 5):
+        for row in excel2airtable.select_shard(rows, 'PhysicalAssetActionRecord', shard, 4).values():
+            assert shard_of_asset.setdefault(row['B'], shard) == shard
+
+
+def test_shards_upload_and_merge(fake_airtable, monkeypatch, tmp_path):
+    monkeypatch.setattr(excel2airtable, 'logger', logging.getLogger('main_logger'), raising=False)
+    monkeypatch.chdir(tmp_path)
+    fake_airtable.add_records(BASE_ID, 'Physical Assets',
+                              [{"Physical Asset ID": paid} for paid in
+                               ['SIA09-043_V0003OM', 'SIA09-043_V0004OM', 'sihsfa_LINKER_U14',
+                                'SIA19-095_V0001EM', 'SIA16-090_V0454B']])
+    kwvars = {'input': VENDOR_FILEPATH, 'input_validation': False, 'sheet': 'Digital Assets', 'row': 0,
+              'rows': None, 'shard': None, 'results_json': None, 'batch': True,
+              'refresh_schema': False, 'retry_failed': False, 'fresh': False, 'workers': 2,
+              'workbook_cache': False, 'create_links': True}
+    excel2airtable.excel_to_airtable(kwvars)
+    results_filepaths = []
+    for shard in (1, 2, 3):
+        excel2airtable.excel_to_airtable({**kwvars, 'shard': (shard, 3), 'create_links': False})
+        results_filepaths.append(tmp_path / f"{VENDOR_FILEPATH.stem}.shard-{shard}-of-3.results.json")
+    assert len(fake_airtable.records(BASE_ID, 'Digital Assets')) == 4
+    merged = excel2airtable.merge_results(results_filepaths)
+    assert merged['shards_merged'] == [1, 2, 3] and not merged['shards_missing']
+    # each shard sent some of the rows
+    for results_filepath in results_filepaths:
+        with open(results_filepath, 'r') as results_file:
+            assert json.load(results_file)['sheets']['Digital Assets']['rows']
+    assert merged['sheets']['Digital Assets']['rows'] == 4
+    assert merged['totals']['created'] == 4
+    assert excel2airtable.merge_results(results_filepaths[:1])['shards_missing'] == [2, 3]
+    with pytest.raises(RuntimeError):
+        excel2airtable.merge_results(results_filepaths + results_filepaths[:1])
+
+
+def test_shards_share_a_missing_link(fake_airtable, monkeypatch, tmp_path):
+    monkeypatch.setattr(excel2airtable, 'logger', logging.getLogger('main_logger'), raising=False)
+    monkeypatch.chdir(tmp_path)
+    csv_filepath = tmp_path / 'Digital Assets.csv'
+    # the rows are in different shards, and both go in a container that isn't in Airtable yet
+    csv_filepath.write_text("digital_asset_id,Container\ndaid_0.wav,Box 1\ndaid_8.wav,Box 1\n")
+    kwvars = {'input': csv_filepath, 'input_validation': False, 'sheet': None, 'row': 0,
+              'rows': None, 'shard': (1, 2), 'results_json': None, 'batch': True,
+              'refresh_schema': False, 'retry_failed': False, 'fresh': False, 'workers': 2,
+              'workbook_cache': False, 'create_links': False}
+    with pytest.raises(RuntimeError):
+        excel2airtable.excel_to_airtable(kwvars)
+    assert not fake_airtable.records(BASE_ID, 'Containers')
+    excel2airtable.excel_to_airtable({**kwvars, 'shard': None, 'create_links': True})
+    assert not fake_airtable.records(BASE_ID, 'Digital Assets')
+    for shard in (1, 2):
+        # each shard is its own process, with its own link cache
+        excel2airtable.airtable.link_resolver.reset()
+        excel2airtable.excel_to_airtable({**kwvars, 'shard': (shard, 2)})
+    containers = fake_airtable.records(BASE_ID, 'Containers')
+    assert [container['fields']['Container Name'] for container in containers] == ['Box 1']
+    digital_assets = fake_airtable.records(BASE_ID, 'Digital Assets')
+    assert len(digital_assets) == 2
+    assert all(record['fields']['Container'] == [containers[0]['id']] for record in digital_assets)
+
+
+def test_row_range(fake_airtable, monkeypatch, tmp_path):
+    monkeypatch.setattr(excel2airtable, 'logger', logging.getLogger('main_logger'), raising=False)
+    results_filepath = tmp_path / 'results.json'
+    kwvars = {'input': VENDOR_FILEPATH, 'input_validation': False, 'sheet': 'Digital Assets', 'row': 0,
+              'rows': (5, 6), 'shard': None, 'results_json': results_filepath, 'batch': True,
+              'refresh_schema': False, 'retry_failed': False, 'fresh': False, 'workers': 2,
+              'workbook_cache': False, 'create_links': False}
+    excel2airtable.excel_to_airtable(kwvars)
+    with open(results_filepath, 'r') as results_file:
+        results = json.load(results_file)
+    assert results['sheets']['Digital Assets']['rows'] == 2
+    assert len(fake_airtable.records(BASE_ID, 'Digital Assets')) == 2
+
+
+def test_row_changed_back_is_sent_again(fake_airtable, monkeypatch, tmp_path):
+    monkeypatch.setattr(excel2airtable, 'logger', logging.getLogger('main_logger'), raising=False)
+    csv_filepath = tmp_path / 'Digital Assets.csv'
+    sends = []
+    for md5 in ['aaa', 'aaa', 'bbb', 'aaa']:
+        requests_before = len(fake_airtable.requests)
+        csv_filepath.write_text(f"digital_asset_id,md5\ndaid_0.wav,{md5}\n")
+        kwvars = {'input': csv_filepath, 'input_validation': False, 'sheet': None, 'row': 0,
+                  'rows': None, 'shard': None, 'results_json': None, 'batch': True,
+                  'refresh_schema': False, 'retry_failed': False, 'fresh': False, 'workers': 2,
+                  'workbook_cache': False, 'create_links': False}
+        excel2airtable.excel_to_airtable(kwvars)
+        records = fake_airtable.records(BASE_ID, 'Digital Assets')
+        assert [record['fields']['MD5 Checksum Value'] for record in records] == [md5]
+        writes = [request for request in fake_airtable.requests[requests_before:]
+                  if request['method'] != 'GET']
+        sends.append(len(writes))
+    # the unchanged second run sends nothing
+    assert sends == [1, 0, 1, 1]
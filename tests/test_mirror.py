@@ -0,0 +1,85 @@
+'''
+tests the local mirror of Airtable tables
+'''
+import time
+import avmpi_scripts.services.airtable.airtable as airtable
+import avmpi_scripts.services.airtable.mirror as mirror
+
+
+class FakeSyncTable:
+    '''
+    stands in for pyairtable.Table
+    serves every record, or only the "modified" ones when asked with a formula
+    '''
+
+    def __init__(self, records: list, name: str = 'Digital Assets'):
+        self.records = records
+        self.modified = []
+        self.base = type('FakeBase', (), {'id': 'appU0Fh8L9xVZBeok'})()
+        self.name = name
+        self.formulas = []
+        self.formula_queries = 0
+
+    def iterate(self, formula=None, **options):
+        self.formulas.append(str(formula) if formula else None)
+        records = self.modified if formula else self.records
+        for start in range(0, len(records), 100):
+            yield records[start:start + 100]
+
+    def all(self, formula=None, **options):
+        self.formula_queries += 1
+        return []
+
+
+def test_mirror_sync(tmp_path):
+    records = [{'id': f"rec{i}", 'createdTime': '', 'fields': {'Digital Asset ID': f"daid_{i}.wav"}}
+               for i in range(250)]
+    fake_table = FakeSyncTable(records)
+    atbl_mirror = mirror.Mirror(tmp_path / 'mirror.sqlite')
+    assert atbl_mirror.sync(fake_table) == 3
+    assert fake_table.formulas == [None]
+    assert len(atbl_mirror.records(fake_table)) == 250
+    # second sync only asks for what changed
+    fake_table.modified = [{'id': 'rec5', 'createdTime': '', 'fields': {'Digital Asset ID': 'renamed.wav'}},
+                           {'id': 'recnew', 'createdTime': '', 'fields': {'Digital Asset ID': 'new.wav'}}]
+    assert atbl_mirror.sync(fake_table) == 1
+    assert fake_table.formulas[1].startswith("IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE(")
+    mirrored = {record['id']: record['fields'] for record in atbl_mirror.records(fake_table)}
+    assert len(mirrored) == 251
+    assert mirrored['rec5'] == {'Digital Asset ID': 'renamed.wav'}
+    # the mirror survives between runs
+    atbl_mirror.close()
+    atbl_mirror = mirror.Mirror(tmp_path / 'mirror.sqlite', full_sync_hours=0)
+    assert len(atbl_mirror.records(fake_table)) == 251
+    # once the last full sync is too old, deleted records get dropped
+    fake_table.records = records[:10]
+    time.sleep(0.01)
+    atbl_mirror.sync(fake_table)
+    assert fake_table.formulas[2] is None
+    assert len(atbl_mirror.records(fake_table)) == 10
+
+
+def test_find_from_mirror(monkeypatch, tmp_path):
+    records = [{'id': f"rec{i}", 'createdTime': '', 'fields': {'Digital Asset ID': f"daid_{i}.wav",
+                                                               'Auto ID #': i}}
+               for i in range(300)]
+    fake_table = FakeSyncTable(records)
+    monkeypatch.setattr(airtable, '_mirror', mirror.Mirror(tmp_path / 'mirror.sqlite'))
+    monkeypatch.setattr(airtable, '_mirror_synced', set())
+    monkeypatch.setattr(airtable, '_mirror_enabled', True)
+    try:
+        assert airtable.find('daid_42.wav', 'Digital Asset ID', fake_table, True)['id'] == 'rec42'
+        assert airtable.find(299, 'Auto ID #', fake_table, True)['id'] == 'rec299'
+        # synced once per run
+        assert fake_table.formulas == [None]
+        assert fake_table.formula_queries == 0
+        # missing from the mirror, double-checked live
+        assert airtable.find('nope.wav', 'Digital Asset ID', fake_table) is None
+        assert fake_table.formula_queries == 1
+        # --fresh
+        airtable.use_mirror(False)
+        airtable.find('daid_42.wav', 'Digital Asset ID', fake_table)
+        assert fake_table.formula_queries == 2
+        assert fake_table.formulas == [None]
+    finally:
+        airtable.clear_prefetch()
@@ -0,0 +1,219 @@
+'''
+tests the Airtable outbox
+'''
+import time
+import pytest
+import requests
+import threading
+import avmpi_scripts.services.airtable.outbox as outbox
+
+
+class FakeTable:
+    '''
+    stands in for pyairtable.Table
+    can be told to drop the connection, or to reject records
+    '''
+
+    def __init__(self, connection_errors: int = 0, bad_value: str = None, rate_limited: int = 0,
+                 read_timeouts: int = 0, seconds: float = 0):
+        self.connection_errors = connection_errors
+        self.bad_value = bad_value
+        self.rate_limited = rate_limited
+        self.read_timeouts = read_timeouts
+        self.seconds = seconds
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _check(self, records: list):
+        time.sleep(self.seconds)
+        with self._lock:
+            self.requests.append(records)
+        if self.read_timeouts:
+            self.read_timeouts -= 1
+            raise requests.exceptions.ReadTimeout("read timed out")
+        if self.connection_errors:
+            self.connection_errors -= 1
+            raise requests.exceptions.ConnectionError("network is down")
+        if self.rate_limited:
+            self.rate_limited -= 1
+            response = requests.Response()
+            response.status_code = 429
+            raise requests.exceptions.HTTPError("RATE_LIMIT_REACHED", response=response)
+        for record in records:
+            if self.bad_value and self.bad_value in str(record):
+                response = requests.Response()
+                response.status_code = 422
+                raise requests.exceptions.HTTPError("INVALID_MULTIPLE_CHOICE_OPTIONS", response=response)
+
+    def batch_upsert(self, records, key_fields):
+        self._check(records)
+        out = [{'id': f"rec{record['fields'][key_fields[0]]}"} for record in records]
+        return {'createdRecords': [rec['id'] for rec in out], 'updatedRecords': [], 'records': out}
+
+    def batch_create(self, records):
+        self._check(records)
+        return [{'id': f"recnew{i}"} for i, _ in enumerate(records)]
+
+
+@pytest.fixture
+def atbl_outbox(tmp_path):
+    atbl_outbox = outbox.Outbox(tmp_path / 'outbox.sqlite')
+    yield atbl_outbox
+    atbl_outbox.close()
+
+
+def fill(atbl_outbox: outbox.Outbox, count: int):
+    for i in range(count):
+        key = outbox.make_idempotency_key('test.xlsx', 'PhysicalAssetRecord', i)
+        assert atbl_outbox.enqueue('Physical Assets', 'upsert', {'Physical Asset ID': f"PA{i}"},
+                                   key, key_fields=['Physical Asset ID'])
+
+
+def test_enqueue_idempotent(atbl_outbox):
+    fill(atbl_outbox, 3)
+    key = outbox.make_idempotency_key('test.xlsx', 'PhysicalAssetRecord', 0)
+    assert not atbl_outbox.enqueue('Physical Assets', 'upsert', {'Physical Asset ID': 'PA0'},
+                                   key, key_fields=['Physical Asset ID'])
+    assert atbl_outbox.status(key) == 'pending'
+    assert atbl_outbox.counts()['pending'] == 3
+
+
+def test_enqueue_replaces_changed_entry(atbl_outbox):
+    key = outbox.make_idempotency_key('test.xlsx', 'PhysicalAssetRecord', 0)
+    fake_table = FakeTable()
+    for part, queued in [('1', True), ('1', False), ('2', True), ('1', True)]:
+        payload = {'Physical Asset ID': 'PA0', 'Part': part}
+        assert atbl_outbox.enqueue('Physical Assets', 'upsert', payload, key,
+                                   key_fields=['Physical Asset ID']) == queued
+        assert atbl_outbox.unchanged(key, outbox.make_payload_hash(payload))
+        atbl_outbox.drain(lambda table_name: fake_table)
+    # A -> A -> B -> A is sent three times, and the outbox only ever has the one entry
+    assert [records[0]['fields']['Part'] for records in fake_table.requests] == ['1', '2', '1']
+    assert atbl_outbox.counts() == {'pending': 0, 'sent': 1, 'failed': 0}
+
+
+def test_enqueue_from_threads(atbl_outbox):
+    '''
+    the upload stage of excel2airtable writes from its own thread
+    '''
+    def enqueue(start):
+        for i in range(start, start + 20):
+            key = outbox.make_idempotency_key('test.xlsx', 'PhysicalAssetRecord', i)
+            atbl_outbox.enqueue('Physical Assets', 'upsert', {'Physical Asset ID': f"PA{i}"},
+                                key, key_fields=['Physical Asset ID'])
+
+    threads = [threading.Thread(target=enqueue, args=(start,)) for start in range(0, 80, 20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert atbl_outbox.counts()['pending'] == 80
+
+
+def test_drain_batches(atbl_outbox):
+    fill(atbl_outbox, 25)
+    fake_table = FakeTable()
+    result = atbl_outbox.drain(lambda table_name: fake_table)
+    assert [len(records) for records in fake_table.requests] == [10, 10, 5]
+    assert result == {'created': 25, 'updated': 0, 'failed': 0, 'pending': 0, 'calls': 3}
+    assert atbl_outbox.drain(lambda table_name: fake_table)['calls'] == 0
+
+
+def test_drain_resumes_after_network_drop(atbl_outbox):
+    fill(atbl_outbox, 15)
+    fake_table = FakeTable(connection_errors=2)
+    result = atbl_outbox.drain(lambda table_name: fake_table, max_attempts=2, backoff_seconds=0)
+    assert result['pending'] == 15
+    # next run picks up where the last one left off
+    result = atbl_outbox.drain(lambda table_name: fake_table, max_attempts=2, backoff_seconds=0)
+    assert result['created'] == 15
+    assert result['pending'] == 0
+
+
+def test_drain_waits_out_rate_limit(atbl_outbox):
+    fill(atbl_outbox, 15)
+    fake_table = FakeTable(rate_limited=3)
+    result = atbl_outbox.drain(lambda table_name: fake_table, max_attempts=2, backoff_seconds=0)
+    # not rejected, left pending for the next run
+    assert result['failed'] == 0
+    assert result['pending'] == 15
+    result = atbl_outbox.drain(lambda table_name: fake_table, max_attempts=2, backoff_seconds=0)
+    assert result['created'] == 15
+    assert atbl_outbox.counts() == {'pending': 0, 'sent': 15, 'failed': 0}
+
+
+def test_drain_isolates_rejected_record(atbl_outbox):
+    fill(atbl_outbox, 10)
+    fake_table = FakeTable(bad_value='PA3')
+    result = atbl_outbox.drain(lambda table_name: fake_table)
+    assert result['created'] == 9
+    assert result['failed'] == 1
+    assert atbl_outbox.counts() == {'pending': 0, 'sent': 9, 'failed': 1}
+    assert atbl_outbox.retry_failed() == 1
+    assert atbl_outbox.counts()['pending'] == 1
+
+
+def test_chunks_split_on_repeated_key(atbl_outbox):
+    fill(atbl_outbox, 3)
+    atbl_outbox.enqueue('Physical Assets', 'upsert', {'Physical Asset ID': 'PA1', 'Part': '2'},
+                        'later edit', key_fields=['Physical Asset ID'])
+    atbl_outbox.enqueue('QC Log', 'create', {'MediaConch': 'Pass'}, 'qc')
+    chunks = outbox.Outbox._chunk_entries(atbl_outbox.pending(), 10)
+    assert [len(chunk) for chunk in chunks] == [3, 1, 1]
+
+
+def fill_creates(atbl_outbox: outbox.Outbox, count: int):
+    for i in range(count):
+        atbl_outbox.enqueue('QC Log', 'create', {'MediaConch': 'Pass', 'Digital Asset': [f"recDA{i}"]},
+                            outbox.make_idempotency_key('QC Log', f"recDA{i}"))
+
+
+def test_two_processes_drain_one_outbox(tmp_path):
+    '''
+    validate_media and excel2airtable can share an outbox file
+    '''
+    outboxes = [outbox.Outbox(tmp_path / 'outbox.sqlite') for _ in range(2)]
+    fill_creates(outboxes[0], 250)
+    fake_table = FakeTable(seconds=0.01)
+    threads = [threading.Thread(target=atbl_outbox.drain, args=(lambda table_name: fake_table,),
+                                kwargs={'claim_size': 20}) for atbl_outbox in outboxes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sent = [record['Digital Asset'][0] for records in fake_table.requests for record in records]
+    # every entry created exactly once
+    assert sorted(sent) == sorted(f"recDA{i}" for i in range(250))
+    assert outboxes[1].counts() == {'pending': 0, 'sent': 250, 'failed': 0}
+    for atbl_outbox in outboxes:
+        atbl_outbox.close()
+
+
+def test_create_not_resent_after_read_timeout(atbl_outbox, tmp_path):
+    fill_creates(atbl_outbox, 5)
+    fake_table = FakeTable(read_timeouts=1)
+    result = atbl_outbox.drain(lambda table_name: fake_table, backoff_seconds=0)
+    # the creates may have gone through, so they're left for someone to check
+    assert result['failed'] == 5
+    assert len(fake_table.requests) == 1
+    # upserts are safe to send again
+    upsert_outbox = outbox.Outbox(tmp_path / 'upserts.sqlite')
+    fill(upsert_outbox, 5)
+    fake_table = FakeTable(read_timeouts=1)
+    result = upsert_outbox.drain(lambda table_name: fake_table, backoff_seconds=0)
+    assert result['created'] == 5 and result['failed'] == 0
+    assert len(fake_table.requests) == 2
+    upsert_outbox.close()
+
+
+def test_interrupted_drain_is_recovered(atbl_outbox):
+    fill_creates(atbl_outbox, 2)
+    fill(atbl_outbox, 2)
+    # claimed by a drain that was killed before it could send them
+    atbl_outbox._claim('killed', 10)
+    fake_table = FakeTable()
+    assert atbl_outbox.drain(lambda table_name: fake_table)['calls'] == 0
+    result = atbl_outbox.drain(lambda table_name: fake_table, stale_seconds=0)
+    assert result['created'] == 2
+    assert result['failed'] == 2
+    assert atbl_outbox.counts()['failed'] == 2
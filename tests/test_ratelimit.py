@@ -0,0 +1,71 @@
+'''
+tests the cross-process Airtable rate governor
+'''
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import avmpi_scripts.services.airtable.ratelimit as ratelimit
+
+
+def test_token_bucket_shared(tmp_path):
+    state_filepath = tmp_path / 'ratelimit.sqlite'
+    # two governors on the same file stand in for two scripts running at once
+    governor_a = ratelimit.RateGovernor(state_filepath, requests_per_second=5, burst=5)
+    governor_b = ratelimit.RateGovernor(state_filepath, requests_per_second=5, burst=5)
+    for _ in range(3):
+        assert governor_a.acquire('appU0Fh8L9xVZBeok') == 0
+    for _ in range(2):
+        assert governor_b.acquire('appU0Fh8L9xVZBeok') == 0
+    assert governor_a.wait_time('appU0Fh8L9xVZBeok') > 0
+    assert governor_b.wait_time('appU0Fh8L9xVZBeok') > 0
+    # other bases have their own bucket
+    assert governor_a.wait_time('appWtd175HSokQgQP') == 0
+    start = time.time()
+    governor_b.acquire('appU0Fh8L9xVZBeok')
+    assert time.time() - start > 0.1
+
+
+def test_block(tmp_path):
+    governor = ratelimit.RateGovernor(tmp_path / 'ratelimit.sqlite')
+    governor.block(0.3)
+    assert 0.2 < governor.wait_time() <= 0.3
+    assert governor.acquire() > 0.2
+
+
+def test_get_bucket_key():
+    assert ratelimit.get_bucket_key('https://api.airtable.com/v0/appU0Fh8L9xVZBeok/QC%20Log') == 'appU0Fh8L9xVZBeok'
+    assert ratelimit.get_bucket_key('https://api.airtable.com/v0/meta/whoami') == 'default'
+
+
+class TooManyRequestsAdapter(HTTPAdapter):
+    '''
+    answers 429 a few times, then 200
+    '''
+
+    def __init__(self, too_many: int):
+        super().__init__()
+        self.too_many = too_many
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = 429 if self.calls <= self.too_many else 200
+        response._content = b'{}'
+        response.request = request
+        return response
+
+
+def test_governed_session_backs_off(tmp_path):
+    governor = ratelimit.RateGovernor(tmp_path / 'ratelimit.sqlite')
+    session = ratelimit.GovernedSession(lambda: governor, max_retries=3, backoff_seconds=0.05)
+    adapter = TooManyRequestsAdapter(too_many=2)
+    session.mount('https://', adapter)
+    response = session.get('https://api.airtable.com/v0/appU0Fh8L9xVZBeok/QC%20Log')
+    assert response.status_code == 200
+    assert adapter.calls == 3
+    adapter = TooManyRequestsAdapter(too_many=10)
+    session.mount('https://', adapter)
+    response = session.get('https://api.airtable.com/v0/appU0Fh8L9xVZBeok/QC%20Log')
+    assert response.status_code == 429
+    assert adapter.calls == 4
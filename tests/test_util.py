@@ -0,0 +1,42 @@
+'''
+tests util.py
+'''
+import time
+import threading
+import pytest
+import util
+
+
+def test_map_ordered():
+    in_flight = []
+    most_in_flight = []
+    lock = threading.Lock()
+
+    def convert(i):
+        with lock:
+            in_flight.append(i)
+            most_in_flight.append(len(in_flight))
+        # later items finish first
+        time.sleep(0.01 * (i % 3))
+        with lock:
+            in_flight.remove(i)
+        return i * 2
+
+    started = time.perf_counter()
+    assert list(util.map_ordered(convert, range(30), workers=4, window=6)) == [i * 2 for i in range(30)]
+    assert max(most_in_flight) <= 4
+    # overlapped, not one after another (which would be 0.3 s)
+    assert time.perf_counter() - started < 0.25
+
+
+def test_map_ordered_raises():
+    def convert(i):
+        if i == 3:
+            raise RuntimeError("no such linked record")
+        return i
+
+    results = []
+    with pytest.raises(RuntimeError):
+        for result in util.map_ordered(convert, range(10), workers=2):
+            results.append(result)
+    assert results == [0, 1, 2]
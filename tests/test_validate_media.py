@@ -0,0 +1,48 @@
+'''
+tests validate_media.py
+'''
+import validate_media
+import services.airtable.airtable as airtable
+
+
+def make_index(records: list, field: str) -> airtable.TableIndex:
+    table_index = airtable.TableIndex(None, [field])
+    for record in records:
+        table_index.add(record)
+    return table_index
+
+
+def test_plan_qc_log_sync():
+    da_recs_by_daid = {f"daid_{i}.mkv": [{'id': f"recDA{i}", 'fields': {'Digital Asset ID': f"daid_{i}.mkv"}}]
+                       for i in range(4)}
+    da_recs_by_daid['daid_9.mkv'] = []
+    qc_index = make_index([{'id': 'recQC1', 'fields': {'Digital Asset': ['recDA1']}},
+                           {'id': 'recQC3', 'fields': {'Digital Asset': ['recDA3']}}], "Digital Asset")
+    results = [('daid_0.mkv', 'Pass', ''), ('daid_1.mkv', 'Fail', 'bad'),
+               ('daid_2.mkv', 'In Progress', 'hmm'), ('daid_3.mkv', 'Pass', ''),
+               ('daid_9.mkv', 'Pass', '')]
+    creates, updates, missing = validate_media.plan_qc_log_sync(results, da_recs_by_daid, qc_index,
+                                                                 '2024-04-04')
+    assert creates == [{"MediaConch": "Pass", "QC Issues": "", "QC Start": '2024-04-04',
+                        "Digital Asset": ['recDA0']},
+                       {"MediaConch": "In Progress", "QC Issues": "hmm", "QC Start": '2024-04-04',
+                        "Digital Asset": ['recDA2']}]
+    assert [update['id'] for update in updates] == ['recQC1', 'recQC3']
+    assert updates[0]['fields']['MediaConch'] == 'Fail'
+    assert missing == ['daid_9.mkv']
+
+
+def test_send_results_fail_pass_fail(fake_airtable):
+    base_id = airtable.config()['bases']['Assets']['base_id']
+    digital_assets = fake_airtable.add_records(base_id, 'Digital Assets', [{"Digital Asset ID": "daid_0.mkv"}])
+    fake_airtable.add_records(base_id, 'QC Log', [{"Digital Asset": [digital_assets[0]['id']],
+                                                   "MediaConch": "In Progress"}])
+    # each run reads the QC Log live, like separate validate_media runs would
+    airtable.use_mirror(False)
+    for status in ['Fail', 'Pass', 'Fail']:
+        if status == 'Pass':
+            validate_media.send_results_to_airtable([{'daid': 'daid_0.mkv'}], [], [])
+        else:
+            validate_media.send_results_to_airtable([], [{'daid': 'daid_0.mkv', 'log': 'bad'}], [])
+        qc_log = fake_airtable.records(base_id, 'QC Log')
+        assert [record['fields']['MediaConch'] for record in qc_log] == [status]